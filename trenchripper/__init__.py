@@ -15,6 +15,8 @@ from .projection import *
 from .marlin import *
 from .daskutils import *
 from .utils import *
+from .arraystore import *
+from .parquetindex import *
 from .steadystate import *
 
 jobqueue_config_path = (
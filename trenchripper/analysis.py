@@ -1,6 +1,9 @@
 # fmt: off
 from .utils import pandas_hdf5_handler
 from .trcluster import dask_controller
+from .daskutils import wait_for_completion
+from .arraystore import open_array_file,get_array_backend
+from .parquetindex import encode_index_columns,index_bounds,file_parquet_index_widths
 
 import h5py
 import os
@@ -46,6 +49,7 @@ class regionprops_extractor:
         self.meta_handle = pandas_hdf5_handler(self.global_metapath)
         fovdf = self.meta_handle.read_df("global",read_metadata=True)
         self.metadata = fovdf.metadata
+        self.array_backend = self.metadata.get("array_backend","hdf5")
 
         self.analysispath = headpath + "/analysis"
         self.props_list = props_list
@@ -64,14 +68,14 @@ class regionprops_extractor:
     def get_file_regionprops(self,file_idx):
         pixel_microns = self.metadata['pixel_microns']
 
-        segmentation_file = self.segmentationpath + "/segmentation_" + str(file_idx) + ".hdf5"
-        kymograph_file = self.kymographpath + "/kymograph_" + str(file_idx) + ".hdf5"
+        segmentation_file = self.segmentationpath + "/segmentation_" + str(file_idx)
+        kymograph_file = self.kymographpath + "/kymograph_" + str(file_idx)
 
-        with h5py.File(segmentation_file,"r") as segfile:
+        with open_array_file(segmentation_file,"r",backend=self.array_backend) as segfile:
             seg_arr = segfile["data"][:]
         if self.intensity_channel_list is not None:
             kymo_arr_list = []
-            with h5py.File(kymograph_file,"r") as kymofile:
+            with open_array_file(kymograph_file,"r",backend=self.array_backend) as kymofile:
                 for intensity_channel in self.intensity_channel_list:
                     kymo_arr_list.append(kymofile[intensity_channel][:])
         props_output = []
@@ -165,9 +169,7 @@ class regionprops_extractor:
         column_list = base_list + unpacked_props_list
 
         df_out = pd.DataFrame(props_output, columns=column_list).reset_index()
-        file_idx = df_out.apply(lambda x: int(f'{x["File Index"]:08n}{x["File Trench Index"]:04n}{x["timepoints"]:04n}{x["Objectid"]:02n}'), axis=1)
-
-        df_out["File Parquet Index"] = [item for item in file_idx]
+        df_out["File Parquet Index"] = encode_index_columns(df_out,["File Index","File Trench Index","timepoints","Objectid"],file_parquet_index_widths+[2])
         df_out = df_out.set_index("File Parquet Index").sort_index()
         del df_out["index"]
 
@@ -185,16 +187,7 @@ class regionprops_extractor:
             delayed_list.append(df_delayed.persist())
 
         ## filtering out non-failed dataframes ##
-        all_delayed_futures = []
-        for item in delayed_list:
-            all_delayed_futures += futures_of(item)
-        while any(future.status == "pending" for future in all_delayed_futures):
-            sleep(0.1)
-
-        good_delayed = []
-        for item in delayed_list:
-            if all([future.status == "finished" for future in futures_of(item)]):
-                good_delayed.append(item)
+        good_delayed,_ = wait_for_completion(delayed_list,label="Regionprops")
 
         ## compiling output dataframe ##
         df_out = dd.from_delayed(good_delayed).persist()
@@ -207,7 +200,7 @@ class regionprops_extractor:
         kymo_df = kymo_df.set_index("File Merge Index", sorted=True)
         kymo_df = kymo_df.drop(["File Index","File Trench Index","timepoints","File Parquet Index"], axis=1)
 
-        df_out["File Merge Index"] = df_out.apply(lambda x: int(f'{x["File Index"]:08n}{x["File Trench Index"]:04n}{x["timepoints"]:04n}'), axis=1)
+        df_out["File Merge Index"] = encode_index_columns(df_out,["File Index","File Trench Index","timepoints"],file_parquet_index_widths)
         df_out = df_out.reset_index(drop=True)
         df_out = df_out.set_index("File Merge Index", sorted=True)
 
@@ -242,11 +235,12 @@ class kymograph_viewer:
         self.kymopath = headpath + "/kymograph"
         self.segpath = headpath + "/" + segdir
         self.channel = channel
+        self.array_backend = get_array_backend(headpath + "/metadata.hdf5")
 
     def get_kymograph_data(self,file_idx,trench_idx):
-        with h5py.File(self.kymopath + "/kymograph_"+str(file_idx)+".hdf5", "r") as infile:
+        with open_array_file(self.kymopath + "/kymograph_"+str(file_idx), "r", backend=self.array_backend) as infile:
             kymodat = infile[self.channel][trench_idx]
-        with h5py.File(self.segpath+"/segmentation_"+str(file_idx)+".hdf5", "r") as infile:
+        with open_array_file(self.segpath+"/segmentation_"+str(file_idx), "r", backend=self.array_backend) as infile:
             segdat = infile["data"][trench_idx]
         segdat = np.array([sk.morphology.label(segdat[t],connectivity=1) for t in range(segdat.shape[0])])
         return kymodat,segdat
@@ -281,13 +275,13 @@ def get_image_measurements(
     df = dd.read_parquet(kymographpath + "/metadata",calculate_divisions=True)
     df = df.set_index("File Parquet Index",sorted=True,npartitions=n_partitions,divisions=divisions)
 
-    start_idx = int(str(file_idx) + "00000000")
-    end_idx = int(str(file_idx) + "99999999")
+    start_idx,end_idx = index_bounds([file_idx],file_parquet_index_widths)
 
     working_dfs = []
 
-    proc_file_path = kymographpath + "/kymograph_" + str(file_idx) + ".hdf5"
-    with h5py.File(proc_file_path, "r") as infile:
+    array_backend = get_array_backend(os.path.dirname(kymographpath) + "/metadata.hdf5")
+    proc_file_path = kymographpath + "/kymograph_" + str(file_idx)
+    with open_array_file(proc_file_path, "r", backend=array_backend) as infile:
         working_filedf = df.loc[start_idx:end_idx].compute(scheduler='threads')
         trench_idx_list = working_filedf["File Trench Index"].unique().tolist()
         for trench_idx in trench_idx_list:
@@ -324,13 +318,7 @@ def get_all_image_measurements(dask_controller, headpath, output_path, channels,
 #         delayed_list.append(df_delayed.persist())
         df_futures.append(df_future)
 
-    while any(future.status == 'pending' for future in df_futures):
-        sleep(0.1)
-
-    good_futures = []
-    for future in df_futures:
-        if future.status == 'finished':
-            good_futures.append(future)
+    good_futures,_ = wait_for_completion(df_futures,label=output_name)
 
     good_delayed = [delayed(good_future.result)() for good_future in good_futures]
 
@@ -500,6 +488,11 @@ def fetch_hdf5(filename,channel):
         data = infile[channel][:]
     return data
 
+def fetch_array(path,channel,backend="hdf5"):
+    with open_array_file(path,"r",backend=backend) as infile:
+        data = infile[channel][:]
+    return data
+
 def put_index_first(df,col_name):
     df_cols = list(df)
     df_cols.insert(0, df_cols.pop(df_cols.index(col_name)))
@@ -1168,17 +1161,17 @@ def kymo_xarr(headpath,subset=None,in_memory=False,in_distributed_memory=False,u
     meta_handle = pandas_hdf5_handler(headpath+"/metadata.hdf5")
     metadata = meta_handle.read_df("global",read_metadata=True).metadata
     channels = metadata["channels"]
+    array_backend = metadata.get("array_backend","hdf5")
     file_indices = data_parquet["File Index"].unique().compute().to_list()
 
-    delayed_fetch_hdf5 = delayed(fetch_hdf5)
-    filenames = [headpath + '/kymograph/kymograph_'+str(file_idx)+'.hdf5' for file_idx in file_indices]
+    delayed_fetch_array = delayed(fetch_array)
+    filenames = [headpath + '/kymograph/kymograph_'+str(file_idx) for file_idx in file_indices]
 
-    sample = fetch_hdf5(filenames[0],channels[0])
+    sample = fetch_array(filenames[0],channels[0],backend=array_backend)
 
     channel_arr = []
     for channel in channels:
-        filenames = [headpath + '/kymograph/kymograph_'+str(file_idx)+'.hdf5' for file_idx in file_indices]
-        delayed_arrays = [delayed_fetch_hdf5(fn,channel) for fn in filenames]
+        delayed_arrays = [delayed_fetch_array(fn,channel,backend=array_backend) for fn in filenames]
         da_file_arrays = [da.from_delayed(delayed_reader, shape=sample.shape, dtype=sample.dtype) for delayed_reader in delayed_arrays]
         da_file_index_arr = da.concatenate(da_file_arrays, axis=0)
         channel_arr.append(da_file_index_arr)
@@ -0,0 +1,131 @@
+# fmt: off
+import os
+import shutil
+import h5py
+import numpy as np
+import pandas as pd
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+array_file_extensions = {"hdf5":".hdf5","zarr":".zarr"}
+
+class zarr_file:
+    def __init__(self,filepath,mode="r"):
+        """Zarr directory store with the subset of the h5py.File interface used by
+        the pipeline. Each dataset is a chunked zarr array, so separate workers can
+        write disjoint chunks of the same array concurrently without file locks.
+
+        Args:
+            filepath (str): Path of the .zarr directory.
+            mode (str): "r", "r+", "a" or "w", as in h5py.File.
+        """
+        if zarr is None:
+            raise ImportError("zarr is required for the zarr array backend.")
+        self.filepath = filepath
+        self.group = zarr.open_group(store=filepath,mode=mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def keys(self):
+        return self.group.keys()
+
+    def __contains__(self,key):
+        return key in self.group
+
+    def __getitem__(self,key):
+        return self.group[key]
+
+    def create_dataset(self,name,shape=None,dtype=None,data=None,chunks=None,**kwargs):
+        """h5py style create_dataset. h5py specific keywords (compression filters,
+        fillvalue etc.) are ignored in favour of zarr's default compressor.
+        """
+        if data is not None:
+            data = np.asarray(data)
+            shape = data.shape
+            dtype = data.dtype if dtype is None else dtype
+        array_kwargs = {"shape":shape,"dtype":dtype,"overwrite":True}
+        if chunks is not None and chunks is not True:
+            array_kwargs["chunks"] = chunks
+        if hasattr(self.group,"create_array"):
+            array = self.group.create_array(name,**array_kwargs)
+        else:
+            array = self.group.create_dataset(name,**array_kwargs)
+        if data is not None:
+            array[...] = data
+        return array
+
+def iter_t_slabs(dataset,t_chunk):
+    """Reads a (t,...) dataset in slabs of about t_chunk timepoints. The slab
+    length is rounded to a whole number of the dataset's chunks along t, so
+    each chunk is read and decompressed only once.
+
+    Args:
+        dataset (h5py.Dataset or zarr.Array): Dataset to read.
+        t_chunk (int): Target number of timepoints per slab.
+
+    Yields:
+        tuple: (t_start,t_end,slab) with slab = dataset[t_start:t_end].
+    """
+    chunks = getattr(dataset,"chunks",None)
+    if chunks is not None:
+        t_chunk = max(t_chunk//chunks[0],1)*chunks[0]
+    num_tpts = dataset.shape[0]
+    for t_start in range(0,num_tpts,t_chunk):
+        t_end = min(t_start+t_chunk,num_tpts)
+        yield t_start,t_end,dataset[t_start:t_end]
+
+def array_file_path(path,backend="hdf5"):
+    """Returns the on-disk path of an array file given its path without extension."""
+    return path + array_file_extensions[backend]
+
+def open_array_file(path,mode="r",backend="hdf5",**kwargs):
+    """Opens an array file, such as hdf5/hdf5_0 or kymograph/kymograph_0, with the
+    selected storage backend. The path excludes the file extension.
+
+    Args:
+        path (str): Path without extension.
+        mode (str): File mode.
+        backend (str): "hdf5" or "zarr".
+        **kwargs: Passed to h5py.File (e.g. rdcc_nbytes), ignored for zarr.
+
+    Returns:
+        h5py.File or zarr_file: Open file handle.
+    """
+    if backend == "hdf5":
+        return h5py.File(array_file_path(path,backend),mode,**kwargs)
+    elif backend == "zarr":
+        return zarr_file(array_file_path(path,backend),mode=mode)
+    else:
+        raise ValueError("Unknown array backend " + str(backend))
+
+def remove_array_file(path,backend="hdf5"):
+    filepath = array_file_path(path,backend)
+    if os.path.isdir(filepath):
+        shutil.rmtree(filepath)
+    else:
+        os.remove(filepath)
+
+def array_file_exists(path,backend="hdf5"):
+    return os.path.exists(array_file_path(path,backend))
+
+def get_array_backend(metapath):
+    """Reads the array backend recorded at extraction from metadata.hdf5, defaulting
+    to hdf5 for older datasets.
+    """
+    if not os.path.exists(metapath):
+        return "hdf5"
+    with pd.HDFStore(metapath,"r") as store:
+        if "/global" not in store.keys():
+            return "hdf5"
+        metadata = getattr(store.get_storer("global").attrs,"metadata",{})
+    return metadata.get("array_backend","hdf5")
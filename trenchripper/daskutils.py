@@ -5,7 +5,83 @@ import os
 import shutil
 import time
 
+from distributed import as_completed
+from distributed.client import futures_of
+
 from .utils import writedir
+from .parquetindex import encode_index_columns
+
+
+def iter_completed(items, label=None, report_fraction=0.1):
+    """Yields each item as soon as all of its futures have completed, in
+    completion order, using as_completed instead of polling future status.
+
+    Args:
+        items (list): Futures, or persisted dask collections backed by futures.
+        label (str, optional): If given, progress is printed under this label.
+        report_fraction (float): Fraction of items between progress reports.
+
+    Yields:
+        tuple: (index, item, succeeded) where index is the item's position in
+        items and succeeded is False if any of its futures errored or was
+        cancelled.
+    """
+    num_items = len(items)
+    remaining = []
+    failed = [False] * num_items
+    key_to_items = {}
+    key_to_future = {}
+    for i, item in enumerate(items):
+        item_futures = futures_of(item)
+        remaining.append(len(item_futures))
+        for future in item_futures:
+            key_to_items.setdefault(future.key, []).append(i)
+            key_to_future[future.key] = future
+
+    num_done, num_failed = (0, 0)
+    report_every = max(int(num_items * report_fraction), 1)
+
+    def report():
+        if label is not None and (num_done % report_every == 0 or num_done == num_items):
+            print(label + ": " + str(num_done) + "/" + str(num_items) + " done, " + str(num_failed) + " failed.")
+
+    for i in range(num_items):
+        if remaining[i] == 0:
+            num_done += 1
+            report()
+            yield i, items[i], True
+
+    for future in as_completed(list(key_to_future.values())):
+        for i in key_to_items[future.key]:
+            if future.status != "finished":
+                failed[i] = True
+            remaining[i] -= 1
+            if remaining[i] == 0:
+                num_done += 1
+                num_failed += int(failed[i])
+                report()
+                yield i, items[i], not failed[i]
+
+
+def wait_for_completion(items, label=None, report_fraction=0.1):
+    """Blocks until every item has completed and splits them by outcome.
+
+    Args:
+        items (list): Futures, or persisted dask collections backed by futures.
+        label (str, optional): If given, progress is printed under this label.
+        report_fraction (float): Fraction of items between progress reports.
+
+    Returns:
+        tuple: (succeeded, failed) lists of items, each in the original order.
+    """
+    succeeded_mask = [False] * len(items)
+    for i, _, succeeded in iter_completed(
+        items, label=label, report_fraction=report_fraction
+    ):
+        succeeded_mask[i] = succeeded
+    succeeded = [item for i, item in enumerate(items) if succeeded_mask[i]]
+    failed = [item for i, item in enumerate(items) if not succeeded_mask[i]]
+    return succeeded, failed
 
 
 def add_list_to_column(df, list_to_add, column_name, repartition=False):
@@ -55,15 +131,25 @@ def set_new_aligned_index(df, index_column):
 
 
 def make_parquet_index(df, index_columns, index_precisions):
-    index_precisions = index_precisions.astype("uint")
-    rolling_precisions = np.add.accumulate(index_precisions[::-1])
-    precision_factors = (10**rolling_precisions)[::-1]
-    parquet_index = sum(
-        [
-            df[index_column].astype("uint") * precision_factors[i]
-            for i, index_column in enumerate(index_columns)
-        ]
-    )
+    """Packs index_columns into a single int64 index, where index_precisions[i]
+    is the number of digits that follow column i. A wrapper over
+    parquetindex.encode_index_columns, so out of range columns raise an
+    OverflowError.
+
+    Args:
+        df (pandas.DataFrame or dask.dataframe.DataFrame): Input dataframe.
+        index_columns (list): Column names, in the order they are packed.
+        index_precisions (array): Digits following each column.
+
+    Returns:
+        pandas.Series or dask.dataframe.Series: Packed index aligned with df.
+    """
+    index_precisions = [int(precision) for precision in index_precisions]
+    ## the digit width of column i is the precision of column i-1
+    index_widths = [index_precisions[0]] + index_precisions[:-1]
+    parquet_index = encode_index_columns(df, index_columns, index_widths)
+    if index_precisions[-1] > 0:
+        parquet_index = parquet_index * (10 ** index_precisions[-1])
     return parquet_index
 
 
@@ -177,15 +263,14 @@ def to_parquet_checkpoint(
         )
         output_futures.append(output_future)
 
-    while len(unfinished_files) > 0:
-        time.sleep(10)
-        output_temp_path_dirlist = os.listdir(output_temp_path)
-        finished_files = [
-            int(path.split(".")[1])
-            for path in output_temp_path_dirlist
-            if "Lockfile" in path
-        ]
-        unfinished_files = sorted(list(set(partition_list) - set(finished_files)))
+    _, failed_futures = wait_for_completion(output_futures)
+    if len(failed_futures) > 0:
+        raise RuntimeError(
+            str(len(failed_futures))
+            + " partitions failed to write to "
+            + output_temp_path
+            + ", rerun to resume."
+        )
 
     temp_output_file_list = [
         output_temp_path + "/temp_output." + str(partition_idx) + ".parquet"
@@ -22,6 +22,7 @@ from holoviews.operation.datashader import regrid
 from .kymograph import kymograph_multifov,get_grid_indices
 from .segment import fluo_segmentation
 from .utils import kymo_handle,pandas_hdf5_handler
+from .arraystore import open_array_file,get_array_backend
 #
 class kymograph_interactive(kymograph_multifov):
     def __init__(self,headpath):
@@ -48,7 +49,7 @@ class kymograph_interactive(kymograph_multifov):
         file_idx = int(img_entry["File Index"])
         img_idx = int(img_entry["Image Index"])
 
-        with h5py.File(self.headpath + "/hdf5/hdf5_" + str(file_idx) + ".hdf5", "r") as infile:
+        with open_array_file(self.headpath + "/hdf5/hdf5_" + str(file_idx), "r", backend=self.array_backend) as infile:
             img_arr = infile[channel][img_idx,:,:]
         if invert:
             img_arr = sk.util.invert(img_arr)
@@ -481,6 +482,7 @@ class focus_filter:
     def __init__(self,headpath):
         self.headpath = headpath
         self.kymographpath = headpath + "/kymograph"
+        self.array_backend = get_array_backend(headpath + "/metadata.hdf5")
         self.df = dd.read_parquet(self.kymographpath + "/metadata",calculate_divisions=True)
 
         self.final_params = {}
@@ -546,7 +548,7 @@ class focus_filter:
             trench_idx = row["trench"]
             img_idx = row["Image Index"]
 
-            with h5py.File(self.kymographpath + "/kymograph_processed_" + str(file_idx) + ".hdf5", "r") as hdf5_handle:
+            with open_array_file(self.kymographpath + "/kymograph_processed_" + str(file_idx), "r", backend=self.array_backend) as hdf5_handle:
                 array = hdf5_handle[row_idx + "/" + self.channel][trench_idx,img_idx]
             array_list.append(array)
         output_array = np.concatenate(np.expand_dims(array_list,axis=0),axis=0)
@@ -596,7 +598,7 @@ class fluo_segmentation_interactive(fluo_segmentation):
     def __init__(self,headpath,maskpath=None,bit_max=0,scale_timepoints=False,scaling_percentile=0.9,img_scaling=1.,smooth_sigma=0.75,\
                  eig_sigma=2.,eig_ball_radius=20,eig_local_thr="niblack",eig_otsu_scaling=1.,eig_niblack_k=0.05,eig_window_size=7,\
                  hess_pad=6,local_thr="otsu",background_thr="triangle",global_threshold=25,window_size=15,cell_otsu_scaling=1.,niblack_k=0.2,background_scaling=1.,\
-                 min_obj_size=30,distance_threshold=2,border_buffer=1,horizontal_border_only=False):
+                 min_obj_size=30,distance_threshold=2,border_buffer=1,horizontal_border_only=False,eig_background_method="rolling_ball"):
 
         fluo_segmentation.__init__(self,maskpath=maskpath,bit_max=bit_max,scale_timepoints=scale_timepoints,scaling_percentile=scaling_percentile,img_scaling=img_scaling,\
                                     smooth_sigma=smooth_sigma,eig_sigma=eig_sigma,eig_ball_radius=eig_ball_radius,eig_local_thr=eig_local_thr,\
@@ -604,7 +606,7 @@ class fluo_segmentation_interactive(fluo_segmentation):
                                     hess_pad=hess_pad,local_thr=local_thr,background_thr=background_thr,\
                                     global_threshold=global_threshold,window_size=window_size,cell_otsu_scaling=cell_otsu_scaling,niblack_k=niblack_k,\
                                     background_scaling=background_scaling,min_obj_size=min_obj_size,distance_threshold=distance_threshold,border_buffer=border_buffer,\
-                                  horizontal_border_only=horizontal_border_only)
+                                  horizontal_border_only=horizontal_border_only,eig_background_method=eig_background_method)
 
         self.headpath = headpath
         self.kymographpath = headpath + "/kymograph"
@@ -616,6 +618,7 @@ class fluo_segmentation_interactive(fluo_segmentation):
 #         self.kymodf = self.meta_handle.read_df("kymograph",read_metadata=True)
         globaldf = self.meta_handle.read_df("global",read_metadata=True)
         self.all_channels = globaldf.metadata['channels']
+        self.array_backend = globaldf.metadata.get("array_backend","hdf5")
         self.foldersinheadpath = next(os.walk(headpath))[1]
 
         timepoint_num = len(self.kymodf["timepoints"].unique().tolist())
@@ -669,7 +672,7 @@ class fluo_segmentation_interactive(fluo_segmentation):
 
         array_list = []
         for item in selectedlist:
-            with h5py.File(self.kymographpath + "/kymograph_" + str(item[0]) + ".hdf5", "r") as hdf5_handle:
+            with open_array_file(self.kymographpath + "/kymograph_" + str(item[0]), "r", backend=self.array_backend) as hdf5_handle:
                 if t_range[1] is None:
                     array = hdf5_handle[self.seg_channel][item[1],t_range[0]::t_subsample_step]
                 else:
@@ -685,7 +688,7 @@ class fluo_segmentation_interactive(fluo_segmentation):
             mask_array_list = []
             mask_label_array_list = []
             for item in selectedlist:
-                with h5py.File(self.fullmaskpath + "/segmentation_" + str(item[0]) + ".hdf5", "r") as hdf5_handle:
+                with open_array_file(self.fullmaskpath + "/segmentation_" + str(item[0]), "r", backend=self.array_backend) as hdf5_handle:
                     if t_range[1] is None:
                         mask_label_array = hdf5_handle["data"][item[1],t_range[0]::t_subsample_step]
                         mask_array = mask_label_array>0
@@ -937,9 +940,10 @@ class fluo_segmentation_interactive(fluo_segmentation):
         )
         display(cell_mask_list_int)
 
-    def plot_eig_mask(self,eig_sigma,eig_ball_radius,eig_local_thr,eig_otsu_scaling,eig_niblack_k,eig_window_size):
+    def plot_eig_mask(self,eig_sigma,eig_ball_radius,eig_background_method,eig_local_thr,eig_otsu_scaling,eig_niblack_k,eig_window_size):
         self.final_params['Hessian Blur Sigma:'] = eig_sigma
         self.final_params['Hessian Rolling Ball Size:'] = eig_ball_radius
+        self.final_params['Hessian Background Method:'] = eig_background_method
         self.final_params['Hessian Local Threshold Method:'] = eig_local_thr
         self.final_params['Hessian Otsu Scaling:'] = eig_otsu_scaling
         self.final_params['Hessian Niblack K:'] = eig_niblack_k
@@ -950,11 +954,11 @@ class fluo_segmentation_interactive(fluo_segmentation):
         for i,eig in enumerate(self.eig_list):
             if self.maskpath is None:
                 eig_mask, inv_eig_img = self.get_eig_mask(eig,None,eig_sigma=eig_sigma,eig_ball_radius=eig_ball_radius,eig_local_thr=eig_local_thr,eig_otsu_scaling=eig_otsu_scaling,\
-                                             eig_niblack_k=eig_niblack_k,eig_window_size=eig_window_size)
+                                             eig_niblack_k=eig_niblack_k,eig_window_size=eig_window_size,eig_background_method=eig_background_method)
             else:
                 input_mask = self.proc_mask_list[i]
                 eig_mask, inv_eig_img = self.get_eig_mask(eig,input_mask,eig_sigma=eig_sigma,eig_ball_radius=eig_ball_radius,eig_local_thr=eig_local_thr,eig_otsu_scaling=eig_otsu_scaling,\
-                                             eig_niblack_k=eig_niblack_k,eig_window_size=eig_window_size)
+                                             eig_niblack_k=eig_niblack_k,eig_window_size=eig_window_size,eig_background_method=eig_background_method)
             eig_mask_list.append(eig_mask)
             inv_eig_img_list.append(inv_eig_img)
         self.eig_mask_list = eig_mask_list
@@ -968,6 +972,7 @@ class fluo_segmentation_interactive(fluo_segmentation):
         cell_eig_list_int = interactive(
             self.plot_eig_mask,
             {"manual": True},
+            eig_background_method=Dropdown(options=["rolling_ball","parabolic","shrink"],value="rolling_ball",description="Hessian Background Method:"),
             eig_local_thr=Dropdown(options=["otsu","niblack"],value="niblack"),
             eig_sigma=FloatSlider(
                 value=2.,
@@ -1042,9 +1047,10 @@ class fluo_segmentation_interactive(fluo_segmentation):
         )
         display(dist_mask_int)
 
-    def plot_marker_mask(self,eig_sigma,eig_ball_radius,eig_local_thr,eig_otsu_scaling,eig_niblack_k,eig_window_size,distance_threshold,border_buffer,horizontal_border_only):
+    def plot_marker_mask(self,eig_sigma,eig_ball_radius,eig_background_method,eig_local_thr,eig_otsu_scaling,eig_niblack_k,eig_window_size,distance_threshold,border_buffer,horizontal_border_only):
         self.final_params['Hessian Blur Sigma:'] = eig_sigma
         self.final_params['Hessian Rolling Ball Size:'] = eig_ball_radius
+        self.final_params['Hessian Background Method:'] = eig_background_method
         self.final_params['Hessian Local Threshold Method:'] = eig_local_thr
         self.final_params['Hessian Otsu Scaling:'] = eig_otsu_scaling
         self.final_params['Hessian Niblack K:'] = eig_niblack_k
@@ -1061,11 +1067,11 @@ class fluo_segmentation_interactive(fluo_segmentation):
             eig = self.eig_list[i]
             if self.maskpath is None:
                 eig_mask, inv_eig_img = self.get_eig_mask(eig,None,eig_sigma=eig_sigma,eig_ball_radius=eig_ball_radius,eig_local_thr=eig_local_thr,eig_otsu_scaling=eig_otsu_scaling,\
-                                             eig_niblack_k=eig_niblack_k,eig_window_size=eig_window_size)
+                                             eig_niblack_k=eig_niblack_k,eig_window_size=eig_window_size,eig_background_method=eig_background_method)
             else:
                 input_mask = self.proc_mask_list[i]
                 eig_mask, inv_eig_img = self.get_eig_mask(eig,input_mask,eig_sigma=eig_sigma,eig_ball_radius=eig_ball_radius,eig_local_thr=eig_local_thr,eig_otsu_scaling=eig_otsu_scaling,\
-                                             eig_niblack_k=eig_niblack_k,eig_window_size=eig_window_size)
+                                             eig_niblack_k=eig_niblack_k,eig_window_size=eig_window_size,eig_background_method=eig_background_method)
 
             cell_mask = self.cell_mask_list[i]
             dist_img = ndi.distance_transform_edt(cell_mask).astype("uint8")
@@ -1084,26 +1090,9 @@ class fluo_segmentation_interactive(fluo_segmentation):
             output_kymo = output_kymo.return_wrap()
 
             if self.maskpath is not None:
-                label_arr = self.mask_label_output_array[i]
-                reindexed_kymo = np.stack([output_kymo,label_arr],axis=3)
-                relabel_fn = lambda x: int(f'{x[0]:04n}{x[1]:04n}')
-                reindexed_kymo = np.apply_along_axis(relabel_fn,3,reindexed_kymo) #kyx
-                reindexed_kymo[(output_kymo==0)|(label_arr==0)] = 0
-                output_kymo = reindexed_kymo
-                del reindexed_kymo
-                del label_arr
-                output_kymo = np.stack([sk.segmentation.relabel_sequential(output_kymo[i],offset=1)[0] for i in range(output_kymo.shape[0])],axis=0)
-
-            top_bottom_mask = np.ones(output_kymo.shape[1:],dtype=bool)
-            top_bottom_mask[:(border_buffer+1)] = False
-            top_bottom_mask[-(border_buffer+1):] = False
-
-            for i in range(output_kymo.shape[0]):
-                if (border_buffer >= 0) and not horizontal_border_only:
-                    output_kymo[i] = sk.segmentation.clear_border(output_kymo[i], buffer_size=border_buffer) ##NEW
-                elif (border_buffer >= 0) and horizontal_border_only:
-                    output_kymo[i] = sk.segmentation.clear_border(output_kymo[i], mask=top_bottom_mask) ##NEWER
-                output_kymo[i] = self.reorder_ids(output_kymo[i])
+                output_kymo = self.combine_labels(output_kymo,self.mask_label_output_array[i])
+
+            output_kymo = self.clear_border_frames(output_kymo,border_buffer=border_buffer,horizontal_border_only=horizontal_border_only)
 
             unwrapped_output = kymo_handle()
             unwrapped_output.import_wrap(output_kymo)
@@ -1127,6 +1116,7 @@ class fluo_segmentation_interactive(fluo_segmentation):
             marker_mask_int = interactive(
                 self.plot_marker_mask,
                 {"manual": True},
+                eig_background_method=Dropdown(options=["rolling_ball","parabolic","shrink"],value=self.final_params.get('Hessian Background Method:',"rolling_ball"),description="Hessian Background Method:"),
                 eig_local_thr=Dropdown(options=["otsu","niblack"],value=self.final_params['Hessian Local Threshold Method:']),
                 eig_sigma=FloatSlider(
                     value=self.final_params['Hessian Blur Sigma:'],
@@ -1190,6 +1180,7 @@ class fluo_segmentation_interactive(fluo_segmentation):
             marker_mask_int = interactive(
                 self.plot_marker_mask,
                 {"manual": True},
+                eig_background_method=Dropdown(options=["rolling_ball","parabolic","shrink"],value="rolling_ball",description="Hessian Background Method:"),
                 eig_local_thr=Dropdown(options=["otsu","niblack"],value="niblack"),
                 eig_sigma=FloatSlider(
                     value=2.,
@@ -1284,7 +1275,7 @@ class hdf5_viewer:
             for channel in self.channels:
                 channel_arrays = []
                 for file_idx in file_indices:
-                    infile = h5py.File(headpath + '/hdf5/hdf5_'+str(file_idx)+'.hdf5','r')
+                    infile = open_array_file(headpath + '/hdf5/hdf5_'+str(file_idx),'r',backend=self.metadata.get("array_backend","hdf5"))
                     data = infile[channel]
                     array = da.from_array(data, chunks=(1, data.shape[1], data.shape[2]))
                     channel_arrays.append(array)
@@ -1433,7 +1424,7 @@ class whole_chip_viewer:
                 data = testfile[list(testfile.keys())[0]]
                 self.img_height,self.img_width = (data.shape[1],data.shape[2])
         else:
-            with h5py.File(headpath + '/hdf5/hdf5_0.hdf5','r') as testfile:
+            with open_array_file(headpath + '/hdf5/hdf5_0','r',backend=self.metadata.get("array_backend","hdf5")) as testfile:
                 data = testfile[list(testfile.keys())[0]]
                 self.img_height,self.img_width = (data.shape[1],data.shape[2])
             
@@ -1455,7 +1446,7 @@ class whole_chip_viewer:
                             if thumbnail:
                                 infile = h5py.File(headpath + '/hdf5_thumbnails/hdf5_'+str(file_idx)+'.hdf5','r')
                             else:
-                                infile = h5py.File(headpath + '/hdf5/hdf5_'+str(file_idx)+'.hdf5','r')
+                                infile = open_array_file(headpath + '/hdf5/hdf5_'+str(file_idx),'r',backend=self.metadata.get("array_backend","hdf5"))
                             data = infile[channel]
                             array = da.from_array(data, chunks=(1, data.shape[1], data.shape[2]))
                             column_dask.append(array)
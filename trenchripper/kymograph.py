@@ -19,10 +19,15 @@ from dask.distributed import wait
 import dask.dataframe as dd
 import dask.delayed as delayed
 
+from numpy.lib.stride_tricks import sliding_window_view
+
 from skimage import filters
 from .trcluster import hdf5lock
 from .utils import multifov,pandas_hdf5_handler,writedir
-from .daskutils import add_list_to_column
+from .daskutils import add_list_to_column,iter_completed,wait_for_completion
+from .arraystore import open_array_file,remove_array_file,get_array_backend,iter_t_slabs
+from .parquetindex import encode_index_columns,index_bounds,fov_parquet_index_widths,temp_file_parquet_index_widths,\
+file_parquet_index_widths,trenchid_timepoint_index_widths
 from tifffile import imread
 
 ## Hacky memory trim
@@ -32,6 +37,31 @@ def trim_memory() -> int:
     libc = ctypes.CDLL("libc.so.6")
     return libc.malloc_trim(0)
 
+def get_row_percentiles(img_arr,percentile,invert=False):
+    """Computes a percentile along the last axis with 'lower' interpolation,
+    equivalent to np.percentile(img_arr,percentile,axis=-1,interpolation='lower').
+    Only a single order statistic is needed, so a partial sort (np.partition)
+    is used instead of sorting every row.
+
+    Args:
+        img_arr (array): Array of shape (...,x).
+        percentile (float): Percentile to compute.
+        invert (bool): If True, computes the percentile of sk.util.invert(img_arr).
+        For unsigned integer arrays this is done without inverting the input.
+
+    Returns:
+        array: Percentile array of shape (...), in the dtype of img_arr.
+    """
+    n = img_arr.shape[-1]
+    k = int(np.floor((percentile/100.)*(n-1)))
+    if invert and np.issubdtype(img_arr.dtype,np.unsignedinteger):
+        ## the k-th smallest inverted value is the (n-1-k)-th smallest value, inverted
+        kth = np.partition(img_arr,n-1-k,axis=-1)[...,n-1-k]
+        return np.iinfo(img_arr.dtype).max - kth
+    elif invert:
+        img_arr = sk.util.invert(img_arr)
+    return np.partition(img_arr,k,axis=-1)[...,k]
+
 # def get_focus_score(img_arr):
 #     # computes focus score from single image
 
@@ -51,6 +81,154 @@ def get_focus_score(img_arr):
     Ften = np.sum(Sx**2 + Sy**2)
     return Ften
 
+def get_focus_scores(img_stack,batch_size=256):
+    """Batched get_focus_score and mean intensity over a stack of images. Each
+    image is min/max normalized in float32 and the Sobel energy is computed with
+    separable slice arithmetic on the reflect-padded stack, matching
+    skimage.filters.sobel_h/sobel_v. Constant images get a focus score of 0.
+
+    Args:
+        img_stack (numpy.ndarray): Images of shape (n,y,x).
+        batch_size (int): Number of images normalized at once, bounding the float32 working memory.
+
+    Returns:
+        tuple: (focus_scores,intensity_scores), float arrays of shape (n,).
+    """
+    num_imgs = img_stack.shape[0]
+    focus_scores = np.zeros(num_imgs,dtype=float)
+    intensity_scores = img_stack.mean(axis=(1,2),dtype=float)
+    for start in range(0,num_imgs,batch_size):
+        batch = img_stack[start:start+batch_size]
+        img_min = batch.min(axis=(1,2)).astype("float32")[:,np.newaxis,np.newaxis]
+        img_range = batch.max(axis=(1,2)).astype("float32")[:,np.newaxis,np.newaxis]-img_min
+        img_range[img_range==0] = np.inf
+        I = np.pad((batch-img_min)/img_range,((0,0),(1,1),(1,1)),mode="symmetric").astype("float32",copy=False)
+
+        smooth_x = I[:,:,:-2] + 2*I[:,:,1:-1] + I[:,:,2:]
+        Sx = (smooth_x[:,:-2]-smooth_x[:,2:])/4
+        smooth_y = I[:,:-2] + 2*I[:,1:-1] + I[:,2:]
+        Sy = (smooth_y[:,:,:-2]-smooth_y[:,:,2:])/4
+        focus_scores[start:start+batch_size] = np.sum(Sx**2 + Sy**2,axis=(1,2),dtype=float)
+    return focus_scores,intensity_scores
+
+def get_otsu_thresholds(signal,nbins=50):
+    """Otsu thresholds of every row of a 2D array, computed from a single 2D
+    histogram. Equivalent to sk.filters.threshold_otsu(signal[i],nbins=nbins)
+    for each row i of a float array.
+
+    Args:
+        signal (numpy.ndarray): Array of shape (n,x).
+        nbins (int): Number of histogram bins per row.
+
+    Returns:
+        numpy.ndarray: Thresholds of shape (n,).
+    """
+    signal = np.asarray(signal,dtype=float)
+    num_rows = signal.shape[0]
+    row_min,row_max = (signal.min(axis=1),signal.max(axis=1))
+    constant = row_min == row_max
+
+    ## per-row np.histogram binning, including its edge corrections
+    first_edge = row_min
+    last_edge = np.where(constant,row_min+1.,row_max)
+    bin_edges = np.linspace(first_edge,last_edge,nbins+1,axis=1)
+    norm = nbins/(last_edge-first_edge)
+    indices = ((signal-first_edge[:,np.newaxis])*norm[:,np.newaxis]).astype(np.intp)
+    indices[indices==nbins] -= 1
+    indices[signal<np.take_along_axis(bin_edges,indices,axis=1)] -= 1
+    increment = (signal>=np.take_along_axis(bin_edges,indices+1,axis=1))&(indices!=nbins-1)
+    indices[increment] += 1
+    row_offsets = (np.arange(num_rows)*nbins)[:,np.newaxis]
+    counts = np.bincount((indices+row_offsets).ravel(),minlength=num_rows*nbins).reshape(num_rows,nbins)
+    bin_centers = (bin_edges[:,:-1]+bin_edges[:,1:])/2
+
+    weight1 = np.cumsum(counts,axis=1)
+    weight2 = np.cumsum(counts[:,::-1],axis=1)[:,::-1]
+    with np.errstate(divide="ignore",invalid="ignore"): # constant rows, overwritten below
+        mean1 = np.cumsum(counts*bin_centers,axis=1)/weight1
+        mean2 = (np.cumsum((counts*bin_centers)[:,::-1],axis=1)/weight2[:,::-1])[:,::-1]
+    variance12 = weight1[:,:-1]*weight2[:,1:]*(mean1[:,:-1]-mean2[:,1:])**2
+
+    thresholds = bin_centers[np.arange(num_rows),np.argmax(variance12,axis=1)]
+    thresholds[constant] = row_min[constant]
+    return thresholds
+
+def get_mask_midpoints(mask):
+    """Row-wise equivalent of get_midpoints_from_mask over a (n,x) boolean
+    array. Rising and falling edges of all rows are found in one pass; a
+    falling edge before the first rising edge and an unmatched trailing
+    rising edge are dropped, and the remaining edges are paired in order.
+
+    Args:
+        mask (numpy.ndarray): Boolean array of shape (n,x).
+
+    Returns:
+        list: n int arrays of trench midpoint x positions.
+    """
+    transitions = np.diff(mask.astype(np.int8),axis=1)
+    row_idx,edges = np.nonzero(transitions)
+    rising = transitions[row_idx,edges] == 1
+
+    row_start = np.ones(len(row_idx),dtype=bool)
+    row_start[1:] = row_idx[1:] != row_idx[:-1]
+    row_end = np.ones(len(row_idx),dtype=bool)
+    row_end[:-1] = row_start[1:]
+    keep = ~((row_start&~rising)|(row_end&rising))
+    row_idx,edges = (row_idx[keep],edges[keep])
+
+    midpoints = (edges[0::2]+edges[1::2])//2
+    split_points = np.searchsorted(row_idx[0::2],np.arange(1,mask.shape[0]))
+    return np.split(midpoints,split_points)
+
+def get_midpoints_over_time(x_signal,otsu_scaling,min_threshold):
+    """Finds the trench midpoints of one row at every timepoint, thresholding
+    all timepoints at once. Timepoints where fewer than half of the previous
+    midpoints are found reuse the previous midpoints.
+
+    Args:
+        x_signal (numpy.ndarray): Smoothed x signal of shape (t,x).
+        otsu_scaling (float): Threshold scaling factor for Otsu's method thresholding.
+        min_threshold (float): Lower bound on the threshold.
+
+    Returns:
+        tuple: (all_midpoints,thresholds) where all_midpoints is a list of t midpoint arrays, or None
+        if no midpoints are found at the first timepoint, and thresholds has shape (t,).
+    """
+    thresholds = np.maximum(get_otsu_thresholds(x_signal)*otsu_scaling,min_threshold)
+    midpoints_t = get_mask_midpoints(x_signal>thresholds[:,np.newaxis])
+    if len(midpoints_t[0]) == 0:
+        return None,thresholds
+    all_midpoints = [midpoints_t[0]]
+    for midpoints in midpoints_t[1:]:
+        if len(midpoints)/(len(all_midpoints[-1])+1) < 0.5:
+            all_midpoints.append(all_midpoints[-1])
+        else:
+            all_midpoints.append(midpoints)
+    return all_midpoints,thresholds
+
+def get_row_x_drift(all_midpoints):
+    """Computes the cumulative x drift of one row from its midpoints over time.
+    Each midpoint is matched to the nearest midpoint at the next timepoint by
+    binary search and the drift between timepoints is the median offset.
+
+    Args:
+        all_midpoints (list): Sorted midpoint arrays, one per timepoint.
+
+    Returns:
+        numpy.ndarray: Net x drift of each timepoint, relative to the first.
+    """
+    x_drift = []
+    for t in range(len(all_midpoints)-1):
+        prev_midpoints,next_midpoints = (np.asarray(all_midpoints[t]),np.asarray(all_midpoints[t+1]))
+        right_idx = np.clip(np.searchsorted(next_midpoints,prev_midpoints),1,len(next_midpoints)-1)
+        left_idx = right_idx-1
+        if len(next_midpoints) == 1:
+            right_idx = left_idx = np.zeros(len(prev_midpoints),dtype=int)
+        left_dist,right_dist = (next_midpoints[left_idx]-prev_midpoints,next_midpoints[right_idx]-prev_midpoints)
+        min_dists = np.where(np.abs(left_dist)<=np.abs(right_dist),left_dist,right_dist)
+        x_drift.append(int(np.median(min_dists)))
+    return np.append(np.array([0]),np.add.accumulate(x_drift))
+
 def get_grid_lookups(global_df, delta = 10):
     first_tpt = global_df.loc[pd.IndexSlice[:, slice(0, 0)], :]
 
@@ -152,6 +330,90 @@ def match_midpoints(midpoints, consensus_midpoints, midpoint_dist_tolerence):
 
     return matched_min_cons_idx, match_mask
 
+def get_metadata_lookup(fovdf,alternate_over_rows=False):
+    """Builds compact per-file and per-fov lookups of the global metadata table,
+    so that kymograph tasks do not each re-read and re-index metadata.hdf5.
+
+    Args:
+        fovdf (pandas.DataFrame): Global metadata indexed by (fov,timepoints).
+        alternate_over_rows (bool): Also compute the grid row of each fov.
+
+    Returns:
+        dict: {"files":{file_idx:{"fov","timepoints","Image Index"}},
+        "fovs":{fov_idx:{"File Index","Image Index",("x","y","t")}},"grid_rows":dict or None},
+        where the per-file arrays are sorted by image index and the per-fov arrays follow
+        the order of fovdf.loc[fov_idx].
+    """
+    filedf = fovdf.reset_index(inplace=False)
+    filedf = filedf.sort_values(["File Index","Image Index"],kind="stable")
+    file_lookup = {}
+    for file_idx,working_filedf in filedf.groupby("File Index",sort=True):
+        file_lookup[file_idx] = {"fov":working_filedf["fov"].values[0],"timepoints":working_filedf["timepoints"].values,\
+                                 "Image Index":working_filedf["Image Index"].values}
+
+    fov_columns = ["File Index","Image Index"] + [column for column in ["x","y","t"] if column in fovdf.columns]
+    fov_lookup = {}
+    for fov_idx in fovdf.index.get_level_values("fov").unique():
+        working_fovdf = fovdf.loc[fov_idx]
+        fov_lookup[fov_idx] = {column:working_fovdf[column].values for column in fov_columns}
+
+    if alternate_over_rows:
+        _, grid_rows = get_grid_lookups(fovdf, delta = 10)
+    else:
+        grid_rows = None
+    return {"files":file_lookup,"fovs":fov_lookup,"grid_rows":grid_rows}
+
+def get_trench_lookup(trench_df,trenches_per_file,renumber_rows=False):
+    """Builds the per-trench table used to reorganize kymographs in post-processing.
+    Trenches are ordered by (fov,row,trench), assigned to output files in blocks of
+    trenches_per_file and renumbered contiguously, so gaps left by filtered trenches
+    or rows are closed.
+
+    Args:
+        trench_df (pandas.DataFrame): One row per trench with columns fov, row and trench, indexed by trenchid.
+        trenches_per_file (int): Number of trenches in each reorganized file.
+        renumber_rows (bool): Also renumber rows within each fov.
+
+    Returns:
+        pandas.DataFrame: Indexed by the current trenchid, in output order, with columns fov, row,
+        trench, new row, new trench, File Index, File Trench Index and new trenchid.
+    """
+    trench_lookup = trench_df[["fov","row","trench"]].sort_values(["fov","row","trench"],kind="stable")
+    trench_order = np.arange(len(trench_lookup))
+    if renumber_rows:
+        trench_lookup["new row"] = trench_lookup.groupby("fov")["row"].rank(method="dense").astype(int)-1
+    else:
+        trench_lookup["new row"] = trench_lookup["row"]
+    trench_lookup["new trench"] = trench_lookup.groupby(["fov","row"]).cumcount()
+    trench_lookup["File Index"] = trench_order//trenches_per_file
+    trench_lookup["File Trench Index"] = trench_order%trenches_per_file
+    trench_lookup["new trenchid"] = trench_order
+    return trench_lookup
+
+def apply_trench_lookup(df,trench_lookup):
+    """Applies a get_trench_lookup table to one partition of the kymograph metadata,
+    assigning the output file indices, renumbered rows, trenches and trenchids along
+    with the indices derived from them.
+
+    Args:
+        df (pandas.DataFrame): Kymograph metadata partition.
+        trench_lookup (pandas.DataFrame): Output of get_trench_lookup.
+
+    Returns:
+        pandas.DataFrame: Metadata indexed by the new FOV Parquet Index.
+    """
+    lookup = trench_lookup.loc[df["trenchid"].values]
+    df = df.drop(columns=["File Index","Image Index","trenchid"])
+    df["row"] = lookup["new row"].values
+    df["trench"] = lookup["new trench"].values
+    df["File Index"] = lookup["File Index"].values
+    df["File Trench Index"] = lookup["File Trench Index"].values
+    df["File Parquet Index"] = encode_index_columns(df,["File Index","File Trench Index","timepoints"],file_parquet_index_widths)
+    df["trenchid"] = lookup["new trenchid"].values
+    df["Trenchid Timepoint Index"] = encode_index_columns(df,["trenchid","timepoints"],trenchid_timepoint_index_widths)
+    df.index = pd.Index(encode_index_columns(df,["fov","row","trench","timepoints"],fov_parquet_index_widths).values,name="FOV Parquet Index")
+    return df
+
 class kymograph_cluster:
     def __init__(self,headpath="",paramfile=False,all_channels=[""],filter_channel=None,trench_len_y=270,padding_y=20,trench_width_x=30,use_median_drift=False,\
                  invert=False,y_percentile=85,y_foreground_percentile=80,y_min_edge_dist=50,midpoint_dist_tolerence=50,smoothing_kernel_y=(1,9),y_percentile_threshold=0.2,\
@@ -199,6 +461,7 @@ class kymograph_cluster:
         self.seg_channel = self.all_channels[0]
         self.metapath = self.headpath + "/metadata.hdf5"
         self.meta_handle = pandas_hdf5_handler(self.metapath)
+        self.array_backend = get_array_backend(self.metapath)
 
 #         self.t_range = t_range
         self.invert = invert
@@ -280,7 +543,7 @@ class kymograph_cluster:
         med_filter[:,-kernel_pad[1]:] = end_edge
         return med_filter
 
-    def get_smoothed_y_percentiles(self,file_idx,y_percentile,y_foreground_percentile,smoothing_kernel_y):
+    def get_smoothed_y_percentiles(self,file_idx,y_percentile,y_foreground_percentile,smoothing_kernel_y,t_chunk=25):
         """For each imported array, computes the percentile along the x-axis of
         the segmentation channel, generating a (y,t) array. Then performs
         median filtering of this array for smoothing.
@@ -290,17 +553,19 @@ class kymograph_cluster:
             "data" of shape (channel,y,x,t).
             y_percentile (int): Percentile to apply along the x-axis.
             smoothing_kernel_y (tuple): Kernel to use for median filtering.
+            t_chunk (int): Number of timepoints read and reduced at a time, bounds peak memory. Rounded
+            to whole dataset chunks along t.
 
         Returns:
             h5py.File: Hdf5 file handle corresponding to the output hdf5 dataset "data", a smoothed
             percentile array of shape (y,t).
         """
-        with h5py.File(self.hdf5path+"/hdf5_"+str(file_idx)+".hdf5","r",rdcc_nbytes=self.metadata["chunk_cache_mem_size"]) as imported_hdf5_handle:
+        with open_array_file(self.hdf5path+"/hdf5_"+str(file_idx),"r",backend=self.array_backend,rdcc_nbytes=self.metadata["chunk_cache_mem_size"]) as imported_hdf5_handle:
         # with h5py_cache.File(self.hdf5path+"/hdf5_"+str(file_idx)+".hdf5","r",chunk_cache_mem_size=self.metadata["chunk_cache_mem_size"]) as imported_hdf5_handle:
-            img_arr = imported_hdf5_handle[self.seg_channel][:] #t x y
-            if self.invert:
-                img_arr = sk.util.invert(img_arr)
-            perc_arr = np.percentile(img_arr,y_percentile,axis=2,interpolation='lower')
+            img_dset = imported_hdf5_handle[self.seg_channel] #t x y
+            perc_arr = np.empty(img_dset.shape[:2],dtype=img_dset.dtype)
+            for t_start,t_end,img_slab in iter_t_slabs(img_dset,t_chunk):
+                perc_arr[t_start:t_end] = get_row_percentiles(img_slab,y_percentile,invert=self.invert)
             y_percentiles_smoothed = self.median_filter_2d(perc_arr,smoothing_kernel_y)
 
             min_qth_percentile = y_percentiles_smoothed.min(axis=1)[:, np.newaxis]
@@ -577,25 +842,34 @@ class kymograph_cluster:
 
         return valid_init_y_ends,valid_orientations
 
+    def get_metadata_lookup(self,metadata_lookup=None):
+        """Returns metadata_lookup, building it from metadata.hdf5 if it was not passed in."""
+        if metadata_lookup is None:
+            fovdf = self.meta_handle.read_df("global",read_metadata=False)
+            metadata_lookup = get_metadata_lookup(fovdf,alternate_over_rows=self.alternate_over_rows)
+        return metadata_lookup
+
     def get_ends_and_orientations(self,fov_idx,edges_futures,expected_num_rows,alternate_orientation,top_orientation,alternate_over_rows,\
-                                  consensus_orientations,consensus_midpoints,y_min_edge_dist,midpoint_dist_tolerence,padding_y,trench_len_y):
+                                  consensus_orientations,consensus_midpoints,y_min_edge_dist,midpoint_dist_tolerence,padding_y,trench_len_y,metadata_lookup=None):
 
-        fovdf = self.meta_handle.read_df("global",read_metadata=False)
+        metadata_lookup = self.get_metadata_lookup(metadata_lookup)
         if alternate_over_rows:
-            _, y_lookup = get_grid_lookups(fovdf, delta = 10)
+            y_lookup = metadata_lookup["grid_rows"]
+            if y_lookup is None:
+                _, y_lookup = get_grid_lookups(self.meta_handle.read_df("global",read_metadata=False), delta = 10)
             current_row = y_lookup[fov_idx]
         else:
             current_row = 0
 #         fovdf = fovdf.loc[(slice(None), slice(self.t_range[0],self.t_range[1])),:]
-        working_fovdf = fovdf.loc[fov_idx]
+        fov_lookup = metadata_lookup["fovs"][fov_idx]
+        fov_file_indices = fov_lookup["File Index"]
 
         trench_edges_y_list = []
         start_above_list = []
         end_above_list = []
 
-        for j,file_idx in enumerate(working_fovdf["File Index"].unique().tolist()):
-            working_filedf = working_fovdf[working_fovdf["File Index"]==file_idx]
-            img_indices = working_filedf["Image Index"].unique()
+        for j,file_idx in enumerate(pd.unique(fov_file_indices)):
+            img_indices = pd.unique(fov_lookup["Image Index"][fov_file_indices==file_idx])
             first_idx,last_idx = (img_indices[0],img_indices[-1])
             trench_edges_y_list += edges_futures[j][0][first_idx:last_idx+1]
             start_above_list += edges_futures[j][1][first_idx:last_idx+1]
@@ -629,76 +903,113 @@ class kymograph_cluster:
         drift_orientation_and_initend_future = tuple((new_y_drift,drift_orientation_and_initend_future[1],drift_orientation_and_initend_future[2]))
         return drift_orientation_and_initend_future
 
-    def crop_y(self,file_idx,drift_orientation_and_initend_future,padding_y,trench_len_y):
-        """Performs cropping of the images in the y-dimension.
+    def get_file_crop_params(self,file_idx,drift_orientation_and_initend_future,metadata_lookup=None):
+        """Looks up the image range of a file and the drift corrected trench ends
+        for each of its timepoints.
 
         Args:
-            i (int): Specifies the current fov index.
-            trench_edges_y_list (list): List containing, for each fov entry, a list of time-sorted edge arrays.
-            row_num_list (list): List containing The number of trench rows detected in each fov.
-            imported_array_list (list): A list containing numpy arrays containing the hdf5 file image
-            data of shape (channel,y,x,t).
-            padding_y (int): Padding to be used when cropping in the y-dimension.
-            trench_len_y (int): Length from the end of the tenches to be used when cropping in the
-            y-dimension.
-            top_orientation (int, optional): The orientation of the top-most row where 0 corresponds to a trench with
-            a downward-oriented trench opening and 1 corresponds to a trench with an upward-oriented trench opening.
+            file_idx (int): File index.
+            drift_orientation_and_initend_future (tuple): Output of get_ends_and_orientations.
+            metadata_lookup (dict, optional): Output of get_metadata_lookup, read from
+            metadata.hdf5 if not given.
+
         Returns:
-            array: A y-cropped array of shape (rows,channels,x,y,t).
+            tuple: (first_idx,last_idx,image_slice,drift_corrected_edges,valid_orientations) where
+            first_idx and last_idx are the first and last timepoints in the file.
         """
-        fovdf = self.meta_handle.read_df("global",read_metadata=False)
-#         fovdf = fovdf.loc[(slice(None), slice(self.t_range[0],self.t_range[1])),:]
+        file_lookup = self.get_metadata_lookup(metadata_lookup)["files"][file_idx]
 
-        filedf = fovdf.reset_index(inplace=False)
-        filedf = filedf.set_index(["File Index","Image Index"], drop=True, append=False, inplace=False)
-        filedf = filedf.sort_index()
-        working_filedf = filedf.loc[file_idx]
-
-        timepoint_indices = working_filedf["timepoints"].unique().tolist()
-        image_indices = working_filedf.index.get_level_values("Image Index").unique().tolist()
+        timepoint_indices = file_lookup["timepoints"]
+        image_indices = file_lookup["Image Index"]
 #         first_idx,last_idx = (timepoint_indices[0]-self.t_range[0],timepoint_indices[-1]-self.t_range[0])
         first_idx,last_idx = (timepoint_indices[0],timepoint_indices[-1])
-
+        image_slice = slice(image_indices[0],image_indices[-1]+1)
 
         y_drift = drift_orientation_and_initend_future[0][first_idx:last_idx+1]
         valid_orientations,valid_init_y_ends = drift_orientation_and_initend_future[1:]
 
         drift_corrected_edges = np.add.outer(y_drift,valid_init_y_ends)
+        return first_idx,last_idx,image_slice,drift_corrected_edges,valid_orientations
 
+    def crop_y_array(self,img_arr,drift_corrected_edges,valid_orientations,padding_y,trench_len_y):
+        """Crops the trench rows out of a single channel array of shape (t,y,x).
+
+        Args:
+            img_arr (array): Image array of shape (t,y,x).
+            drift_corrected_edges (array): Trench ends of shape (t,rows).
+            valid_orientations (list): Orientation of each row.
+            padding_y (int): Padding to be used when cropping in the y-dimension.
+            trench_len_y (int): Length from the end of the tenches to be used when cropping in the
+            y-dimension.
+
+        Returns:
+            tuple: A y-cropped array of shape (t,rows,y,x) and a (t,rows) nested list of the upper
+            y coordinate of each row.
+        """
+        orientations = np.array(valid_orientations)
+        y_len = padding_y+trench_len_y
+        upper = np.where(orientations==0,drift_corrected_edges-padding_y,drift_corrected_edges-trench_len_y)
+        if upper.size > 0 and upper.min() >= 0 and upper.max()+y_len <= img_arr.shape[1]:
+            ## all rows are in frame, so every crop is y_len tall and the whole file is one gather
+            ## from a (t,y_window,x,y_len) view of the input
+            windows = sliding_window_view(img_arr,y_len,axis=1).transpose(0,1,3,2)
+            cropped_in_y = windows[np.arange(img_arr.shape[0])[:,np.newaxis],upper] # t x row x y x x
+            return cropped_in_y,upper.tolist()
+
+        time_list = []
+        lane_y_coords_list = []
+        for t in range(img_arr.shape[0]):
+            trench_ends_y = drift_corrected_edges[t]
+            row_list = []
+            lane_y_coords = []
+            for r,orientation in enumerate(valid_orientations):
+                trench_end = trench_ends_y[r]
+                if orientation == 0:
+                    upper = max(trench_end-padding_y,0)
+                    lower = min(trench_end+trench_len_y,img_arr.shape[1])
+                else:
+                    upper = max(trench_end-trench_len_y,0)
+                    lower = min(trench_end+padding_y,img_arr.shape[1])
+                lane_y_coords.append(upper)
+                output_array = img_arr[t,upper:lower,:]
+                row_list.append(output_array)
+            time_list.append(row_list)
+            lane_y_coords_list.append(lane_y_coords)
+        cropped_in_y = np.array(time_list) # t x row x y x x
+        if len(cropped_in_y.shape) != 4:
+            print("Error in crop_y")
+            raise
+        return cropped_in_y,lane_y_coords_list
+
+    def crop_y(self,file_idx,drift_orientation_and_initend_future,padding_y,trench_len_y,channels=None,metadata_lookup=None):
+        """Performs cropping of the images in the y-dimension.
+
+        Args:
+            file_idx (int): File index.
+            drift_orientation_and_initend_future (tuple): Output of get_ends_and_orientations.
+            padding_y (int): Padding to be used when cropping in the y-dimension.
+            trench_len_y (int): Length from the end of the tenches to be used when cropping in the
+            y-dimension.
+            channels (list, optional): Channels to crop, defaults to all channels.
+            metadata_lookup (dict, optional): Output of get_metadata_lookup.
+        Returns:
+            tuple: A list of y-cropped arrays of shape (t,rows,y,x), one per channel, and the
+            upper y coordinate of each row.
+        """
+        if channels is None:
+            channels = self.all_channels
+        _,_,image_slice,drift_corrected_edges,valid_orientations = self.get_file_crop_params(file_idx,drift_orientation_and_initend_future,metadata_lookup=metadata_lookup)
 
         channel_arr_list = []
-        for c,channel in enumerate(self.all_channels):
-            with h5py.File(self.hdf5path+"/hdf5_"+str(file_idx)+".hdf5","r",rdcc_nbytes=self.metadata["chunk_cache_mem_size"]) as imported_hdf5_handle:
-            # with h5py_cache.File(self.hdf5path+"/hdf5_"+str(file_idx)+".hdf5","r",chunk_cache_mem_size=self.metadata["chunk_cache_mem_size"]) as imported_hdf5_handle:
-                img_arr = imported_hdf5_handle[channel][image_indices[0]:image_indices[-1]+1]
-            time_list = []
-            lane_y_coords_list = []
-            for t in range(img_arr.shape[0]):
-                trench_ends_y = drift_corrected_edges[t]
-                row_list = []
-                lane_y_coords = []
-                for r,orientation in enumerate(valid_orientations):
-                    trench_end = trench_ends_y[r]
-                    if orientation == 0:
-                        upper = max(trench_end-padding_y,0)
-                        lower = min(trench_end+trench_len_y,img_arr.shape[1])
-                    else:
-                        upper = max(trench_end-trench_len_y,0)
-                        lower = min(trench_end+padding_y,img_arr.shape[1])
-                    lane_y_coords.append(upper)
-                    output_array = img_arr[t,upper:lower,:]
-                    row_list.append(output_array)
-                time_list.append(row_list)
-                lane_y_coords_list.append(lane_y_coords)
-            cropped_in_y = np.array(time_list) # t x row x y x x
-            if len(cropped_in_y.shape) != 4:
-                print("Error in crop_y")
-                raise
-            else:
+        with open_array_file(self.hdf5path+"/hdf5_"+str(file_idx),"r",backend=self.array_backend,rdcc_nbytes=self.metadata["chunk_cache_mem_size"]) as imported_hdf5_handle:
+        # with h5py_cache.File(self.hdf5path+"/hdf5_"+str(file_idx)+".hdf5","r",chunk_cache_mem_size=self.metadata["chunk_cache_mem_size"]) as imported_hdf5_handle:
+            for c,channel in enumerate(channels):
+                img_arr = imported_hdf5_handle[channel][image_slice]
+                cropped_in_y,lane_y_coords_list = self.crop_y_array(img_arr,drift_corrected_edges,valid_orientations,padding_y,trench_len_y)
                 channel_arr_list.append(cropped_in_y)
         return channel_arr_list,lane_y_coords_list
 
-    def get_smoothed_x_percentiles(self,file_idx,drift_orientation_and_initend_future,padding_y,trench_len_y,x_percentile,background_kernel_x,smoothing_kernel_x):
+    def get_smoothed_x_percentiles(self,file_idx,drift_orientation_and_initend_future,padding_y,trench_len_y,x_percentile,background_kernel_x,smoothing_kernel_x,metadata_lookup=None):
         """Summary.
 
         Args:
@@ -711,7 +1022,8 @@ class kymograph_cluster:
         Returns:
             array: A smoothed and background subtracted percentile array of shape (rows,x,t)
         """
-        channel_arr_list,_ = self.crop_y(file_idx,drift_orientation_and_initend_future,padding_y,trench_len_y)
+        ## only the segmentation channel is needed to find midpoints
+        channel_arr_list,_ = self.crop_y(file_idx,drift_orientation_and_initend_future,padding_y,trench_len_y,channels=[self.seg_channel],metadata_lookup=metadata_lookup)
         cropped_in_y = channel_arr_list[0]
         if self.invert:
             cropped_in_y = sk.util.invert(cropped_in_y)
@@ -785,19 +1097,9 @@ class kymograph_cluster:
         """
         all_midpoints_list = []
         for row in range(x_percentiles_smoothed.shape[0]):
-            row_x_percentiles = x_percentiles_smoothed[row]
-            all_midpoints = []
-            midpoints = self.get_x_row_midpoints(row_x_percentiles[0],otsu_scaling,min_threshold)
-            if len(midpoints) == 0:
+            all_midpoints,_ = get_midpoints_over_time(x_percentiles_smoothed[row],otsu_scaling,min_threshold)
+            if all_midpoints is None:
                 return None
-            all_midpoints.append(midpoints)
-
-            for t in range(1,row_x_percentiles.shape[0]):
-                midpoints = self.get_x_row_midpoints(row_x_percentiles[t],otsu_scaling,min_threshold)
-                if len(midpoints)/(len(all_midpoints[-1])+1) < 0.5:
-                    all_midpoints.append(all_midpoints[-1])
-                else:
-                    all_midpoints.append(midpoints)
             all_midpoints_list.append(all_midpoints)
         return all_midpoints_list
 
@@ -823,18 +1125,7 @@ class kymograph_cluster:
             list: A nested list of the form [row_list,[time_list,[x_drift_int]]].
         """
         all_midpoints_list = self.compile_midpoint_futures(midpoint_futures)
-
-        x_drift_list = []
-        for all_midpoints in all_midpoints_list:
-            x_drift = []
-            for t in range(len(all_midpoints)-1):
-                diff_mat = np.subtract.outer(all_midpoints[t+1],all_midpoints[t])
-                min_dist_idx = np.argmin(abs(diff_mat),axis=0)
-                min_dists = diff_mat[min_dist_idx]
-                median_translation = int(np.median(min_dists))
-                x_drift.append(median_translation)
-            net_x_drift = np.append(np.array([0]),np.add.accumulate(x_drift))
-            x_drift_list.append(net_x_drift)
+        x_drift_list = [get_row_x_drift(all_midpoints) for all_midpoints in all_midpoints_list]
         return x_drift_list
 
     def get_median_x_drift(self,x_drift_futures):
@@ -939,37 +1230,31 @@ class kymograph_cluster:
 
         return in_bounds_list,x_coords_list,k_tot_list
 
-    def crop_with_bounds(self,output_kymograph,cropped_in_y_list,working_in_bounds,k_tot,row_num):
-        """Generates and writes kymographs of a single row from the already
-        y-cropped image data, using a pregenerated kymograph mask of shape
-        (y_dim,t_dim,x_dim).
+    def crop_with_bounds(self,output_kymograph,cropped_in_y,working_in_bounds,row_num,channel):
+        """Generates and writes kymographs of a single row and channel from the
+        already y-cropped image data, using the trench bounds of shape (2,t_dim,k_dim).
 
         Args:
-            cropped_in_y_handle (h5py.File): Hdf5 file handle corresponding to the y-cropped hdf5 dataset
-            "data" of shape (rows,channels,x,y,t).
-            k_mask_handle (h5py.File): Hdf5 file handle corresponding to the trench mask hdf5 dataset
-            "data" of shape (y_dim,t_dim,x_dim).
+            output_kymograph (h5py.File): Output file handle.
+            cropped_in_y (array): The y-cropped row of shape (t,y,x).
+            working_in_bounds (array): Trench x bounds of shape (2,t_dim,k_dim).
             row_num (int): The row number to crop kymographs from.
-            k_tot (int): Int specifying the total number of detected trenches in the fov.
+            channel (str): The channel being cropped.
         """
+        dataset_name = str(row_num) + "/" + str(channel)
+        x_len = working_in_bounds[1,0,0]-working_in_bounds[0,0,0]
 
-        for c,channel in enumerate(self.all_channels):
-            dataset_name = str(row_num) + "/" + str(channel)
-            cropped_in_y = cropped_in_y_list[c][:,row_num] # t,y,x
-            k_len,t_len,y_len,x_len = (working_in_bounds.shape[2],working_in_bounds.shape[1],cropped_in_y.shape[1],working_in_bounds[1,0,0]-working_in_bounds[0,0,0])
-
-            kymo_out = np.zeros((k_len,t_len,y_len,x_len),dtype="uint16")
-
-            for t in range(working_in_bounds.shape[1]):
-                for k in range(working_in_bounds.shape[2]):
-                    bounds = working_in_bounds[:,t,k]
-                    kymo_out[k,t] = cropped_in_y[t,:,bounds[0]:bounds[1]]
+        ## trenches have a fixed width, so kymo_out[k,t] = cropped_in_y[t,:,start[t,k]:start[t,k]+x_len]
+        ## is a single gather from a (t,x_window,y,x_len) view of the row
+        windows = sliding_window_view(cropped_in_y,x_len,axis=2).transpose(0,2,1,3)
+        x_starts = working_in_bounds[0].T # k x t
+        kymo_out = windows[np.arange(cropped_in_y.shape[0])[np.newaxis,:],x_starts].astype("uint16",copy=False) # k x t x y x x
 
 #             kymo_out = self.apply_kymo_mask(kymo_mask,cropped_in_y,k_tot) # k x t x y x x
 
-            hdf5_dataset = output_kymograph.create_dataset(dataset_name,data=kymo_out,chunks=self.output_chunk_shape, dtype='uint16')
+        hdf5_dataset = output_kymograph.create_dataset(dataset_name,data=kymo_out,chunks=self.output_chunk_shape, dtype='uint16')
 
-    def crop_x(self,file_idx,drift_orientation_and_initend_future,in_bounds_future,padding_y,trench_len_y):
+    def crop_x(self,file_idx,drift_orientation_and_initend_future,in_bounds_future,padding_y,trench_len_y,metadata_lookup=None):
         """Generates complete kymograph arrays for all trenches in the fov in
         every channel listed in 'self.all_channels'. Writes hdf5 files
         containing datasets of shape (trench_num,y_dim,x_dim,t_dim) for each
@@ -977,55 +1262,47 @@ class kymograph_cluster:
 
         ["[row_number]/[channel_name]"].
 
+        The source file is opened once and each channel is cropped in y and
+        then in x before the next channel is read, so only a single channel
+        is held in memory.
+
         Args:
-            cropped_in_y_handle (h5py.File): Hdf5 file handle corresponding to the y-cropped hdf5 dataset
-            "data" of shape (rows,channels,x,y,t).
-            all_midpoints_list (list): A nested list of the form [row_list,[time_list,[midpoint_array]]] containing
-            the trench midpoints.
-            x_drift_list (list): A nested list of the form [row_list,[time_list,[x_drift_int]]] containing the computed
-            drift in the x dimension.
-            trench_width_x (int): Width to be used when cropping in the x-dimension.
+            file_idx (int): File index.
+            drift_orientation_and_initend_future (tuple): Output of get_ends_and_orientations.
+            in_bounds_future (tuple): Output of get_all_in_bounds.
+            padding_y (int): Padding to be used when cropping in the y-dimension.
+            trench_len_y (int): Length from the end of the tenches to be used when cropping in the
+            y-dimension.
+            metadata_lookup (dict, optional): Output of get_metadata_lookup.
         """
-        fovdf = self.meta_handle.read_df("global",read_metadata=False)
-#         fovdf = fovdf.loc[(slice(None), slice(self.t_range[0],self.t_range[1])),:]
-        filedf = fovdf.reset_index(inplace=False)
-        filedf = filedf.set_index(["File Index","Image Index"], drop=True, append=False, inplace=False)
-        filedf = filedf.sort_index()
-        working_filedf = filedf.loc[file_idx]
-
-        timepoint_indices = working_filedf["timepoints"].unique().tolist()
-        image_indices = working_filedf.index.get_level_values("Image Index").unique().tolist()
-#         first_idx,last_idx = (timepoint_indices[0]-self.t_range[0],timepoint_indices[-1]-self.t_range[0])  #CHANGED
-        first_idx,last_idx = (timepoint_indices[0],timepoint_indices[-1])  #CHANGED
-
-
-        channel_arr_list,lane_y_coords_list = self.crop_y(file_idx,drift_orientation_and_initend_future,padding_y,trench_len_y)
-        num_rows = channel_arr_list[0].shape[1]
+        first_idx,last_idx,image_slice,drift_corrected_edges,valid_orientations = self.get_file_crop_params(file_idx,drift_orientation_and_initend_future,metadata_lookup=metadata_lookup)
+        num_rows = len(valid_orientations)
 
         in_bounds_list,x_coords_list,k_tot_list = in_bounds_future
 #         counting_arr = self.init_counting_arr(self.metadata["width"])
-        with h5py.File(self.kymographpath+"/kymograph_processed_"+str(file_idx)+".hdf5","w",rdcc_nbytes=self.output_chunk_cache_mem_size) as output_kymograph:
-        # with h5py_cache.File(self.kymographpath+"/kymograph_processed_"+str(file_idx)+".hdf5","w",chunk_cache_mem_size=self.output_chunk_cache_mem_size) as output_kymograph:
-            for row_num in range(num_rows):
-                in_bounds,k_tot = (in_bounds_list[row_num],k_tot_list[row_num])
-                working_in_bounds = in_bounds[:,first_idx:last_idx+1]
-#                 kymo_mask = self.get_trench_mask(in_bounds[:,first_idx:last_idx+1],counting_arr)
-                self.crop_with_bounds(output_kymograph,channel_arr_list,working_in_bounds,k_tot,row_num)
+        with open_array_file(self.hdf5path+"/hdf5_"+str(file_idx),"r",backend=self.array_backend,rdcc_nbytes=self.metadata["chunk_cache_mem_size"]) as imported_hdf5_handle:
+            with open_array_file(self.kymographpath+"/kymograph_processed_"+str(file_idx),"w",backend=self.array_backend,rdcc_nbytes=self.output_chunk_cache_mem_size) as output_kymograph:
+            # with h5py_cache.File(self.kymographpath+"/kymograph_processed_"+str(file_idx)+".hdf5","w",chunk_cache_mem_size=self.output_chunk_cache_mem_size) as output_kymograph:
+                for c,channel in enumerate(self.all_channels):
+                    img_arr = imported_hdf5_handle[channel][image_slice]
+                    cropped_in_y,lane_y_coords_list = self.crop_y_array(img_arr,drift_corrected_edges,valid_orientations,padding_y,trench_len_y)
+                    del img_arr
+                    for row_num in range(num_rows):
+                        working_in_bounds = in_bounds_list[row_num][:,first_idx:last_idx+1]
+#                         kymo_mask = self.get_trench_mask(in_bounds[:,first_idx:last_idx+1],counting_arr)
+                        self.crop_with_bounds(output_kymograph,cropped_in_y[:,row_num],working_in_bounds,row_num,channel)
 
         return lane_y_coords_list
 
-    def save_coords(self,fov_idx,x_crop_futures,in_bounds_future,drift_orientation_and_initend_future):
-        fovdf = self.meta_handle.read_df("global",read_metadata=False)
+    def save_coords(self,fov_idx,x_crop_futures,in_bounds_future,drift_orientation_and_initend_future,metadata_lookup=None):
 #         fovdf = fovdf.loc[(slice(None), slice(self.t_range[0],self.t_range[1])),:]
-        fovdf = fovdf.loc[fov_idx]
+        fov_lookup = self.get_metadata_lookup(metadata_lookup)["fovs"][fov_idx]
 
         x_coords_list = in_bounds_future[1]
         orientations = drift_orientation_and_initend_future[1]
 
         y_coords_list = []
-        for j,file_idx in enumerate(fovdf["File Index"].unique().tolist()):
-            working_filedf = fovdf[fovdf["File Index"]==file_idx]
-            img_indices = working_filedf["Image Index"].unique()
+        for j in range(len(pd.unique(fov_lookup["File Index"]))):
             y_coords_list += x_crop_futures[j] # t x row list
 
         pixel_microns = self.metadata['pixel_microns']
@@ -1036,12 +1313,12 @@ class kymograph_cluster:
         orit_dict = {0:"top",1:"bottom"}
         tpts = np.array(range(t_len))
 
-        missing_metadata = ('x' not in fovdf.columns)
+        missing_metadata = ('x' not in fov_lookup)
 
         if not missing_metadata:
-            global_x,global_y,ts,file_indices,img_indices = (fovdf["x"].values,fovdf["y"].values,fovdf["t"].values,fovdf["File Index"].values,fovdf["Image Index"].values)
+            global_x,global_y,ts,file_indices,img_indices = (fov_lookup["x"],fov_lookup["y"],fov_lookup["t"],fov_lookup["File Index"],fov_lookup["Image Index"])
         else:
-            file_indices,img_indices = (fovdf["File Index"].values,fovdf["Image Index"].values)
+            file_indices,img_indices = (fov_lookup["File Index"],fov_lookup["Image Index"])
 
         pd_output = []
 
@@ -1071,10 +1348,8 @@ class kymograph_cluster:
             df = pd.DataFrame(pd_output,columns=["fov","row","trench","timepoints","File Index","Image Index","lane orientation","y (local)","x (local)"])
             df = df.astype({"fov":int,"row":int,"trench":int,"timepoints":int,"File Index":int,"Image Index":int,"lane orientation":str,"y (local)":float,"x (local)":float,})
 
-        fov_indices = df.apply(lambda x: int(f'{x["fov"]:04n}{x["row"]:04n}{x["trench"]:04n}{x["timepoints"]:04n}'), axis=1)
-        temp_file_idx = df.apply(lambda x: int(f'{x["File Index"]:08n}{x["Image Index"]:04n}{x["timepoints"]:04n}'), axis=1)
-        df["FOV Parquet Index"] = [item for item in fov_indices]
-        df["Temp File Parquet Index"] = [item for item in temp_file_idx]
+        df["FOV Parquet Index"] = encode_index_columns(df,["fov","row","trench","timepoints"],fov_parquet_index_widths)
+        df["Temp File Parquet Index"] = encode_index_columns(df,["File Index","Image Index","timepoints"],temp_file_parquet_index_widths)
         df = df.set_index("FOV Parquet Index").sort_index()
         df = df.dropna()
 
@@ -1082,27 +1357,30 @@ class kymograph_cluster:
 
         return fov_idx
 
-    def get_filter_scores(self,channel,file_idx):
-        df = dd.read_parquet(self.kymographpath + "/metadata",calculate_divisions=True)
+    def get_filter_scores(self,channel,file_idx,working_filedf):
+        """Computes the focus score and mean intensity of every kymograph image in
+        a processed file.
 
+        Args:
+            channel (str): Channel to score.
+            file_idx (int): Processed file index.
+            working_filedf (pandas.DataFrame): Metadata slice of the file.
+
+        Returns:
+            pandas.DataFrame: working_filedf indexed by FOV Parquet Index, with the score columns added.
+        """
         working_rowdfs = []
+        working_filedf = working_filedf.set_index("FOV Parquet Index",drop=True).sort_index()
 
-        proc_file_path = self.kymographpath+"/kymograph_processed_"+str(file_idx)+".hdf5"
-        with h5py.File(proc_file_path,"r") as infile:
-            start_index = int(f'{file_idx:08n}' + '00000000')
-            end_index = int(f'{file_idx:08n}' + '99999999')
-            working_filedf = df.loc[start_index:end_index].compute()
-            del df
-            working_filedf = working_filedf.set_index("FOV Parquet Index",drop=True).sort_index()
-#             df[df["File Index"]==file_idx]
+        proc_file_path = self.kymographpath+"/kymograph_processed_"+str(file_idx)
+        with open_array_file(proc_file_path,"r",backend=self.array_backend) as infile:
             row_list = working_filedf["row"].unique().tolist()
             for row in row_list:
-                working_rowdf = working_filedf[working_filedf["row"]==row]
+                working_rowdf = working_filedf[working_filedf["row"]==row].copy()
                 kymo_arr = infile[str(row) + "/" + channel][:]
                 original_shape = kymo_arr.shape
                 kymo_arr = kymo_arr.reshape(-1,original_shape[2],original_shape[3])
-                focus_scores = [get_focus_score(kymo_arr[i]) for i in range(kymo_arr.shape[0])]
-                intensity_scores = [np.mean(kymo_arr[i]) for i in range(kymo_arr.shape[0])]
+                focus_scores,intensity_scores = get_focus_scores(kymo_arr)
 
                 working_rowdf[channel + " Focus Score"] = focus_scores
                 working_rowdf[channel + " Mean Intensity"] = intensity_scores
@@ -1115,25 +1393,17 @@ class kymograph_cluster:
     def get_all_filter_scores(self,channel):
         df = dd.read_parquet(self.kymographpath + "/metadata",calculate_divisions=True)
         file_list = df["File Index"].unique().compute().tolist()
-        del df
 
         delayed_list = []
 
         for file_idx in file_list:
-            df_delayed = delayed(self.get_filter_scores)(channel,file_idx)
+            start_index,end_index = index_bounds([file_idx],temp_file_parquet_index_widths)
+            df_delayed = delayed(self.get_filter_scores)(channel,file_idx,df.loc[start_index:end_index])
             delayed_list.append(df_delayed.persist())
+        del df
 
         ## filtering out non-failed dataframes ##
-        all_delayed_futures = []
-        for item in delayed_list:
-            all_delayed_futures+=futures_of(item)
-        while any(future.status == 'pending' for future in all_delayed_futures):
-            sleep(0.1)
-
-        good_delayed = []
-        for item in delayed_list:
-            if all([future.status == 'finished' for future in futures_of(item)]):
-                good_delayed.append(item)
+        good_delayed,_ = wait_for_completion(delayed_list,label="Filter Scores")
 
         ## compiling output dataframe ##
         df_out = dd.from_delayed(good_delayed).persist()
@@ -1143,17 +1413,65 @@ class kymograph_cluster:
         writedir(self.kymographpath + "/metadata",overwrite=True)
         dd.to_parquet(df_out, self.kymographpath + "/metadata",engine='fastparquet',compression='gzip',write_metadata_file=True)
 
-    def generate_kymographs(self,dask_controller,first_fov_only=False,delta_global_rows=25):
-        writedir(self.kymographpath,overwrite=True)
-        writedir(self.kymographpath+ "/temp_output",overwrite=True)
+    def load_kymograph_progress(self):
+        """Returns the fovs finished by a previous, interrupted run of
+        generate_kymographs and the median drifts it used, if its parameters
+        match the current ones.
+        """
+        progress_path = self.kymographpath + "/progress.pkl"
+        if not os.path.exists(progress_path):
+            return [],{}
+        with open(progress_path, 'rb') as infile:
+            progress = pickle.load(infile)
+        if repr(progress["kymograph_params"]) != repr(self.kymograph_params):
+            print("Kymograph parameters have changed, regenerating all fovs.")
+            return [],{}
+        return progress["finished_fovs"],progress["median_drifts"]
+
+    def save_kymograph_progress(self,finished_fovs,median_drifts):
+        progress = {"kymograph_params":self.kymograph_params,"finished_fovs":finished_fovs,"median_drifts":median_drifts}
+        with open(self.kymographpath + "/progress.pkl", 'wb') as outfile:
+            pickle.dump(progress, outfile)
+
+    def generate_kymographs(self,dask_controller,first_fov_only=False,delta_global_rows=25,overwrite=False):
+        """Generates kymographs for every fov. Each fov's outputs are checkpointed
+        as it finishes, so a run interrupted by a crash or walltime limit
+        resumes with only the unfinished fovs when called again.
+
+        Args:
+            dask_controller (dask_controller): Controller with a running client.
+            first_fov_only (bool): Only process the first fov.
+            delta_global_rows (int): Tolerance used when assigning global rows.
+            overwrite (bool): Discard the outputs of a previous interrupted run.
+        """
+        if overwrite:
+            finished_fovs,median_drifts = ([],{})
+        else:
+            finished_fovs,median_drifts = self.load_kymograph_progress()
+
+        if len(finished_fovs) == 0 and len(median_drifts) == 0:
+            writedir(self.kymographpath,overwrite=True)
+            writedir(self.kymographpath+ "/temp_output",overwrite=True)
+        else:
+            print("Resuming kymograph generation, " + str(len(finished_fovs)) + " fovs already finished.")
+            ## outputs of an interrupted compilation step
+            for metadata_dir in ["/metadata","/metadata_2","/metadata_3"]:
+                if os.path.exists(self.kymographpath + metadata_dir):
+                    shutil.rmtree(self.kymographpath + metadata_dir)
+        self.save_kymograph_progress(finished_fovs,median_drifts)
 
         dask_controller.futures = {}
 
         fovdf = self.meta_handle.read_df("global",read_metadata=True)
         self.metadata = fovdf.metadata
+
+        ## per-file and per-fov metadata, broadcast once instead of re-read by every task
+        metadata_lookup = get_metadata_lookup(fovdf,alternate_over_rows=self.alternate_over_rows)
+        metadata_lookup_future = dask_controller.daskclient.scatter([metadata_lookup],broadcast=True)[0]
         if first_fov_only:
             first_fov_val = fovdf.index.get_level_values(0)[0]
             fovdf = fovdf.loc[first_fov_val:first_fov_val]
+        fovdf = fovdf[~fovdf.index.get_level_values("fov").isin(finished_fovs)]
 #         fovdf = fovdf.loc[(slice(None), slice(self.t_range[0],self.t_range[1])),:]
 
         filedf = fovdf.reset_index(inplace=False)
@@ -1189,16 +1507,21 @@ class kymograph_cluster:
             edges_futures = [dask_controller.futures["Y Trench Edges: " + str(file_idx)] for file_idx in working_files]
             future = dask_controller.daskclient.submit(self.get_ends_and_orientations,fov_idx,edges_futures,self.expected_num_rows,self.alternate_orientation,\
                                                        self.top_orientation,self.alternate_over_rows,self.consensus_orientations,self.consensus_midpoints,\
-                                                       self.y_min_edge_dist,self.midpoint_dist_tolerence,self.padding_y,self.trench_len_y,retries=1)
+                                                       self.y_min_edge_dist,self.midpoint_dist_tolerence,self.padding_y,self.trench_len_y,\
+                                                       metadata_lookup=metadata_lookup_future,retries=1)
 
             dask_controller.futures["Y Trench Drift, Orientations and Initial Trench Ends: " + str(fov_idx)] = future
 
         ### optionally get median drift ###
         if self.use_median_drift:
-            drift_orientation_and_initend_futures = [dask_controller.futures["Y Trench Drift, Orientations and Initial Trench Ends: " + str(fov_idx)] for fov_idx in fov_list]
-            drift_orientation_and_initend_futures = dask_controller.daskclient.gather(drift_orientation_and_initend_futures,errors="skip")
-            future = dask_controller.daskclient.submit(self.get_median_y_drift,drift_orientation_and_initend_futures,retries=1)
-            dask_controller.futures["Y Median Drift"] = future
+            ## a resumed run reuses the median of the original run, which covered every fov
+            if "Y Median Drift" not in median_drifts:
+                drift_orientation_and_initend_futures = [dask_controller.futures["Y Trench Drift, Orientations and Initial Trench Ends: " + str(fov_idx)] for fov_idx in fov_list]
+                drift_orientation_and_initend_futures = dask_controller.daskclient.gather(drift_orientation_and_initend_futures,errors="skip")
+                future = dask_controller.daskclient.submit(self.get_median_y_drift,drift_orientation_and_initend_futures,retries=1)
+                median_drifts["Y Median Drift"] = future.result()
+                self.save_kymograph_progress(finished_fovs,median_drifts)
+            dask_controller.futures["Y Median Drift"] = median_drifts["Y Median Drift"]
             for k,fov_idx in enumerate(fov_list):
                 new_y_drift = dask_controller.futures["Y Median Drift"]
                 drift_orientation_and_initend_future = dask_controller.futures["Y Trench Drift, Orientations and Initial Trench Ends: " + str(fov_idx)]
@@ -1216,7 +1539,7 @@ class kymograph_cluster:
                 drift_orientation_and_initend_future = dask_controller.futures["Y Trench Drift, Orientations and Initial Trench Ends: " + str(fov_idx)]
             future = dask_controller.daskclient.submit(self.get_smoothed_x_percentiles,file_idx,drift_orientation_and_initend_future,\
                                                        self.padding_y,self.trench_len_y,self.x_percentile,self.background_kernel_x,\
-                                                       self.smoothing_kernel_x,retries=1)
+                                                       self.smoothing_kernel_x,metadata_lookup=metadata_lookup_future,retries=1)
             dask_controller.futures["Smoothed X Percentiles: " + str(file_idx)] = future
 
         ### get x midpoints ###
@@ -1239,10 +1562,13 @@ class kymograph_cluster:
         ### optionally get median drift ###
 
         if self.use_median_drift:
-            x_drift_futures = [dask_controller.futures["X Drift: " + str(fov_idx)] for fov_idx in fov_list]
-            x_drift_futures = dask_controller.daskclient.gather(x_drift_futures,errors="skip")
-            future = dask_controller.daskclient.submit(self.get_median_x_drift,x_drift_futures,retries=1)
-            dask_controller.futures["X Median Drift"] = future
+            if "X Median Drift" not in median_drifts:
+                x_drift_futures = [dask_controller.futures["X Drift: " + str(fov_idx)] for fov_idx in fov_list]
+                x_drift_futures = dask_controller.daskclient.gather(x_drift_futures,errors="skip")
+                future = dask_controller.daskclient.submit(self.get_median_x_drift,x_drift_futures,retries=1)
+                median_drifts["X Median Drift"] = future.result()
+                self.save_kymograph_progress(finished_fovs,median_drifts)
+            dask_controller.futures["X Median Drift"] = median_drifts["X Median Drift"]
             for k,fov_idx in enumerate(fov_list):
                 new_x_drift = dask_controller.futures["X Median Drift"]
                 x_drift_future = dask_controller.futures["X Drift: " + str(fov_idx)]
@@ -1275,7 +1601,8 @@ class kymograph_cluster:
                 drift_orientation_and_initend_future = dask_controller.futures["Y Trench Drift, Orientations and Initial Trench Ends: " + str(fov_idx)]
             in_bounds_future = dask_controller.futures["X In Bounds: " + str(fov_idx)]
 
-            future = dask_controller.daskclient.submit(self.crop_x,file_idx,drift_orientation_and_initend_future,in_bounds_future,self.padding_y,self.trench_len_y,retries=0)
+            future = dask_controller.daskclient.submit(self.crop_x,file_idx,drift_orientation_and_initend_future,in_bounds_future,self.padding_y,self.trench_len_y,\
+                                                       metadata_lookup=metadata_lookup_future,retries=0)
             dask_controller.futures["X Crop: " + str(file_idx)] = future
 
         ### get coords ###
@@ -1290,18 +1617,16 @@ class kymograph_cluster:
             else:
                 drift_orientation_and_initend_future = dask_controller.futures["Y Trench Drift, Orientations and Initial Trench Ends: " + str(fov_idx)]
 
-            df_fov_idx_future = dask_controller.daskclient.submit(self.save_coords,fov_idx,x_crop_futures,in_bounds_future,drift_orientation_and_initend_future,retries=0)
+            df_fov_idx_future = dask_controller.daskclient.submit(self.save_coords,fov_idx,x_crop_futures,in_bounds_future,drift_orientation_and_initend_future,\
+                                                                  metadata_lookup=metadata_lookup_future,retries=0)
             df_fov_idx_futures.append(df_fov_idx_future)
 
-        while any(future.status == 'pending' for future in df_fov_idx_futures):
-            sleep(0.1)
+        for _,future,succeeded in iter_completed(df_fov_idx_futures,label="Kymographs"):
+            if succeeded:
+                finished_fovs = finished_fovs + [future.result()]
+                self.save_kymograph_progress(finished_fovs,median_drifts)
 
-        good_futures = []
-        for future in df_fov_idx_futures:
-            if future.status == 'finished':
-                good_futures.append(future.result())
-
-        temp_output_file_list = [self.kymographpath + "/temp_output/temp_output_" + str(fov_idx) + ".hdf" for fov_idx in sorted(good_futures)]
+        temp_output_file_list = [self.kymographpath + "/temp_output/temp_output_" + str(fov_idx) + ".hdf" for fov_idx in sorted(finished_fovs)]
         df_out = dd.read_hdf(temp_output_file_list,"data",mode="r",sorted_index=True)
 
         ## compiling output dataframe ##
@@ -1313,7 +1638,7 @@ class kymograph_cluster:
         dd.to_parquet(df_out, self.kymographpath + "/metadata",engine='pyarrow',compression='gzip',write_metadata_file=True,overwrite=True)
 
         dask_controller.daskclient.cancel(df_out)
-        dask_controller.daskclient.cancel(good_futures)
+        dask_controller.daskclient.cancel(df_fov_idx_futures)
 
         if self.filter_channel != None:
             self.get_all_filter_scores(self.filter_channel)
@@ -1352,13 +1677,15 @@ class kymograph_cluster:
 
         with open(self.kymographpath + "/metadata.pkl", 'wb') as handle:
             pickle.dump(kymograph_metadata, handle)
+        ## finished, later stages consume the per-fov outputs so the next call starts fresh
+        os.remove(self.kymographpath + "/progress.pkl")
 
         dask_controller.daskclient.cancel([val for key,val in dask_controller.futures.items()])
         dask_controller.daskclient.run(trim_memory)
 
     def add_trenchids(self,df):
 
-        trench_preindex = df.apply(lambda x: int(f'{x["fov"]:04n}{x["row"]:04n}{x["trench"]:04n}'), axis=1)
+        trench_preindex = encode_index_columns(df,["fov","row","trench"],fov_parquet_index_widths[:3])
         df["key"] = trench_preindex.persist()
 
         trenchids = df.set_index("key",sorted=True).groupby("key").size().reset_index().drop(0,axis=1).reset_index().compute()
@@ -1395,91 +1722,97 @@ class kymograph_cluster:
         out_df = out_df.drop(labels="trenchid filter", axis=1)
         return out_df
 
-    def reindex_trenches(self,df):
-
-        num_timepoints = len(df["timepoints"].unique())
-        fov_row_idx = df.apply(lambda x: int(f'{x["fov"]:04n}{x["row"]:04n}'), axis=1)
-        df["fov-row Index"] = fov_row_idx.persist()
-        wait(df);
-
-        ### NEW ##
-
-        new_trenches = df.set_index("fov-row Index",sorted=True)["trench"].persist()
-        wait(new_trenches);
-        new_trenches = new_trenches.groupby("fov-row Index").apply(lambda x: list(np.repeat(list(range(0,len(x.unique()))),repeats=num_timepoints))).persist()
-        wait(new_trenches);
-
-#         new_trenches = df.set_index("fov-row Index",sorted=True).groupby("fov-row Index").apply(lambda x: np.repeat(list(range(0,len(x["trench"].unique()))),repeats=num_timepoints))
-#         wait(new_trenches);
-        new_trenches = new_trenches.compute().sort_index()
-        new_trenches = new_trenches.apply(eval)
-        new_trenches = [element for list_ in new_trenches for element in list_]
-        new_trenches = pd.DataFrame(new_trenches)
-        df = df.drop(["trenchid","trench","fov-row Index"],axis=1)
-        new_trenches.index = df.index
-
-        new_trenches_dask_df = dd.from_pandas(new_trenches,npartitions=df.npartitions).persist()
-        wait(new_trenches_dask_df);
-        new_trenches_dask_df = new_trenches_dask_df.repartition(divisions=df.divisions)
-        # new_trenches_dask_df = new_trenches_dask_df.repartition(divisions=df.divisions,force=True)
-        new_trenches_dask_df = new_trenches_dask_df.persist()
-        wait(new_trenches_dask_df);
-        df["trench"] = new_trenches_dask_df[0]
-
-        cols = df.columns.tolist()
-        reordered_columns = cols[:2] + cols[-1:] + cols[2:-1]
-        df = df[reordered_columns]
-
-        ## NEW CODE ##
-        fov_idx = df.apply(lambda x: int(f'{x["fov"]:04n}{x["row"]:04n}{x["trench"]:04n}{x["timepoints"]:04n}'), axis=1)
-        df["FOV Parquet Index"] = fov_idx.persist()
-        wait(df);
-
-        df = df.set_index("FOV Parquet Index")
-        return df
+    def get_reorg_plan(self,trench_df,file_df):
+        """Maps each trench in a block to its position in the reorganized
+        kymograph file. Trenches of the same fov and row with consecutive
+        trench indices are merged into runs, so they can be copied with a
+        single slice.
 
-    def reorg_kymograph(self,k,trenchids):
-#         df = dd.read_parquet(self.kymographpath + "/metadata/")
-#         trenchid_list = df["trenchid"].unique().compute().tolist()
-#         trenchiddf = df.set_index("trenchid")
-        working_trenchdf = dd.read_parquet(self.kymographpath + "/trenchiddf",calculate_divisions=True).loc[trenchids].compute(scheduler='threads')
-        output_file_path = self.kymographpath+"/kymograph_"+str(k)+".hdf5"
+        Args:
+            trench_df (pandas.DataFrame): Block of get_trench_lookup, in output order.
+            file_df (pandas.DataFrame): First timepoint of each processed file, with columns
+            fov, File Index and timepoints.
+
+        Returns:
+            tuple: (file_order,run_df) where file_order lists, per fov, the files in time order
+            and run_df has one row per run with columns fov, row, trench (first trench), k (first
+            output index) and length.
+        """
+        trench_table = trench_df[["fov","row","trench"]].reset_index(drop=True)
+        trench_table["k"] = np.arange(len(trench_table))
+
+        ## a new run starts whenever fov or row change or the trench index is not consecutive
+        fov_row_change = (trench_table["fov"].diff() != 0)|(trench_table["row"].diff() != 0)
+        new_run = (fov_row_change|(trench_table["trench"].diff() != 1)).to_numpy(copy=True)
+        new_run[0] = True
+        run_id = np.cumsum(new_run)-1
+        run_df = trench_table.groupby(run_id).agg(fov=("fov","first"),row=("row","first"),trench=("trench","first"),\
+                                                  k=("k","first"),length=("k","size"))
+
+        file_times = file_df[file_df["fov"].isin(run_df["fov"].unique())].sort_values(["fov","timepoints"])
+        file_order = {fov:fov_df["File Index"].tolist() for fov,fov_df in file_times.groupby("fov",sort=False)}
+        return file_order,run_df
+
+    def reorg_kymograph(self,k,trench_df,file_df,buffer_bytes=2**26):
+        """Writes the kymographs of a block of trenches, across all of their
+        files and channels, to kymograph_[k]. Output datasets are allocated up
+        front and filled with slice reads of contiguous trench runs, opening
+        each processed file once, so peak memory is bounded by buffer_bytes
+        rather than by the size of the block.
 
-        with h5py.File(output_file_path,"w") as outfile:
+        Args:
+            k (int): Output file index.
+            trench_df (pandas.DataFrame): Block of get_trench_lookup written to this file, in output order.
+            file_df (pandas.DataFrame): First timepoint of each processed file, with columns
+            fov, File Index and timepoints.
+            buffer_bytes (int): Maximum size of a single copied slab.
+        """
+        file_order,run_df = self.get_reorg_plan(trench_df,file_df)
+        output_file_path = self.kymographpath+"/kymograph_"+str(k)
+
+        ## time offset of each file within its fov
+        first_run = run_df.iloc[0]
+        file_tpts = {}
+        for fov,file_list in file_order.items():
+            fov_row = run_df[run_df["fov"]==fov]["row"].iloc[0]
+            for file_idx in file_list:
+                proc_file_path = self.kymographpath+"/kymograph_processed_"+str(file_idx)
+                with open_array_file(proc_file_path,"r",backend=self.array_backend) as infile:
+                    dataset_shape = infile[str(fov_row) + "/" + self.all_channels[0]].shape
+                file_tpts[file_idx] = dataset_shape[1]
+        y_dim,x_dim = dataset_shape[2:]
+        file_offsets = {}
+        for fov,file_list in file_order.items():
+            file_offsets.update(dict(zip(file_list,np.cumsum([0]+[file_tpts[file_idx] for file_idx in file_list[:-1]]))))
+        num_tpts = sum(file_tpts[file_idx] for file_idx in file_order[first_run["fov"]])
+        ## files are full length except the last of each fov, so chunking time by the longest file
+        ## keeps every file offset on a chunk boundary and only the last file writes a partial chunk
+        t_chunk = int(min(max(file_tpts.values()),num_tpts))
+
+        with open_array_file(output_file_path,"w",backend=self.array_backend) as outfile:
             for channel in self.all_channels:
-                fov_list = working_trenchdf["fov"].unique().tolist()
-                trench_arr_fovs = []
-                for fov in fov_list:
-                    working_fovdf = working_trenchdf[working_trenchdf["fov"]==fov]
-                    file_list = working_fovdf["File Index"].unique().tolist()
-
-                    trench_arr_files = []
-                    for file_idx in file_list:
-                        proc_file_path = self.kymographpath+"/kymograph_processed_"+str(file_idx)+".hdf5"
-                        with h5py.File(proc_file_path,"r") as infile:
-                            working_filedf = working_fovdf[working_fovdf["File Index"]==file_idx]
-                            row_list = working_filedf["row"].unique().tolist()
-
-                            trench_arr_rows = []
-                            for row in row_list:
-                                working_rowdf = working_filedf[working_filedf["row"]==row]
-#                                 trenches = working_rowdf["trench"].unique().tolist()
-#                                 first_trench_idx,last_trench_idx = (trenches[0],trenches[-1])
-#                                 kymo_arr = infile[str(row) + "/" + channel][first_trench_idx:(last_trench_idx+1)]
-                                trenches = working_rowdf["trench"].unique().tolist()
-                                kymo_arr = infile[str(row) + "/" + channel][trenches]
-                                trench_arr_rows.append(kymo_arr)
-                        trench_arr_rows = np.concatenate(trench_arr_rows,axis=0) # k x t x y x x
-                        trench_arr_files.append(trench_arr_rows)
-                    trench_arr_files = np.concatenate(trench_arr_files,axis=1) # k x t x y x x
-                    trench_arr_fovs.append(trench_arr_files)
-                trench_arr_fovs = np.concatenate(trench_arr_fovs,axis=0) # k x t x y x x
-                hdf5_dataset = outfile.create_dataset(str(channel), data=trench_arr_fovs, dtype="uint16")
+                outfile.create_dataset(str(channel),shape=(len(trench_df),num_tpts,y_dim,x_dim),chunks=(1,t_chunk,y_dim,x_dim),dtype="uint16")
+
+            for fov,file_list in file_order.items():
+                fov_run_df = run_df[run_df["fov"]==fov]
+                for file_idx in file_list:
+                    t_start,t_len = (file_offsets[file_idx],file_tpts[file_idx])
+                    trenches_per_slab = max(buffer_bytes//(2*t_len*y_dim*x_dim),1)
+                    proc_file_path = self.kymographpath+"/kymograph_processed_"+str(file_idx)
+                    with open_array_file(proc_file_path,"r",backend=self.array_backend) as infile:
+                        for channel in self.all_channels:
+                            output_dataset = outfile[str(channel)]
+                            for _,run in fov_run_df.iterrows():
+                                input_dataset = infile[str(run["row"]) + "/" + channel]
+                                for offset in range(0,run["length"],trenches_per_slab):
+                                    slab_len = min(trenches_per_slab,run["length"]-offset)
+                                    trench_start,k_start = (run["trench"]+offset,run["k"]+offset)
+                                    output_dataset[k_start:k_start+slab_len,t_start:t_start+t_len] = input_dataset[trench_start:trench_start+slab_len]
 
     def cleanup_kymographs(self,reorg_futures,file_list):
         for file_idx in file_list:
-            proc_file_path = self.kymographpath+"/kymograph_processed_"+str(file_idx)+".hdf5"
-            os.remove(proc_file_path)
+            proc_file_path = self.kymographpath+"/kymograph_processed_"+str(file_idx)
+            remove_array_file(proc_file_path,backend=self.array_backend)
         return 1
 
     def post_process(self,dask_controller,trench_timepoints_per_file=25000,paramfile=True,focus_thr=0,intensity_thr=0,perc_above_thr=0,filter_channel=None):
@@ -1501,101 +1834,42 @@ class kymograph_cluster:
         if filter_channel != None: #revisit next time this is necessary, because outputdf no longer in memory
             outputdf = self.filter_trenchids(filter_channel,outputdf,focus_threshold=focus_thr,intensity_threshold=intensity_thr,perc_above=perc_above_thr)
 
-        if os.path.exists(self.kymographpath + "/global_rows.pkl"):
+        renumber_rows = os.path.exists(self.kymographpath + "/global_rows.pkl")
+        if renumber_rows:
             print("Eliminating selected rows...")
             with open(self.kymographpath + "/global_rows.pkl", 'rb') as handle:
                 rows_to_keep = pkl.load(handle)
-            outputdf = outputdf[outputdf["Global Row"].apply(lambda x: x in rows_to_keep, meta=('Global Row',bool))]
-
-            fov_to_rows_series = outputdf.groupby("fov")["row"].apply(lambda x: sorted(list(set(x)))).compute().sort_index()
-            fov_to_rows_series = fov_to_rows_series.apply(eval)
-            
-            fov_to_rows_map = fov_to_rows_series.apply(lambda x: {old_row:new_row for new_row,old_row in enumerate(sorted(x))}).to_frame().reset_index()
-            fov_to_rows_map = fov_to_rows_map.apply(lambda x: {(x["fov"],key):val for key,val in x["row"].items()}, axis=1).tolist()
-            fov_to_rows_map = {k: v for d in fov_to_rows_map for k, v in d.items()}
-
-            outputdf["new row"] = outputdf.apply(lambda x: int(fov_to_rows_map[(x["fov"],x["row"])]), axis=1, meta=("new row", int))
-            outputdf = outputdf.reset_index(drop=True)
-            outputdf["FOV Parquet Index"] = outputdf.apply(lambda x: int(f'{x["fov"]:04n}{x["new row"]:04n}{x["trench"]:04n}{x["timepoints"]:04n}'), axis=1, meta=("FOV Parquet Index", int))
-            outputdf = outputdf.set_index("FOV Parquet Index",sorted=True)
-
-            dd.to_parquet(outputdf, self.kymographpath + "/metadata_2",engine='pyarrow',compression='gzip',write_metadata_file=True,schema="infer")
-            dask_controller.daskclient.cancel(outputdf)
-            shutil.rmtree(self.kymographpath + "/metadata")
-            os.rename(self.kymographpath + "/metadata_2", self.kymographpath + "/metadata")
-            sleep(self.o2_file_rename_latency)
-
-            outputdf = dd.read_parquet(self.kymographpath + "/metadata",calculate_divisions=True)
+            outputdf = outputdf[outputdf["Global Row"].isin(list(rows_to_keep))]
 
-        trenchid_list = outputdf["trenchid"].unique().compute().tolist()
-        file_list = outputdf["File Index"].unique().compute().tolist()
+        ## small per-trench and per-file tables, reduced without shuffling the metadata
+        trench_df = outputdf.groupby("trenchid")[["fov","row","trench"]].first().compute()
+        file_df = outputdf.groupby(["fov","File Index"])["timepoints"].min().compute().reset_index()
+        file_list = file_df["File Index"].unique().tolist()
+        num_tpts = outputdf["timepoints"].nunique().compute()
 
-        trenchiddf = outputdf.set_index("trenchid",sorted=False).persist()
-        wait(trenchiddf);
-        outputdf = outputdf.drop(columns = ["File Index","Image Index"]).persist()
-        wait(outputdf);
-
-#         writedir(self.kymographpath + "/metadata",overwrite=True)
-
-        num_tpts = len(trenchiddf["timepoints"].unique().compute().tolist())
         trenches_per_file = trench_timepoints_per_file//num_tpts
-        chunk_size = trenches_per_file*num_tpts
 
         print("Number of timepoints per trench: " + str(num_tpts))
         print("Number of trenches per file: " + str(trenches_per_file))
 
-        if len(trenchid_list)%trenches_per_file == 0:
-            num_files = (len(trenchid_list)//trenches_per_file)
-        else:
-            num_files = (len(trenchid_list)//trenches_per_file) + 1
-
-        file_indices = np.repeat(np.array(range(num_files)),chunk_size)[:len(outputdf)]
-        file_trenchid = np.repeat(np.array(range(trenches_per_file)),num_tpts)
-        file_trenchid = np.repeat(file_trenchid[:,np.newaxis],num_files,axis=1).T.flatten()[:len(outputdf)]
-        file_indices = pd.DataFrame(file_indices)
-        file_trenchid = pd.DataFrame(file_trenchid)
-        file_indices.index = outputdf.index
-        file_trenchid.index = outputdf.index
-
-        #test code
-        file_indices_dask_df = dd.from_pandas(file_indices,npartitions=outputdf.npartitions).persist()
-        wait(file_indices_dask_df);
-        file_indices_dask_df = file_indices_dask_df.repartition(divisions=outputdf.divisions)
-        # file_indices_dask_df = file_indices_dask_df.repartition(divisions=outputdf.divisions,force=True)
-        file_indices_dask_df = file_indices_dask_df.persist()
-        wait(file_indices_dask_df);
-        outputdf["File Index"] = file_indices_dask_df[0]
-        #test code
-        file_trenchid_dask_df = dd.from_pandas(file_trenchid,npartitions=outputdf.npartitions).persist()
-        wait(file_trenchid_dask_df);
-        file_trenchid_dask_df = file_trenchid_dask_df.repartition(divisions=outputdf.divisions)
-        # file_trenchid_dask_df = file_trenchid_dask_df.repartition(divisions=outputdf.divisions,force=True)
-        file_trenchid_dask_df = file_trenchid_dask_df.persist()
-        wait(file_trenchid_dask_df);
-        outputdf["File Trench Index"] = file_trenchid_dask_df[0]
-        outputdf = outputdf.persist()
-        wait(outputdf);
-
-##         outputdf = add_list_to_column(outputdf,file_indices[0].tolist(),"File Index").persist()
-##         wait(outputdf);
-#         outputdf = add_list_to_column(outputdf,file_trenchid[0].tolist(),"File Trench Index").persist()
-#         wait(outputdf);
-
-        parq_file_idx = outputdf.apply(lambda x: int(f'{int(x["File Index"]):08n}{int(x["File Trench Index"]):04n}{int(x["timepoints"]):04n}'), axis=1, meta=int)
-        outputdf["File Parquet Index"] = parq_file_idx.persist()
-        outputdf = outputdf.astype({"File Index":int,"File Trench Index":int,"File Parquet Index":int}).persist()
-        wait(outputdf);
-
-        dd.to_parquet(trenchiddf, self.kymographpath + "/trenchiddf",engine='fastparquet',compression='gzip',write_metadata_file=True)
-        del trenchiddf
+        trench_lookup = get_trench_lookup(trench_df,trenches_per_file,renumber_rows=renumber_rows)
+        num_files = int(np.ceil(len(trench_lookup)/trenches_per_file))
+
+        ## output file indices, rows, trenches and trenchids are assigned per partition; the
+        ## new FOV Parquet Index preserves the order of the old one, so partitions stay sorted
+        meta = apply_trench_lookup(outputdf._meta,trench_lookup)
+        outputdf = outputdf.map_partitions(apply_trench_lookup,trench_lookup,meta=meta,align_dataframes=False).clear_divisions()
+        dd.to_parquet(outputdf, self.kymographpath + "/metadata_2",engine='pyarrow',compression='gzip',write_metadata_file=True,schema="infer")
+        dask_controller.daskclient.cancel(outputdf)
 
         random_priorities = np.random.uniform(size=(num_files,))
         for k in range(0,num_files):
             priority = random_priorities[k]
 
-            trenchids = trenchid_list[k*trenches_per_file:(k+1)*trenches_per_file]
+            block_trench_df = trench_lookup.iloc[k*trenches_per_file:(k+1)*trenches_per_file]
+            block_file_df = file_df[file_df["fov"].isin(block_trench_df["fov"].unique())]
 
-            future = dask_controller.daskclient.submit(self.reorg_kymograph,k,trenchids,retries=1,priority=priority)
+            future = dask_controller.daskclient.submit(self.reorg_kymograph,k,block_trench_df,block_file_df,retries=1,priority=priority)
             dask_controller.futures["Kymograph Reorganized: " + str(k)] = future
 
         reorg_futures = [dask_controller.futures["Kymograph Reorganized: " + str(k)] for k in range(num_files)]
@@ -1603,35 +1877,9 @@ class kymograph_cluster:
         dask_controller.futures["Kymographs Cleaned Up"] = future
         dask_controller.daskclient.gather([future])
 
-        if os.path.exists(self.kymographpath + "/global_rows.pkl"):
-            outputdf = outputdf.drop("row",axis=1)
-            outputdf = outputdf.rename(columns={"new row":"row"})
-
-        #checkpoint
-        dd.to_parquet(outputdf, self.kymographpath + "/metadata_2",engine='pyarrow',compression='gzip',write_metadata_file=True,schema="infer")
-        dask_controller.daskclient.cancel(outputdf)
         shutil.rmtree(self.kymographpath + "/metadata")
         os.rename(self.kymographpath + "/metadata_2", self.kymographpath + "/metadata")
         sleep(self.o2_file_rename_latency)
-        outputdf = dd.read_parquet(self.kymographpath + "/metadata",calculate_divisions=True)
-
-        ## everything after this is slow
-
-        outputdf = self.reindex_trenches(outputdf).persist()
-        wait(outputdf);
-        outputdf = self.add_trenchids(outputdf).persist()
-        wait(outputdf);
-
-        ### NEW INDEX
-        outputdf["Trenchid Timepoint Index"] = outputdf.apply(lambda x: int(f'{x["trenchid"]:08n}{x["timepoints"]:04n}'), axis=1, meta=int)
-        outputdf["Trenchid Timepoint Index"] = outputdf["Trenchid Timepoint Index"].astype(int)
-        ### END
-        outputdf = outputdf.drop(labels=["FOV Parquet Index"],axis=1)
-        dd.to_parquet(outputdf, self.kymographpath + "/metadata_2",engine='pyarrow',compression='gzip',write_metadata_file=True,schema="infer")
-        dask_controller.daskclient.cancel(outputdf)
-        shutil.rmtree(self.kymographpath + "/metadata")
-        os.rename(self.kymographpath + "/metadata_2", self.kymographpath + "/metadata")
-        shutil.rmtree(self.kymographpath + "/trenchiddf")
 
     def kymo_report(self):
         df = dd.read_parquet(self.kymographpath + "/metadata/",calculate_divisions=True).persist()
@@ -1677,6 +1925,7 @@ class kymograph_multifov(multifov):
         self.meta_handle = pandas_hdf5_handler(self.metapath)
         self.metadf = self.meta_handle.read_df("global",read_metadata=True)
         self.metadata = self.metadf.metadata
+        self.array_backend = self.metadata.get("array_backend","hdf5")
 
     def import_hdf5(self,i):
         """Performs initial import of the hdf5 file to be processed. Converts
@@ -1702,7 +1951,7 @@ class kymograph_multifov(multifov):
             for j,file_idx in enumerate(file_indices):
                 filedf = fovdf[fovdf["File Index"]==file_idx]
                 img_indices = filedf["Image Index"].unique().tolist()
-                with h5py.File(self.headpath + "/hdf5/hdf5_" + str(file_idx) + ".hdf5", "r") as infile:
+                with open_array_file(self.headpath + "/hdf5/hdf5_" + str(file_idx), "r", backend=self.array_backend) as infile:
                     file_list += [infile[channel][idx][:,:,np.newaxis] for idx in img_indices]
             channel_list.append(np.concatenate(file_list,axis=2))
         channel_array = np.array(channel_list)
@@ -1765,7 +2014,7 @@ class kymograph_multifov(multifov):
             array: A smoothed percentile array of shape (y,t)
         """
         imported_array = imported_array_list[i]
-        y_percentiles = np.percentile(imported_array[0],y_percentile,axis=1,interpolation='lower')
+        y_percentiles = get_row_percentiles(np.moveaxis(imported_array[0],1,-1),y_percentile)
         y_percentiles_smoothed = self.median_filter_2d(y_percentiles,smoothing_kernel_y)
         # Normalize (scale by range and subtract minimum) to make scaling of thresholds make more sense
         min_qth_percentile = y_percentiles_smoothed.min(axis=0)
@@ -1942,7 +2191,7 @@ class kymograph_multifov(multifov):
             init_timepoint_fovdf = fovdf.loc[0:0,:].iloc[0]
             file_idx = int(init_timepoint_fovdf["File Index"])
             img_idx = int(init_timepoint_fovdf["Image Index"])
-            with h5py.File(self.headpath + "/hdf5/hdf5_" + str(file_idx) + ".hdf5", "r") as infile:
+            with open_array_file(self.headpath + "/hdf5/hdf5_" + str(file_idx), "r", backend=self.array_backend) as infile:
                 img_arr.append(infile[self.seg_channel][img_idx][:,:,np.newaxis])
 
         img_arr = np.concatenate(img_arr,axis=2)
@@ -2242,18 +2491,9 @@ class kymograph_multifov(multifov):
         x_percentiles_smoothed_row = x_percentiles_smoothed_list[i]
         midpoints_row_list = []
         for j in range(x_percentiles_smoothed_row.shape[0]):
-            x_percentiles_smoothed = x_percentiles_smoothed_row[j]
-            all_midpoints = []
-            midpoints,_ = self.get_midpoints(x_percentiles_smoothed[:,0],otsu_scaling,min_threshold)
-            if len(midpoints) == 0:
+            all_midpoints,_ = get_midpoints_over_time(x_percentiles_smoothed_row[j].T,otsu_scaling,min_threshold)
+            if all_midpoints is None:
                 return None
-            all_midpoints.append(midpoints)
-            for t in range(1,x_percentiles_smoothed.shape[1]):
-                midpoints,_ = self.get_midpoints(x_percentiles_smoothed[:,t],otsu_scaling,min_threshold)
-                if len(midpoints)/(len(all_midpoints[-1])+1) < 0.5:
-                    all_midpoints.append(all_midpoints[-1])
-                else:
-                    all_midpoints.append(midpoints)
             midpoints_row_list.append(all_midpoints)
         return midpoints_row_list
 
@@ -2270,17 +2510,7 @@ class kymograph_multifov(multifov):
             list: A nested list of the form [row_list,[time_list,[x_drift_int]]].
         """
         midpoints_row_list = all_midpoints_list[i]
-        x_drift_row_list = []
-        for all_midpoints in midpoints_row_list:
-            x_drift = []
-            for t in range(len(all_midpoints)-1):
-                diff_mat = np.subtract.outer(all_midpoints[t+1],all_midpoints[t])
-                min_dist_idx = np.argmin(abs(diff_mat),axis=0)
-                min_dists = diff_mat[min_dist_idx]
-                median_translation = int(np.median(min_dists))
-                x_drift.append(median_translation)
-            net_x_drift = np.append(np.array([0]),np.add.accumulate(x_drift))
-            x_drift_row_list.append(net_x_drift)
+        x_drift_row_list = [get_row_x_drift(all_midpoints) for all_midpoints in midpoints_row_list]
 
         return x_drift_row_list
 
@@ -2489,7 +2719,7 @@ class kymograph_multifov(multifov):
 class tiff_sequence_kymograph():
     """Class for getting kymographs from tiff stack (see classes in
     ndextract.py for details on how this works)"""
-    def __init__(self, headpath, tiffpath, all_channels, filename_format_string, trenches_per_file=5, upside_down=False, time_interval=60, manual_metadata_params={}):
+    def __init__(self, headpath, tiffpath, all_channels, filename_format_string, trenches_per_file=5, upside_down=False, time_interval=60, manual_metadata_params={}, array_backend="hdf5"):
         self.headpath = headpath
         self.kymographpath = self.headpath + "/kymograph"
         self.hdf5path = self.headpath + "/hdf5"
@@ -2502,6 +2732,7 @@ class tiff_sequence_kymograph():
         self.upside_down = upside_down
         self.manual_metadata_params = manual_metadata_params
         self.time_interval = time_interval
+        self.array_backend = array_backend ##"hdf5" or "zarr", recorded in the metadata for downstream stages
 
     def assignidx(self, metadf):
         outdf = copy.deepcopy(metadf)
@@ -2525,6 +2756,7 @@ class tiff_sequence_kymograph():
         exp_metadata["num_frames"] = first_img.shape[0]
         exp_metadata["height"] = first_img.shape[1]
         exp_metadata["width"] = first_img.shape[2]
+        exp_metadata["array_backend"] = self.array_backend
 
         self.output_chunk_shape = (1,1,first_img.shape[1],first_img.shape[2])
         self.output_chunk_bytes = (2*np.multiply.accumulate(np.array(self.output_chunk_shape))[-1])
@@ -2629,12 +2861,12 @@ class tiff_sequence_kymograph():
 
             file_idx, row, channels, trench_indices, filepaths = fidx_channels_paths
             datasets = {}
-            with h5py.File(self.kymographpath + "/kymograph_" + str(file_idx) + ".hdf5","w",rdcc_nbytes=self.chunk_cache_mem_size) as h5pyfile:
+            with open_array_file(self.kymographpath + "/kymograph_" + str(file_idx),"w",backend=self.array_backend,rdcc_nbytes=self.chunk_cache_mem_size) as h5pyfile:
             # with h5py_cache.File(self.kymographpath + "/kymograph_" + str(file_idx) + ".hdf5","w",chunk_cache_mem_size=self.chunk_cache_mem_size) as h5pyfile:
 
                 for i,channel in enumerate(self.all_channels):
                     hdf5_dataset = h5pyfile.create_dataset(str(channel),\
-                    (len(filepaths)/num_channels,time,y_dim,x_dim), chunks=self.output_chunk_shape, dtype='uint16')
+                    (len(filepaths)//num_channels,time,y_dim,x_dim), chunks=self.output_chunk_shape, dtype='uint16')
                     datasets[str(row) + "/" + channel] = hdf5_dataset
                 for i in range(len(filepaths)):
                     curr_channel = channels[i]
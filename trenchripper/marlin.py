@@ -1,6 +1,7 @@
 # fmt: off
 import itertools
 import json
+import io
 import h5py
 import os
 import copy
@@ -20,9 +21,17 @@ import sklearn.mixture
 
 from matplotlib import pyplot as plt
 from .utils import pandas_hdf5_handler, writedir
-from .ndextract import get_registration_shifts,register_image_stack,apply_flatfield
+from .ndextract import register_fov_files,apply_flatfield_stack,get_file_index,group_channel_paths
 from parse import compile
+from concurrent.futures import ThreadPoolExecutor
 
+def read_marlin_image(file_path, out):
+    # h5py serializes calls behind a global lock, so the file is read as raw bytes
+    # (which overlaps across threads) and only parsed by h5py from memory
+    with open(file_path, "rb") as infile:
+        file_bytes = io.BytesIO(infile.read())
+    with h5py.File(file_bytes, "r") as infile:
+        infile["data"].read_direct(out)
 
 ####
 
@@ -35,11 +44,15 @@ class marlin_extractor:
         headpath,
         register_images=False,
         reg_channel=None,
+        reg_downsample=1,
+        reg_roi=None,
         pixel_microns=0.2125, ##hack assuming ti5 20x
         tpts_per_file=100,
         parsestr="fov={fov:d}_config={channel}_t={timepoints:d}.hdf5",
         metaparsestr="metadata_t={timepoint:d}.hdf5",
         zero_base_keys=["timepoints"],
+        rescan=False,
+        io_threads=8,
     ):  # note this chunk size has a large role in downstream steps...make sure is less than 1 MB
         """Utility to import hdf5 format files from MARLIN Runs.
 
@@ -50,6 +63,8 @@ class marlin_extractor:
             hdf5path (str): where to store hdf5 data
             tpts_per_file (int): number of timepoints to put in each hdf5 file
             parsestr (str): format of filenames from which to extract metadata (using parse library)
+            rescan (bool): rescan hdf5inputpath instead of using the saved file index
+            io_threads (int): number of threads each extraction task uses to read source files
         """
         self.hdf5inputpath = hdf5inputpath
         self.headpath = headpath
@@ -60,8 +75,12 @@ class marlin_extractor:
         self.parsestr = parsestr
         self.metaparsestr = metaparsestr
         self.zero_base_keys = zero_base_keys
+        self.rescan = rescan
+        self.io_threads = io_threads
         self.register_images = register_images
         self.reg_channel = reg_channel
+        self.reg_downsample = reg_downsample
+        self.reg_roi = reg_roi
 
         self.pixel_microns = pixel_microns
 
@@ -78,31 +97,12 @@ class marlin_extractor:
         metaparsestr="metadata_t={timepoint:d}.hdf5",
         zero_base_keys=["timepoints"],
     ):
-        parser = compile(parsestr)
-        parse_keys = [
-            item.split("}")[0].split(":")[0] for item in parsestr.split("{")[1:]
-        ] + ["image_paths"]
-
         exp_metadata = {}
-        fov_metadata = {key: [] for key in parse_keys}
-
-        self.hdf5_files = []
-        self.metadata_files = []
-        for root, _, files in os.walk(hdf5inputpath):
-            self.hdf5_files.extend(
-                [
-                    os.path.join(root, f)
-                    for f in files
-                    if "config" in os.path.splitext(f)[0]
-                ]
-            )
-            self.metadata_files.extend(
-                [
-                    os.path.join(root, f)
-                    for f in files
-                    if "metadata" in os.path.splitext(f)[0]
-                ]
-            )
+        index_path = self.headpath + "/file_index.pkl"
+        fov_metadata = get_file_index(hdf5inputpath, parsestr, index_path, file_filter="config", rescan=self.rescan)
+        meta_file_index = get_file_index(hdf5inputpath, metaparsestr, index_path, file_filter="metadata")
+        self.hdf5_files = fov_metadata["image_paths"].tolist()
+        self.metadata_files = meta_file_index["image_paths"].tolist()
 
         with h5py.File(self.hdf5_files[0], "r") as infile:
             hdf5_shape = infile["data"].shape
@@ -110,57 +110,23 @@ class marlin_extractor:
         exp_metadata["width"] = hdf5_shape[1]
         #     exp_metadata['pixel_microns'] = tags['65326']
 
-        for f in self.hdf5_files:
-            match = parser.search(f)
-            # ignore any files that don't match the regex
-            if match is not None:
-                # Add to dictionary
-                fov_frame_dict = match.named
-                for key, value in fov_frame_dict.items():
-                    fov_metadata[key].append(value)
-                fov_metadata["image_paths"].append(f)
-
         for zero_base_key in zero_base_keys:
-            if 0 not in fov_metadata[zero_base_key]:
-                fov_metadata[zero_base_key] = [
-                    item - 1 for item in fov_metadata[zero_base_key]
-                ]
+            if 0 not in fov_metadata[zero_base_key].values:
+                fov_metadata[zero_base_key] = fov_metadata[zero_base_key] - 1
 
-        channels = list(set(fov_metadata["channel"]))
+        channels = fov_metadata["channel"].unique().tolist()
         exp_metadata["channels"] = channels
-        exp_metadata["num_fovs"] = len(set(fov_metadata["fov"]))
-        exp_metadata["frames"] = list(set(fov_metadata["timepoints"]))
+        exp_metadata["num_fovs"] = fov_metadata["fov"].nunique()
+        exp_metadata["frames"] = sorted(fov_metadata["timepoints"].unique().tolist())
         exp_metadata["num_frames"] = len(exp_metadata["frames"])
         exp_metadata["pixel_microns"] = self.pixel_microns
-        fov_metadata = pd.DataFrame(fov_metadata)
-        fov_metadata = fov_metadata.set_index(["fov", "timepoints"]).sort_index()
-
-        output_fov_metadata = []
-        step = len(channels)
-        for i in range(0, len(fov_metadata), step):
-            rows = fov_metadata[i : i + step]
-            channel_path_entry = dict(zip(rows["channel"], rows["image_paths"]))
-            fov_entry = rows.index.get_level_values("fov").unique()[0]
-            timepoint_entry = rows.index.get_level_values("timepoints").unique()[0]
-            fov_metadata_entry = {
-                "fov": fov_entry,
-                "timepoints": timepoint_entry,
-                "channel_paths": channel_path_entry,
-            }
-            output_fov_metadata.append(fov_metadata_entry)
-        fov_metadata = pd.DataFrame(output_fov_metadata).set_index(
-            ["fov", "timepoints"]
-        ).sort_index()
-
-        metaparser = compile(metaparsestr)
+        fov_metadata = group_channel_paths(fov_metadata)
+
         meta_df_out = []
-        for metadata_file in self.metadata_files:
-            match = metaparser.search(metadata_file)
-            if match is not None:
-                timepoint = match.named["timepoint"]
-                meta_df = pd.read_hdf(metadata_file)
-                meta_df["timepoints"] = timepoint
-                meta_df_out.append(meta_df)
+        for timepoint, metadata_file in zip(meta_file_index["timepoint"], self.metadata_files):
+            meta_df = pd.read_hdf(metadata_file)
+            meta_df["timepoints"] = timepoint
+            meta_df_out.append(meta_df)
         meta_df_out = pd.concat(meta_df_out)
         if 0 not in meta_df_out["timepoints"].unique().tolist():
             meta_df_out["timepoints"] = meta_df_out["timepoints"] - 1
@@ -304,7 +270,13 @@ class marlin_extractor:
         metadf = metadf.reset_index(inplace=False)
         metadf = metadf.set_index(["File Index", "Image Index"], drop=True, append=False, inplace=False).sort_index()
 
-        def writehdf5(fovnum, num_entries, timepoint_list, file_idx):
+        def writehdf5(file_idx, channel_path_list):
+            """Writes one output file. channel_path_list holds the channel_paths entry of
+            each image in the file, in Image Index order, so the task does not need to
+            re-read the global metadata. Source files are read on a thread pool into two
+            alternating buffers, so the next channel is read while the current one is
+            written.
+            """
 
             #### open flatfield images
             flatfield_img_dict = {}
@@ -312,40 +284,31 @@ class marlin_extractor:
                 if path != "":
                     flatfield_img_dict[channel] = tifffile.imread(path)
 
-            metadf = self.meta_handle.read_df("global", read_metadata=True)
-            metadf = metadf.reset_index(inplace=False)
-            metadf = metadf.set_index(["File Index", "Image Index"], drop=True, append=False, inplace=False).sort_index()
-
             y_dim = self.metadata["height"]
             x_dim = self.metadata["width"]
-            filedf = metadf.loc[file_idx].reset_index(inplace=False)
-            filedf = filedf.set_index(["timepoints"], drop=True, append=False, inplace=False)
-            filedf = filedf.sort_index()
-
-            with h5py.File(self.hdf5path + "/hdf5_" + str(file_idx) + ".hdf5","w",rdcc_nbytes=self.chunk_cache_mem_size) as h5pyfile:
-            # with h5py_cache.File(self.hdf5path + "/hdf5_" + str(file_idx) + ".hdf5","w",chunk_cache_mem_size=self.chunk_cache_mem_size) as h5pyfile:
-                for i, channel in enumerate(self.metadata["channels"]):
-                    hdf5_dataset = h5pyfile.create_dataset(str(channel),(num_entries, y_dim, x_dim),chunks=self.chunk_shape,dtype="uint16")
-
-                    if self.channel_to_flat_dict[channel] != '': ##flatfielding channels
-                        for j in range(len(timepoint_list)):
-                            frame = timepoint_list[j]
-                            entry = filedf.loc[frame]["channel_paths"]
-                            file_path = entry[channel]
-                            with h5py.File(file_path, "r") as infile:
-                            # with h5py_cache.File(file_path, "r") as infile:
-                                img = infile["data"][:]
-                            img = apply_flatfield(img,flatfield_img_dict[channel],flatfield_img_dict["Dark_Image"])
-                            hdf5_dataset[j, :, :] = img
-                    else:
-                        for j in range(len(timepoint_list)):
-                            frame = timepoint_list[j]
-                            entry = filedf.loc[frame]["channel_paths"]
-                            file_path = entry[channel]
-                            with h5py.File(file_path, "r") as infile:
-                            # with h5py_cache.File(file_path, "r") as infile:
-                                img = infile["data"][:]
-                            hdf5_dataset[j, :, :] = img
+            num_entries = len(channel_path_list)
+            channels = self.metadata["channels"]
+            img_buffers = [np.empty((num_entries, y_dim, x_dim), dtype="uint16") for _ in range(min(2, len(channels)))]
+
+            def prefetch(i):
+                img_stack = img_buffers[i % len(img_buffers)]
+                return [executor.submit(read_marlin_image, entry[channels[i]], img_stack[j]) for j, entry in enumerate(channel_path_list)]
+
+            with ThreadPoolExecutor(max_workers=self.io_threads) as executor:
+                with h5py.File(self.hdf5path + "/hdf5_" + str(file_idx) + ".hdf5","w",rdcc_nbytes=self.chunk_cache_mem_size) as h5pyfile:
+                # with h5py_cache.File(self.hdf5path + "/hdf5_" + str(file_idx) + ".hdf5","w",chunk_cache_mem_size=self.chunk_cache_mem_size) as h5pyfile:
+                    read_futures = prefetch(0)
+                    for i, channel in enumerate(channels):
+                        hdf5_dataset = h5pyfile.create_dataset(str(channel),(num_entries, y_dim, x_dim),chunks=self.chunk_shape,dtype="uint16")
+                        for future in read_futures:
+                            future.result()
+                        if i + 1 < len(channels):
+                            read_futures = prefetch(i + 1)
+
+                        img_stack = img_buffers[i % len(img_buffers)]
+                        if self.channel_to_flat_dict[channel] != '': ##flatfielding channels
+                            apply_flatfield_stack(img_stack,flatfield_img_dict[channel],flatfield_img_dict["Dark_Image"],out=img_stack)
+                        hdf5_dataset[:] = img_stack
             return "Done."
 
         file_list = metadf.index.get_level_values("File Index").unique().values
@@ -356,16 +319,12 @@ class marlin_extractor:
             priority = random_priorities[k]
             filedf = metadf.loc[file_idx]
 
-            fovnum = filedf[0:1]["fov"].values[0]
-            num_entries = len(filedf.index.get_level_values("Image Index").values)
-            timepoint_list = filedf["timepoints"].tolist()
+            channel_path_list = filedf["channel_paths"].tolist()
 
             future = dask_controller.daskclient.submit(
                 writehdf5,
-                fovnum,
-                num_entries,
-                timepoint_list,
                 file_idx,
+                channel_path_list,
                 retries=retries,
                 priority=priority,
             )
@@ -405,8 +364,7 @@ class marlin_extractor:
 
         self.meta_handle.write_df("global", outdf, metadata=self.metadata)
 
-        ###optional registration
-        ###not optimized for memory, can be reworked fairly easily, but only if it becomes necessary
+        ###optional registration, streamed one file at a time
 
         if self.register_images:
 
@@ -415,36 +373,8 @@ class marlin_extractor:
             self.metadata = self.metadf.metadata
 
             def registerhdf5(file_idx_list,reg_channel):
-                reg_stack = []
-                for file_idx in file_idx_list:
-                    with h5py.File(self.hdf5path + "/hdf5_" + str(file_idx) + ".hdf5", "r") as infile:
-                        channels = list(infile.keys())
-                        reg_stack.append(infile[reg_channel][:])
-                reg_stack = np.concatenate(reg_stack)
-
-                cumulative_shift_coords = get_registration_shifts(reg_stack)
-                del reg_stack
-
-                y_dim = self.metadata['height']
-                x_dim = self.metadata['width']
-
-                with h5py.File(self.tempregpath + "/hdf5_" + str(file_idx) + ".hdf5", "w") as outfile:
-
-                    for channel in channels:
-                        img_stack = []
-                        for file_idx in file_idx_list:
-                            with h5py.File(self.hdf5path + "/hdf5_" + str(file_idx) + ".hdf5", "r") as infile:
-                                img_stack.append(infile[channel][:])
-                        stack_borders = np.add.accumulate([0] + [item.shape[0] for item in img_stack])
-                        img_stack = np.concatenate(img_stack)
-                        img_stack = register_image_stack(img_stack,cumulative_shift_coords)
-                        for idx,file_idx in enumerate(file_idx_list):
-                            stack_i = stack_borders[idx]
-                            stack_f = stack_borders[idx+1]
-                            stack_len = stack_f-stack_i
-
-                            hdf5_dataset = outfile.create_dataset(str(channel),(stack_len,y_dim,x_dim), chunks=self.chunk_shape, dtype='uint16')
-                            hdf5_dataset[:] = img_stack[stack_i:stack_f]
+                register_fov_files(self.hdf5path,self.tempregpath,file_idx_list,reg_channel,self.chunk_shape,\
+                                   downsample=self.reg_downsample,roi=self.reg_roi)
 
             fov_file_idx_list = self.metadf.reset_index().groupby("fov").apply(lambda x: sorted(list(x["File Index"].unique()))).tolist()
             num_jobs = len(fov_file_idx_list)
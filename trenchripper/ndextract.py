@@ -6,26 +6,103 @@ import copy
 # import h5py_cache #not using this anymore
 import tifffile
 import pickle as pkl
+import time
+from contextlib import ExitStack
+import re
 import numpy as np
 import pandas as pd
+import scipy as sp
+import scipy.fft
 import ipywidgets as ipyw
 import skimage as sk
 
+try:
+    import hdf5plugin ##optional, provides Blosc/zstd filters
+except ImportError:
+    hdf5plugin = None
+
 from nd2reader import ND2Reader
+from nd2reader.common import read_chunk
 from .utils import pandas_hdf5_handler,writedir
+from .arraystore import open_array_file,array_file_path,iter_t_slabs
 from parse import compile
-
-def get_registration_shifts(img_stack):
-    shift_coords = [[0.,0.]]
-    for i in range(1,img_stack.shape[0]):
-        shift = sk.registration.phase_cross_correlation(img_stack[i-1],img_stack[i],return_error=False,normalization=None)
-        shift_coords.append(shift)
-    shift_coords = np.array(shift_coords)
+from concurrent.futures import ThreadPoolExecutor
+
+def get_pairwise_shifts(img_stack,prev_img=None,batch_size=25,downsample=1,roi=None):
+    """Batched phase correlation between adjacent frames, equivalent to calling
+    sk.registration.phase_cross_correlation(img_stack[i-1],img_stack[i],normalization=None)
+    for every pair. The FFT of each frame is computed once and reused for both of its
+    pairs, and the cross-power spectra are evaluated over batch_size frames at a time.
+
+    Args:
+        img_stack (numpy.ndarray): (t,y,x) image stack.
+        prev_img (numpy.ndarray, optional): Frame preceding img_stack[0]. If given, the
+            first shift is measured against it, otherwise the first shift is zero.
+        batch_size (int): Number of frames transformed at once.
+        downsample (int): Integer block-mean downsampling applied before correlating.
+        roi (tuple, optional): (y_start,y_end,x_start,x_end) region used for correlation.
+
+    Returns:
+        numpy.ndarray: (t,2) shifts of each frame relative to the frame before it, in
+        full resolution pixels.
+    """
+    if roi is not None:
+        img_stack = img_stack[:,roi[0]:roi[1],roi[2]:roi[3]]
+        prev_img = None if prev_img is None else prev_img[roi[0]:roi[1],roi[2]:roi[3]]
+    corr_shape = np.array(img_stack.shape[1:])//downsample
+
+    def transform_frames(frames):
+        frames = frames.astype(np.float32)
+        if downsample > 1:
+            frames = frames[:,:corr_shape[0]*downsample,:corr_shape[1]*downsample]
+            frames = frames.reshape(-1,corr_shape[0],downsample,corr_shape[1],downsample).mean(axis=(2,4))
+        return sp.fft.rfft2(frames,axes=(1,2))
+
+    shift_coords = np.zeros((img_stack.shape[0],2))
+    if prev_img is None:
+        last_fft,start = transform_frames(img_stack[:1]),1
+    else:
+        last_fft,start = transform_frames(prev_img[np.newaxis]),0
+
+    for batch_start in range(start,img_stack.shape[0],batch_size):
+        batch_fft = transform_frames(img_stack[batch_start:batch_start+batch_size])
+        ref_fft = np.concatenate([last_fft,batch_fft[:-1]])
+        cross_corr = np.abs(sp.fft.irfft2(ref_fft*np.conj(batch_fft),s=tuple(corr_shape),axes=(1,2)))
+        maxima = np.array(np.unravel_index(np.argmax(cross_corr.reshape(cross_corr.shape[0],-1),axis=1),tuple(corr_shape))).T
+        maxima = np.where(maxima > corr_shape//2,maxima-corr_shape,maxima)
+        shift_coords[batch_start:batch_start+batch_fft.shape[0]] = maxima*downsample
+        last_fft = batch_fft[-1:]
+    return shift_coords
+
+def get_registration_shifts(img_stack,prev_img=None,batch_size=25,downsample=1,roi=None):
+    shift_coords = get_pairwise_shifts(img_stack,prev_img=prev_img,batch_size=batch_size,downsample=downsample,roi=roi)
     cumulative_shift_coords = np.add.accumulate(shift_coords,axis=0)
     return cumulative_shift_coords
 
-def register_image_stack(img_stack,cumulative_shift_coords): #performs a basic image registration on a given image stack, should include all timepoints
-    pad_val = np.median(img_stack)
+def shift_image(img,shift,pad_val,out=None):
+    """Integer translation of a single image by slicing, equivalent to warping
+    with an integer translation and constant padding.
+    """
+    if out is None:
+        out = np.empty(img.shape,dtype=img.dtype)
+    out[:] = pad_val
+    dy,dx = int(shift[0]),int(shift[1])
+    y_dim,x_dim = img.shape
+    src_y,dst_y = slice(max(0,-dy),min(y_dim,y_dim-dy)),slice(max(0,dy),min(y_dim,y_dim+dy))
+    src_x,dst_x = slice(max(0,-dx),min(x_dim,x_dim-dx)),slice(max(0,dx),min(x_dim,x_dim+dx))
+    if (src_y.stop > src_y.start) and (src_x.stop > src_x.start):
+        out[dst_y,dst_x] = img[src_y,src_x]
+    return out
+
+def register_image_stack(img_stack,cumulative_shift_coords,pad_val=None): #performs a basic image registration on a given image stack, should include all timepoints
+    if pad_val is None:
+        pad_val = np.median(img_stack)
+
+    if np.all(np.mod(cumulative_shift_coords,1.) == 0.): ##integer shifts (the default for phase correlation) only need slicing
+        registered_stack = np.empty(img_stack.shape,dtype=img_stack.dtype)
+        for i in range(0,img_stack.shape[0]):
+            shift_image(img_stack[i],cumulative_shift_coords[i],pad_val,out=registered_stack[i])
+        return registered_stack
 
     registered = []
     for i in range(0,img_stack.shape[0]):
@@ -36,6 +113,158 @@ def register_image_stack(img_stack,cumulative_shift_coords): #performs a basic i
     registered_stack = np.array(registered)
     return registered_stack
 
+def get_hdf5_compression(compression=None):
+    """Returns h5py create_dataset keyword arguments for a lossless compression setting.
+
+    Args:
+        compression (str, optional): One of None, "lzf", "gzip", "blosc" (lz4) or "zstd".
+            Blosc based settings use bitshuffle and require hdf5plugin, falling back to
+            lzf if it is not installed.
+
+    Returns:
+        dict: Keyword arguments for create_dataset.
+    """
+    if compression is None:
+        return {}
+    elif compression == "lzf":
+        return {"compression":"lzf","shuffle":True}
+    elif compression == "gzip":
+        return {"compression":"gzip","compression_opts":4,"shuffle":True}
+    elif compression in ["blosc","zstd"]:
+        if hdf5plugin is None:
+            print("hdf5plugin not installed, using lzf compression.")
+            return get_hdf5_compression("lzf")
+        cname = "lz4" if compression == "blosc" else "zstd"
+        return dict(hdf5plugin.Blosc(cname=cname,clevel=5,shuffle=hdf5plugin.Blosc.BITSHUFFLE))
+    else:
+        raise ValueError("Unknown compression " + str(compression))
+
+def choose_chunk_shape(y_dim,x_dim,tpts_per_file,target_chunk_bytes=4*(2**20),min_t_chunk=8):
+    """Chooses an hdf5 chunk shape for extracted (t,y,x) uint16 datasets. Downstream
+    readers (kymograph_cluster.get_smoothed_y_percentiles and crop_y) read full frames
+    over a range of timepoints, so chunks stack as many timepoints as fit in
+    target_chunk_bytes, and at least min(min_t_chunk,tpts_per_file). Frames too large
+    for that are tiled in y, keeping whole rows.
+
+    Args:
+        y_dim (int): Image height.
+        x_dim (int): Image width.
+        tpts_per_file (int): Timepoints per extracted file.
+        target_chunk_bytes (int): Approximate chunk size.
+        min_t_chunk (int): Minimum number of timepoints per chunk.
+
+    Returns:
+        tuple: (t,y,x) chunk shape.
+    """
+    frame_bytes = 2*y_dim*x_dim
+    t_chunk = int(np.clip(target_chunk_bytes//frame_bytes,min(min_t_chunk,tpts_per_file),tpts_per_file))
+    y_chunk = int(np.clip(target_chunk_bytes//(2*x_dim*t_chunk),1,y_dim))
+    return (t_chunk,y_chunk,x_dim)
+
+def clip_chunk_shape(chunk_shape,data_shape):
+    return tuple(int(min(chunk_dim,data_dim)) for chunk_dim,data_dim in zip(chunk_shape,data_shape))
+
+def benchmark_hdf5_settings(hdf5_file,channel,outputpath,settings=[(None,None),("lzf",None),("zstd",None),(None,"auto"),("lzf","auto"),("zstd","auto")],t_chunk=25,repeats=3):
+    """Rewrites one extracted hdf5 file under several compression and chunking settings
+    and times the reads done by the kymograph stage, with the same file handles and
+    slicing: the t_chunk slabs of kymograph_cluster.get_smoothed_y_percentiles
+    (iter_t_slabs) and the single image slice of crop_y.
+
+    Args:
+        hdf5_file (str): Path to an extracted hdf5_*.hdf5 file.
+        channel (str): Channel to benchmark.
+        outputpath (str): Scratch directory for the rewritten files.
+        settings (list): (compression,chunk_shape) pairs, where chunk_shape is None for
+            single frame chunks, "auto" for choose_chunk_shape, or an explicit tuple.
+        t_chunk (int): t_chunk of get_smoothed_y_percentiles.
+        repeats (int): Number of timed reads per setting, the fastest is kept.
+
+    Returns:
+        pandas.DataFrame: File size, compression ratio, write time and read throughput per setting.
+    """
+    writedir(outputpath,overwrite=True)
+    with h5py.File(hdf5_file,"r") as infile:
+        img_arr = infile[channel][:]
+    raw_mb = img_arr.nbytes/(2**20)
+
+    output = []
+    for k,(compression,chunk_shape) in enumerate(settings):
+        if chunk_shape is None:
+            chunk_shape = (1,img_arr.shape[1],img_arr.shape[2])
+        elif chunk_shape == "auto":
+            chunk_shape = choose_chunk_shape(img_arr.shape[1],img_arr.shape[2],img_arr.shape[0])
+        chunk_shape = clip_chunk_shape(chunk_shape,img_arr.shape)
+        chunk_cache_mem_size = 2*2*int(np.prod(chunk_shape)) ##as set by hdf5_fov_extractor.writemetadata
+        filepath = outputpath + "/benchmark_" + str(k)
+
+        start = time.perf_counter()
+        with open_array_file(filepath,"w") as outfile:
+            outfile.create_dataset(channel,data=img_arr,chunks=chunk_shape,**get_hdf5_compression(compression))
+        write_time = time.perf_counter()-start
+
+        percentile_times,crop_times = ([],[])
+        image_slice = slice(0,img_arr.shape[0])
+        for _ in range(repeats):
+            start = time.perf_counter()
+            with open_array_file(filepath,"r",rdcc_nbytes=chunk_cache_mem_size) as infile:
+                for _ in iter_t_slabs(infile[channel],t_chunk):
+                    pass
+            percentile_times.append(time.perf_counter()-start)
+            start = time.perf_counter()
+            with open_array_file(filepath,"r",rdcc_nbytes=chunk_cache_mem_size) as infile:
+                infile[channel][image_slice]
+            crop_times.append(time.perf_counter()-start)
+
+        file_mb = os.path.getsize(array_file_path(filepath))/(2**20)
+        output.append({"Compression":str(compression),"Chunk Shape":chunk_shape,"File Size (MB)":file_mb,"Compression Ratio":raw_mb/file_mb,\
+                       "Write Time (s)":write_time,"Percentile Read (MB/s)":raw_mb/min(percentile_times),"Crop Read (MB/s)":raw_mb/min(crop_times)})
+
+    shutil.rmtree(outputpath)
+    return pd.DataFrame(output)
+
+def register_fov_files(hdf5path,outputpath,file_idx_list,reg_channel,chunk_shape,downsample=1,roi=None,compression=None,array_backend="hdf5"):
+    """Registers all files of a single FOV while holding roughly one file in memory.
+
+    Shifts are estimated one file at a time, pairing the first frame of each file
+    with the last frame of the previous one, and the cumulative shifts are then
+    applied file by file. Each channel is padded with the median of its first file.
+
+    Args:
+        hdf5path (str): Directory of the extracted hdf5 files.
+        outputpath (str): Directory to write registered hdf5 files to.
+        file_idx_list (list): File indices of the FOV, in time order.
+        reg_channel (str): Channel used to estimate shifts.
+        chunk_shape (tuple): Chunk shape of the output datasets.
+        downsample (int): Downsampling used when estimating shifts.
+        roi (tuple, optional): (y_start,y_end,x_start,x_end) region used when estimating shifts.
+        compression (str, optional): Output compression, see get_hdf5_compression.
+        array_backend (str): Storage backend of the input and output files.
+    """
+    file_shift_coords = []
+    last_img = None
+    for file_idx in file_idx_list:
+        with open_array_file(hdf5path + "/hdf5_" + str(file_idx), "r", backend=array_backend) as infile:
+            channels = list(infile.keys())
+            reg_stack = infile[reg_channel][:]
+        cumulative_shift_coords = get_registration_shifts(reg_stack,prev_img=last_img,downsample=downsample,roi=roi)
+        if last_img is not None:
+            cumulative_shift_coords = cumulative_shift_coords + file_shift_coords[-1][-1]
+        file_shift_coords.append(cumulative_shift_coords)
+        last_img = reg_stack[-1]
+    del reg_stack,last_img
+
+    pad_vals = {}
+    for idx,file_idx in enumerate(file_idx_list):
+        with open_array_file(hdf5path + "/hdf5_" + str(file_idx), "r", backend=array_backend) as infile:
+            with open_array_file(outputpath + "/hdf5_" + str(file_idx), "w", backend=array_backend) as outfile:
+                for channel in channels:
+                    img_stack = infile[channel][:]
+                    if channel not in pad_vals:
+                        pad_vals[channel] = np.median(img_stack)
+                    img_stack = register_image_stack(img_stack,file_shift_coords[idx],pad_val=pad_vals[channel])
+                    outfile.create_dataset(str(channel),data=img_stack,chunks=clip_chunk_shape(chunk_shape,img_stack.shape),\
+                                           dtype='uint16',**get_hdf5_compression(compression))
+
 def generate_flatfield(flatfieldpath,outputpath): #can add dark image correction to this
     img_arr = []
     with ND2Reader(flatfieldpath) as infile:
@@ -53,14 +282,85 @@ def generate_flatfield(flatfieldpath,outputpath): #can add dark image correction
     aggregated_img = aggregated_img/np.max(aggregated_img)
     tifffile.imsave(outputpath,data=aggregated_img)
 
+def read_nd2_frame_channels(fh,chunk_location,num_channels,y_dim,x_dim):
+    """Reads every channel of a single ND2 frame from its image chunk, given the
+    chunk offset recorded by nd_metadata_handler. This avoids re-parsing the ND2
+    header and reads each chunk once, rather than once per channel as get_frame_2D does.
+
+    Args:
+        fh (file): ND2 file opened in binary mode.
+        chunk_location (int): File offset of the image chunk, -1 for missing frames.
+        num_channels (int): Number of channels to read, the first num_channels of those interleaved in the chunk.
+        y_dim (int): Image height.
+        x_dim (int): Image width.
+
+    Returns:
+        numpy.ndarray: (channel,y,x) uint16 array.
+    """
+    if chunk_location < 0:
+        return np.zeros((num_channels,y_dim,x_dim),dtype=np.uint16)
+    data = read_chunk(fh,int(chunk_location))
+    image_group_data = np.frombuffer(data,dtype=np.uint16)[4:] ##first 8 bytes are the timestamp
+    ## as in nd2reader, the number of interleaved channels comes from the chunk length, not the metadata
+    num_true_channels = image_group_data.shape[0]//(y_dim*x_dim)
+    if num_true_channels < num_channels:
+        raise ValueError("ND2 image chunk holds " + str(num_true_channels) + " channels, " + str(num_channels) + " were requested.")
+    ## stitched files pad the end of each row, which is stripped as in nd2reader's remove_parsed_unwanted_bytes
+    row_len = image_group_data.shape[0]//y_dim
+    image_group_data = image_group_data[:row_len*y_dim].reshape(y_dim,row_len)[:,:x_dim*num_true_channels]
+    image_group_data = image_group_data.reshape(y_dim,x_dim,num_true_channels)[:,:,:num_channels]
+    return np.moveaxis(image_group_data,2,0)
+
 def apply_flatfield(img,flatfieldimg,darkimg):
     outimg = (img - darkimg)/flatfieldimg
     outimg = np.clip(outimg,0.,65535.)
     outimg = outimg.astype("uint16")
     return outimg
 
+def apply_flatfield_stack(img_stack,flatfieldimg,darkimg,out=None):
+    """Stack-level version of apply_flatfield. Dark subtraction and flatfield
+    division are done over a whole (t,y,x) block in float32.
+
+    Args:
+        img_stack (numpy.ndarray): (t,y,x) image stack.
+        flatfieldimg (numpy.ndarray): (y,x) flatfield image.
+        darkimg (numpy.ndarray): (y,x) dark image.
+        out (numpy.ndarray, optional): Preallocated uint16 output, may be img_stack itself.
+
+    Returns:
+        numpy.ndarray: (t,y,x) uint16 flatfielded stack.
+    """
+    if out is None:
+        out = np.empty(img_stack.shape,dtype="uint16")
+    working_arr = np.subtract(img_stack,np.asarray(darkimg,dtype=np.float32),dtype=np.float32)
+    np.divide(working_arr,np.asarray(flatfieldimg,dtype=np.float32),out=working_arr)
+    np.clip(working_arr,0.,65535.,out=working_arr)
+    np.copyto(out,working_arr,casting="unsafe")
+    return out
+
+def downsample_stack(img_stack,output_shape):
+    """Block-mean downsampling of a whole (t,y,x) stack, used to generate thumbnails.
+    Output pixel blocks tile the full frame, so sizes that are not an integer
+    factor of the input get blocks that differ in size by at most one pixel.
+
+    Args:
+        img_stack (numpy.ndarray): (t,y,x) image stack.
+        output_shape (tuple): (y,x) output shape.
+
+    Returns:
+        numpy.ndarray: (t,y_out,x_out) uint16 stack.
+    """
+    y_edges = np.linspace(0,img_stack.shape[1],output_shape[0]+1).astype(int)
+    x_edges = np.linspace(0,img_stack.shape[2],output_shape[1]+1).astype(int)
+    block_sums = np.add.reduceat(img_stack,y_edges[:-1],axis=1,dtype=np.float32)
+    block_sums = np.add.reduceat(block_sums,x_edges[:-1],axis=2)
+    block_sizes = np.outer(np.diff(y_edges),np.diff(x_edges)).astype(np.float32)
+    block_sums /= block_sizes
+    return block_sums.astype("uint16")
+
 class hdf5_fov_extractor:
-    def __init__(self,nd2filename,headpath,tpts_per_file=100,ignore_fovmetadata=False,generate_thumbnails=True,thumbnail_rescale=0.05,register_images=False,reg_channel=None,nd2reader_override={}): #note this chunk size has a large role in downstream steps...make sure is less than 1 MB
+    def __init__(self,nd2filename,headpath,tpts_per_file=100,ignore_fovmetadata=False,generate_thumbnails=True,thumbnail_rescale=0.05,register_images=False,reg_channel=None,nd2reader_override={},\
+                 batch_extraction=True,tpts_per_batch=25,reg_downsample=1,reg_roi=None,compression=None,chunk_shape=None,array_backend="hdf5"): #note this chunk size has a large role in downstream steps...make sure is less than 1 MB
         self.nd2filename = nd2filename
         self.headpath = headpath
         self.metapath = self.headpath + "/metadata.hdf5"
@@ -74,15 +374,25 @@ class hdf5_fov_extractor:
         self.thumbnail_rescale = thumbnail_rescale
         self.register_images = register_images
         self.reg_channel = reg_channel
+        self.reg_downsample = reg_downsample ##downsampling factor used to estimate registration shifts
+        self.reg_roi = reg_roi ##(y_start,y_end,x_start,x_end) region used to estimate registration shifts
+        self.compression = compression ##lossless compression of extracted files, see get_hdf5_compression
+        self.output_chunk_shape = chunk_shape ##None for single frame chunks, "auto" for choose_chunk_shape, or a (t,y,x) tuple
+        self.array_backend = array_backend ##"hdf5" or "zarr", recorded in the metadata for downstream stages
+        self.batch_extraction = batch_extraction ##read all channels of a frame in one pass and write timepoint blocks
+        self.tpts_per_batch = tpts_per_batch ##None buffers the whole file
 
         self.organism = ''
         self.microscope = ''
         self.notes = ''
 
         self.channel_to_flat_dict = {}
+        self.ndmeta_handle = None
 
     def writemetadata(self,t_range=None,fov_list=None):
-        ndmeta_handle = nd_metadata_handler(self.nd2filename,ignore_fovmetadata=self.ignore_fovmetadata,nd2reader_override=self.nd2reader_override)
+        if self.ndmeta_handle is None:
+            self.ndmeta_handle = nd_metadata_handler(self.nd2filename,ignore_fovmetadata=self.ignore_fovmetadata,nd2reader_override=self.nd2reader_override)
+        ndmeta_handle = self.ndmeta_handle
         if self.ignore_fovmetadata:
             exp_metadata = ndmeta_handle.get_metadata()
         else:
@@ -97,11 +407,17 @@ class hdf5_fov_extractor:
             fov_metadata = fov_metadata.loc[list(fov_list)]
             exp_metadata["fields_of_view"] = list(fov_list)
 
-        self.chunk_shape = (1,exp_metadata["height"],exp_metadata["width"])
+        if self.output_chunk_shape is None:
+            self.chunk_shape = (1,exp_metadata["height"],exp_metadata["width"])
+        elif self.output_chunk_shape == "auto":
+            self.chunk_shape = choose_chunk_shape(exp_metadata["height"],exp_metadata["width"],self.tpts_per_file)
+        else:
+            self.chunk_shape = tuple(self.output_chunk_shape)
         self.thumb_chunk_shape = (1,int(exp_metadata["height"]*self.thumbnail_rescale),int(exp_metadata["width"]*self.thumbnail_rescale))
         chunk_bytes = (2*np.multiply.accumulate(np.array(self.chunk_shape))[-1])
         self.chunk_cache_mem_size = 2*chunk_bytes
-        exp_metadata["chunk_shape"],exp_metadata["chunk_cache_mem_size"] = (self.chunk_shape,self.chunk_cache_mem_size)
+        exp_metadata["chunk_shape"],exp_metadata["chunk_cache_mem_size"],exp_metadata["compression"] = (self.chunk_shape,self.chunk_cache_mem_size,self.compression)
+        exp_metadata["array_backend"] = self.array_backend
         exp_metadata["Images Registered?"],exp_metadata["Registration Channel"],exp_metadata["Organism"],exp_metadata["Microscope"],exp_metadata["Notes"] = \
         (self.register_images,self.reg_channel,self.organism,self.microscope,self.notes)
         self.meta_handle = pandas_hdf5_handler(self.metapath)
@@ -114,6 +430,7 @@ class hdf5_fov_extractor:
             assignment_metadata.astype({"t":float,"x": float,"y":float,"z":float,"File Index":int,"Image Index":int})
 
         self.meta_handle.write_df("global",assignment_metadata,metadata=exp_metadata)
+        self.meta_handle.write_df("chunk_offsets",ndmeta_handle.get_chunk_offsets())
 
     def assignidx(self,expmeta,metadf=None):
 
@@ -220,8 +537,9 @@ class hdf5_fov_extractor:
         metadf = metadf.reset_index(inplace=False)
         metadf = metadf.set_index(["File Index","Image Index"], drop=True, append=False, inplace=False)
         self.metadf = metadf.sort_index()
+        chunk_offsetdf = self.meta_handle.read_df("chunk_offsets")
 
-        def writehdf5(fovnum,num_entries,timepoint_list,file_idx,num_fovs):
+        def writehdf5(fovnum,num_entries,timepoint_list,file_idx,num_fovs,chunk_offsets=None):
             #### open flatfield images
             flatfield_img_dict = {}
             for channel,path in self.channel_to_flat_dict.items():
@@ -229,59 +547,50 @@ class hdf5_fov_extractor:
                     flatfield_img_dict[channel] = tifffile.imread(path)
 
             #### start reading nd2 files
-            with ND2Reader(self.nd2filename) as nd2file:
+            if self.batch_extraction:
+                nd2file = open(self.nd2filename,"rb") ##frames are read straight from their chunk offsets
+            else:
+                nd2file = ND2Reader(self.nd2filename)
                 for key,item in self.nd2reader_override.items():
                     nd2file.metadata[key] = item
+
+            with nd2file:
                 y_dim = self.metadata['height']
                 x_dim = self.metadata['width']
-                with h5py.File(self.hdf5path + "/hdf5_" + str(file_idx) + ".hdf5","w",rdcc_nbytes=self.chunk_cache_mem_size) as h5pyfile:
+                channels = self.metadata["channels"]
+                batch_size = len(timepoint_list) if self.tpts_per_batch is None else self.tpts_per_batch
+
+                with open_array_file(self.hdf5path + "/hdf5_" + str(file_idx),"w",backend=self.array_backend,rdcc_nbytes=self.chunk_cache_mem_size) as h5pyfile, ExitStack() as thumb_stack:
                 # with h5py_cache.File(self.hdf5path + "/hdf5_" + str(file_idx) + ".hdf5","w",chunk_cache_mem_size=self.chunk_cache_mem_size) as h5pyfile:
+                    compression_kwargs = get_hdf5_compression(self.compression)
+                    hdf5_datasets = [h5pyfile.create_dataset(str(channel),(num_entries,y_dim,x_dim),\
+                                    chunks=clip_chunk_shape(self.chunk_shape,(num_entries,y_dim,x_dim)), dtype='uint16',**compression_kwargs) for channel in channels]
 
                     if self.generate_thumbnails:
-                        with h5py.File(self.hdf5thumbpath + "/hdf5_" + str(file_idx) + ".hdf5","w") as h5pythumbfile:
-                            for i,channel in enumerate(self.metadata["channels"]):
-                                hdf5_dataset = h5pyfile.create_dataset(str(channel),\
-                                (num_entries,y_dim,x_dim), chunks=self.chunk_shape, dtype='uint16')
-
-                                thumbnail_dataset = h5pythumbfile.create_dataset(str(channel),\
-                                (num_entries,self.thumb_chunk_shape[1],self.thumb_chunk_shape[2]), chunks=self.thumb_chunk_shape, dtype='uint16')
-
-                                if self.channel_to_flat_dict[channel] != '': ##flatfielding channels
-                                    for j in range(len(timepoint_list)):
-                                        frame = timepoint_list[j]
-                                        nd2_image = nd2file.get_frame_2D(c=i, t=frame, v=fovnum)
-                                        nd2_image = np.array(nd2_image)
-                                        nd2_image = apply_flatfield(nd2_image,flatfield_img_dict[channel],flatfield_img_dict["Dark_Image"])
-                                        thumb_image = sk.transform.resize(nd2_image,(self.thumb_chunk_shape[1],self.thumb_chunk_shape[2]),anti_aliasing=False,preserve_range=True)
-                                        hdf5_dataset[j,:,:] = nd2_image
-                                        thumbnail_dataset[j,:,:] = thumb_image
-
-                                else:
-                                    for j in range(len(timepoint_list)): ##not flatfielding channels
-                                        frame = timepoint_list[j]
-                                        nd2_image = nd2file.get_frame_2D(c=i, t=frame, v=fovnum)
-                                        thumb_image = sk.transform.resize(nd2_image,(self.thumb_chunk_shape[1],self.thumb_chunk_shape[2]),anti_aliasing=False,preserve_range=True)
-                                        hdf5_dataset[j,:,:] = nd2_image
-                                        thumbnail_dataset[j,:,:] = thumb_image
-
-                    else:
-                        for i,channel in enumerate(self.metadata["channels"]):
-                            hdf5_dataset = h5pyfile.create_dataset(str(channel),\
-                            (num_entries,y_dim,x_dim), chunks=self.chunk_shape, dtype='uint16')
+                        h5pythumbfile = thumb_stack.enter_context(h5py.File(self.hdf5thumbpath + "/hdf5_" + str(file_idx) + ".hdf5","w"))
+                        thumbnail_datasets = [h5pythumbfile.create_dataset(str(channel),(num_entries,self.thumb_chunk_shape[1],self.thumb_chunk_shape[2]),\
+                                    chunks=self.thumb_chunk_shape, dtype='uint16',**compression_kwargs) for channel in channels]
+
+                    img_buffer = np.empty((len(channels),min(batch_size,len(timepoint_list)),y_dim,x_dim),dtype='uint16')
+                    for batch_start in range(0,len(timepoint_list),batch_size):
+                        batch_timepoints = timepoint_list[batch_start:batch_start+batch_size]
+                        batch_end = batch_start + len(batch_timepoints)
+                        batch_arr = img_buffer[:,:len(batch_timepoints)]
+
+                        for j,frame in enumerate(batch_timepoints):
+                            if self.batch_extraction:
+                                batch_arr[:,j] = read_nd2_frame_channels(nd2file,chunk_offsets[batch_start+j],len(channels),y_dim,x_dim)
+                            else:
+                                for i in range(len(channels)):
+                                    batch_arr[i,j] = nd2file.get_frame_2D(c=i, t=frame, v=fovnum)
 
+                        for i,channel in enumerate(channels):
                             if self.channel_to_flat_dict[channel] != '': ##flatfielding channels
-                                for j in range(len(timepoint_list)):
-                                    frame = timepoint_list[j]
-                                    nd2_image = nd2file.get_frame_2D(c=i, t=frame, v=fovnum)
-                                    nd2_image = np.array(nd2_image)
-                                    nd2_image = apply_flatfield(nd2_image,flatfield_img_dict[channel],flatfield_img_dict["Dark_Image"])
-                                    hdf5_dataset[j,:,:] = nd2_image
+                                apply_flatfield_stack(batch_arr[i],flatfield_img_dict[channel],flatfield_img_dict["Dark_Image"],out=batch_arr[i])
+                            hdf5_datasets[i][batch_start:batch_end] = batch_arr[i]
 
-                            else:
-                                for j in range(len(timepoint_list)): ##not flatfielding channels
-                                    frame = timepoint_list[j]
-                                    nd2_image = nd2file.get_frame_2D(c=i, t=frame, v=fovnum)
-                                    hdf5_dataset[j,:,:] = nd2_image
+                            if self.generate_thumbnails:
+                                thumbnail_datasets[i][batch_start:batch_end] = downsample_stack(batch_arr[i],self.thumb_chunk_shape[1:])
 
             return "Done."
 
@@ -296,8 +605,10 @@ class hdf5_fov_extractor:
             fovnum = filedf[0:1]["fov"].values[0]
             num_entries = len(filedf.index.get_level_values("Image Index").values)
             timepoint_list = filedf["timepoints"].tolist()
+            chunk_offsets = chunk_offsetdf.loc[fovnum].loc[timepoint_list,"Chunk Offset"].values
 
-            future = dask_controller.daskclient.submit(writehdf5,fovnum,num_entries,timepoint_list,file_idx,self.metadata["num_fovs"],retries=retries,priority=priority)
+            future = dask_controller.daskclient.submit(writehdf5,fovnum,num_entries,timepoint_list,file_idx,self.metadata["num_fovs"],\
+                                                       chunk_offsets=chunk_offsets,retries=retries,priority=priority)
             dask_controller.futures["extract file: " + str(file_idx)] = future
 
         extracted_futures = [dask_controller.futures["extract file: " + str(file_idx)] for file_idx in file_list]
@@ -321,8 +632,7 @@ class hdf5_fov_extractor:
 
         self.meta_handle.write_df("global",outdf,metadata=self.metadata)
 
-        ###optional registration
-        ###not optimized for memory, can be reworked fairly easily, but only if it becomes necessary
+        ###optional registration, streamed one file at a time
 
         if self.register_images:
 
@@ -331,35 +641,8 @@ class hdf5_fov_extractor:
             self.metadata = self.metadf.metadata
 
             def registerhdf5(file_idx_list,reg_channel):
-                reg_stack = []
-                for file_idx in file_idx_list:
-                    with h5py.File(self.hdf5path + "/hdf5_" + str(file_idx) + ".hdf5", "r") as infile:
-                        channels = list(infile.keys())
-                        reg_stack.append(infile[reg_channel][:])
-                reg_stack = np.concatenate(reg_stack)
-
-                cumulative_shift_coords = get_registration_shifts(reg_stack)
-                del reg_stack
-
-                y_dim = self.metadata['height']
-                x_dim = self.metadata['width']
-
-                for channel in channels:
-                    img_stack = []
-                    for file_idx in file_idx_list:
-                        with h5py.File(self.hdf5path + "/hdf5_" + str(file_idx) + ".hdf5", "r") as infile:
-                            img_stack.append(infile[channel][:])
-                    stack_borders = np.add.accumulate([0] + [item.shape[0] for item in img_stack])
-                    img_stack = np.concatenate(img_stack)
-                    img_stack = register_image_stack(img_stack,cumulative_shift_coords)
-                    for idx,file_idx in enumerate(file_idx_list):
-                        with h5py.File(self.tempregpath + "/hdf5_" + str(file_idx) + ".hdf5", "a") as outfile:
-                            stack_i = stack_borders[idx]
-                            stack_f = stack_borders[idx+1]
-                            stack_len = stack_f-stack_i
-
-                            hdf5_dataset = outfile.create_dataset(str(channel),(stack_len,y_dim,x_dim), chunks=self.chunk_shape, dtype='uint16')
-                            hdf5_dataset[:] = img_stack[stack_i:stack_f]
+                register_fov_files(self.hdf5path,self.tempregpath,file_idx_list,reg_channel,self.chunk_shape,\
+                                   downsample=self.reg_downsample,roi=self.reg_roi,compression=self.compression,array_backend=self.array_backend)
 
             fov_file_idx_list = self.metadf.reset_index().groupby("fov").apply(lambda x: sorted(list(x["File Index"].unique()))).tolist()
             num_jobs = len(fov_file_idx_list)
@@ -384,6 +667,7 @@ class nd_metadata_handler:
         self.nd2filename = nd2filename
         self.ignore_fovmetadata = ignore_fovmetadata
         self.nd2reader_override = nd2reader_override
+        self.metadata_cache = None ##(exp_metadata,fov_metadata,chunk_offsetdf), parsed once per handler
 
     def decode_unidict(self,unidict):
         outdict = {}
@@ -463,7 +747,28 @@ class nd_metadata_handler:
 
         return output
 
-    def get_metadata(self):
+    def make_chunk_offset_df(self,nd2file,exp_metadata):
+        """Records the file offset of the image chunk of every (fov,timepoint), so that
+        extraction tasks can seek straight to their frames without opening the ND2
+        with ND2Reader.
+        """
+        parser = nd2file.parser
+        fov_idx,timepoint_idx = np.meshgrid(np.arange(max(exp_metadata["num_fovs"],1)),np.array(exp_metadata["frames"]),indexing="ij")
+        fov_idx,timepoint_idx = (fov_idx.flatten(),timepoint_idx.flatten())
+
+        chunk_offsets = []
+        for fov,timepoint in zip(fov_idx,timepoint_idx):
+            try:
+                chunk_offsets.append(parser._label_map.get_image_data_location(parser._calculate_image_group_number(timepoint,fov,0)))
+            except KeyError: ##missing frames
+                chunk_offsets.append(-1)
+
+        output = pd.DataFrame({"fov":fov_idx,"timepoints":timepoint_idx,"Chunk Offset":chunk_offsets})
+        output = output.astype({"fov": int, "timepoints": int, "Chunk Offset": "int64"})
+        output = output.set_index(["fov","timepoints"], drop=True, append=False, inplace=False)
+        return output
+
+    def parse_nd2(self):
         # Manual numbers are for broken .nd2 files (from when Elements crashes)
         nd2file = ND2Reader(self.nd2filename)
         for key,item in self.nd2reader_override.items():
@@ -473,14 +778,129 @@ class nd_metadata_handler:
         exp_metadata = dict([(k, exp_metadata[k]) for k in wanted_keys if k in exp_metadata])
         exp_metadata["num_fovs"] = len(exp_metadata['fields_of_view'])
         exp_metadata["settings"] = self.get_imaging_settings(nd2file)
+        fov_metadata = None if self.ignore_fovmetadata else self.make_fov_df(nd2file, exp_metadata)
+        chunk_offsetdf = self.make_chunk_offset_df(nd2file, exp_metadata)
+        nd2file.close()
+        self.metadata_cache = (exp_metadata,fov_metadata,chunk_offsetdf)
+
+    def get_chunk_offsets(self):
+        if self.metadata_cache is None:
+            self.parse_nd2()
+        return copy.deepcopy(self.metadata_cache[2])
+
+    def get_metadata(self):
+        if self.metadata_cache is None:
+            self.parse_nd2()
+        exp_metadata,fov_metadata,_ = copy.deepcopy(self.metadata_cache)
         if not self.ignore_fovmetadata:
-            fov_metadata = self.make_fov_df(nd2file, exp_metadata)
-            nd2file.close()
             return exp_metadata,fov_metadata
         else:
-            nd2file.close()
             return exp_metadata
 
+def scan_single_directory(path):
+    subdirs,files = ([],[])
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            else:
+                files.append(entry.path)
+    return subdirs,files
+
+def scan_directory(path,num_workers=16):
+    """Lists every file below path, scanning each level of subdirectories in
+    parallel on a thread pool (the equivalent of a parallel os.walk).
+    """
+    file_paths = []
+    dir_queue = [path]
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        while len(dir_queue) > 0:
+            scan_results = list(executor.map(scan_single_directory,dir_queue))
+            dir_queue = []
+            for subdirs,files in scan_results:
+                dir_queue.extend(subdirs)
+                file_paths.extend(files)
+    return file_paths
+
+def parsestr_to_regex(parsestr):
+    """Converts a parse format string, e.g. "t{timepoints:d}xy{fov:d}c{channel:d}.tif",
+    into an equivalent regular expression with named groups.
+
+    Returns:
+        str: Regular expression.
+        dict: Type of each named field.
+    """
+    field_re = re.compile(r"\{(\w+)(?::([^}]*))?\}")
+    regex,field_types,last_end = ("",{},0)
+    for match in field_re.finditer(parsestr):
+        regex += re.escape(parsestr[last_end:match.start()])
+        name,spec = (match.group(1),match.group(2) or "")
+        if spec.endswith("d"):
+            regex += "(?P<" + name + r">[-+]?\d+)"
+            field_types[name] = int
+        elif spec.endswith("f"):
+            regex += "(?P<" + name + r">[-+]?\d*\.?\d+)"
+            field_types[name] = float
+        elif spec.endswith("w"):
+            regex += "(?P<" + name + r">\w+)"
+            field_types[name] = str
+        else:
+            regex += "(?P<" + name + ">.+?)"
+            field_types[name] = str
+        last_end = match.end()
+    regex += re.escape(parsestr[last_end:])
+    return regex,field_types
+
+def parse_file_paths(file_paths,parsestr):
+    """Vectorized equivalent of running parse.search(parsestr) over every path.
+    Paths that do not match are dropped.
+
+    Returns:
+        pandas.DataFrame: One column per parsed field, plus "image_paths".
+    """
+    regex,field_types = parsestr_to_regex(parsestr)
+    file_paths = pd.Series(file_paths,dtype=object).reset_index(drop=True)
+    parsed = file_paths.str.extract(regex)
+    matched = parsed.notna().all(axis=1)
+    parsed = parsed[matched].astype(field_types)
+    parsed["image_paths"] = file_paths[matched]
+    return parsed.reset_index(drop=True)
+
+def get_file_index(path,parsestr,index_path,file_filter="",rescan=False,num_workers=16):
+    """Scans path in parallel and parses the filenames matching file_filter (a regex
+    applied to the basename) with parsestr. The scan and parsed tables are persisted
+    to index_path so that reruns skip the directory scan, pass rescan=True if files
+    have been added since.
+
+    Returns:
+        pandas.DataFrame: Output of parse_file_paths.
+    """
+    file_index = {"path":path,"file_paths":None,"parsed":{}}
+    if not rescan and os.path.exists(index_path):
+        with open(index_path,"rb") as infile:
+            saved_index = pkl.load(infile)
+        if saved_index["path"] == path:
+            file_index = saved_index
+
+    key = (parsestr,file_filter)
+    if key not in file_index["parsed"]:
+        if file_index["file_paths"] is None:
+            file_index["file_paths"] = np.array(scan_directory(path,num_workers=num_workers),dtype=object)
+        file_paths = pd.Series(file_index["file_paths"],dtype=object)
+        file_paths = file_paths[file_paths.str.rsplit(os.sep,n=1).str[-1].str.contains(file_filter)]
+        file_index["parsed"][key] = parse_file_paths(file_paths,parsestr)
+        writedir(os.path.dirname(os.path.abspath(index_path)),overwrite=False)
+        with open(index_path,"wb") as outfile:
+            pkl.dump(file_index,outfile)
+    return file_index["parsed"][key].copy()
+
+def group_channel_paths(file_index):
+    """Collects the per-channel image paths of each (fov,timepoints) into a "channel_paths" dict column."""
+    channel_path_df = file_index.pivot(index=["fov","timepoints"],columns="channel",values="image_paths")
+    channel_paths = [{channel:path for channel,path in entry.items() if isinstance(path,str)} for entry in channel_path_df.to_dict("records")]
+    output = pd.DataFrame({"channel_paths":channel_paths},index=channel_path_df.index)
+    return output.sort_index()
+
 def get_tiff_tags(filepath):
     with tifffile.TiffFile(filepath) as tiff:
         tiff_tags = {}
@@ -491,7 +911,7 @@ def get_tiff_tags(filepath):
 
 class tiff_extractor:
     def __init__(self,tiffpath,headpath,channels,tpts_per_file=100,parsestr="t{timepoints:d}xy{fov:d}c{channel:d}.tif",zero_base_keys=["timepoints","fov","channel"],\
-                constant_key=None): #note this chunk size has a large role in downstream steps...make sure is less than 1 MB
+                constant_key=None,rescan=False): #note this chunk size has a large role in downstream steps...make sure is less than 1 MB
         """Utility to convert individual tiff files to hdf5 archives.
 
         Attributes:
@@ -501,6 +921,7 @@ class tiff_extractor:
             hdf5path (str): where to store hdf5 data
             tpts_per_file (int): number of timepoints to put in each hdf5 file
             parsestr (str): format of filenames from which to extract metadata (using parse library)
+            rescan (bool): rescan tiffpath instead of using the saved file index
         """
         self.tiffpath = tiffpath
         self.headpath = headpath
@@ -511,6 +932,7 @@ class tiff_extractor:
         self.parsestr = parsestr
         self.zero_base_keys = zero_base_keys
         self.constant_key = constant_key
+        self.rescan = rescan
 
         self.organism = ''
         self.microscope = ''
@@ -519,20 +941,13 @@ class tiff_extractor:
         self.channel_to_flat_dict = {}
 
     def get_metadata(self,tiffpath,channels,parsestr="t{timepoints:d}xy{fov:d}c{channel:d}.tif",zero_base_keys=["timepoints","fov","channel"],constant_key=None):
-        parser = compile(parsestr)
-        parse_keys = [item.split("}")[0].split(":")[0] for item in parsestr.split("{")[1:]] + ["image_paths"]
-
         exp_metadata = {}
-        fov_metadata = {key:[] for key in parse_keys}
+        fov_metadata = get_file_index(tiffpath,parsestr,self.headpath + "/file_index.pkl",file_filter=r"\.tif[^.]*$",rescan=self.rescan)
         if constant_key is not None:
-            for key in constant_key.keys():
-                fov_metadata[key] = []
+            for key,value in constant_key.items():
+                fov_metadata[key] = value
 
-        tiff_files = []
-        for root, _, files in os.walk(tiffpath):
-            tiff_files.extend([os.path.join(root, f) for f in files if ".tif" in os.path.splitext(f)[1]])
-
-        tags = get_tiff_tags(tiff_files[0])
+        tags = get_tiff_tags(fov_metadata["image_paths"].iloc[0])
         exp_metadata["height"] = tags['ImageLength']
         exp_metadata["width"] = tags['ImageWidth']
         try:
@@ -542,41 +957,16 @@ class tiff_extractor:
             print("Pixel microns not detected. Global position annotations will be invalid.")
         exp_metadata["channels"] = channels
 
-        for f in tiff_files:
-            match = parser.search(f)
-            # ignore any files that don't match the regex
-            if match != None:
-                # Add to dictionary
-                fov_frame_dict = match.named
-                for key, value in fov_frame_dict.items():
-                    fov_metadata[key].append(value)
-                if constant_key is not None:
-                    for key in constant_key.keys():
-                        fov_metadata[key].append(constant_key[key])
-                fov_metadata["image_paths"].append(f)
-
         for zero_base_key in zero_base_keys:
-            if 0 not in fov_metadata[zero_base_key]:
-                fov_metadata[zero_base_key] = [item-1 for item in fov_metadata[zero_base_key]]
+            if 0 not in fov_metadata[zero_base_key].values:
+                fov_metadata[zero_base_key] = fov_metadata[zero_base_key] - 1
 
-        exp_metadata["num_fovs"] = len(set(fov_metadata['fov']))
-        exp_metadata["frames"] = list(set(fov_metadata['timepoints']))
+        exp_metadata["num_fovs"] = fov_metadata['fov'].nunique()
+        exp_metadata["frames"] = sorted(fov_metadata['timepoints'].unique().tolist())
         exp_metadata["num_frames"] = len(exp_metadata["frames"])
 
-        fov_metadata = pd.DataFrame(fov_metadata)
-        fov_metadata["channel"] = fov_metadata["channel"].apply(lambda x: channels[x])
-        fov_metadata = fov_metadata.set_index(["fov","timepoints"]).sort_index()
-
-        output_fov_metadata = []
-        step = len(channels)
-        for i in range(0,len(fov_metadata),step):
-            rows = fov_metadata[i:i+step]
-            channel_path_entry = dict(zip(rows["channel"],rows["image_paths"]))
-            fov_entry = rows.index.get_level_values("fov").unique()[0]
-            timepoint_entry = rows.index.get_level_values("timepoints").unique()[0]
-            fov_metadata_entry = {"fov":fov_entry,"timepoints":timepoint_entry,"channel_paths":channel_path_entry}
-            output_fov_metadata.append(fov_metadata_entry)
-        fov_metadata = pd.DataFrame(output_fov_metadata).set_index(["fov","timepoints"])
+        fov_metadata["channel"] = np.array(channels,dtype=object)[fov_metadata["channel"].values]
+        fov_metadata = group_channel_paths(fov_metadata)
 
         return exp_metadata,fov_metadata
 
@@ -0,0 +1,118 @@
+# fmt: off
+import numpy as np
+import pandas as pd
+import dask.dataframe as dd
+
+## digit widths of the composite indices used throughout the pipeline
+fov_parquet_index_widths = [4,4,4,4] # fov,row,trench,timepoints
+temp_file_parquet_index_widths = [8,4,4] # File Index,Image Index,timepoints
+file_parquet_index_widths = [8,4,4] # File Index,File Trench Index,timepoints
+trenchid_timepoint_index_widths = [8,4] # trenchid,timepoints
+global_cellid_widths = [8,4,4] # File Index,File Trench Index,CellID
+
+max_int64 = np.iinfo(np.int64).max
+
+def check_index_components(components,widths):
+    """Checks that every component fits in its digit width and that the packed
+    index fits in an int64, raising an OverflowError otherwise.
+    """
+    if len(components) != len(widths):
+        raise ValueError("Got " + str(len(components)) + " index components for " + str(len(widths)) + " widths.")
+    max_index = 0
+    for i,(component,width) in enumerate(zip(components,widths)):
+        if component.size == 0:
+            max_index = max_index*(10**width)
+            continue
+        component_min,component_max = (int(component.min()),int(component.max()))
+        if component_min < 0:
+            raise OverflowError("Index component " + str(i) + " has negative value " + str(component_min) + ".")
+        if i > 0 and component_max >= 10**width:
+            raise OverflowError("Index component " + str(i) + " value " + str(component_max) + " does not fit in " + str(width) + " digits.")
+        max_index = max_index*(10**width) + component_max
+    if max_index > max_int64:
+        raise OverflowError("Packed index " + str(max_index) + " does not fit in an int64.")
+
+def encode_index(components,widths):
+    """Packs non-negative integer components into a single int64 index by
+    concatenating their zero padded decimal digits. For example,
+    encode_index([fov,row,trench,timepoints],[4,4,4,4]) is equal to
+    int(f'{fov:04n}{row:04n}{trench:04n}{timepoints:04n}'), computed with
+    array arithmetic. The leading component may use more than its width.
+
+    Args:
+        components (list): Scalars, arrays or pandas Series of integers.
+        widths (list): Number of decimal digits of each component.
+
+    Returns:
+        int or array: The packed index, an int if all components are scalars
+        and an int64 array otherwise.
+    """
+    scalar = all(np.ndim(component) == 0 for component in components)
+    components = [np.asarray(component) for component in components]
+    components = [component if np.issubdtype(component.dtype,np.integer) else component.astype(np.int64) for component in components]
+    check_index_components(components,widths)
+
+    index = np.zeros(np.broadcast(*components).shape,dtype=np.int64)
+    for component,width in zip(components,widths):
+        index *= 10**width
+        index += component
+    if scalar:
+        return int(index)
+    return index
+
+def encode_index_columns(df,columns,widths,name=None):
+    """Packs the given columns of a pandas or dask dataframe into an int64
+    index with encode_index.
+
+    Args:
+        df (pandas.DataFrame or dask.dataframe.DataFrame): Input dataframe.
+        columns (list): Column names, in the order they are packed.
+        widths (list): Number of decimal digits of each column.
+        name (str, optional): Name of the output series.
+
+    Returns:
+        pandas.Series or dask.dataframe.Series: Packed index aligned with df.
+    """
+    if isinstance(df,dd.DataFrame):
+        return df.map_partitions(encode_index_columns,columns,widths,name=name,meta=pd.Series([],dtype="int64",name=name))
+    index = encode_index([df[column].values for column in columns],widths)
+    return pd.Series(index,index=df.index,name=name,dtype="int64")
+
+def decode_index(index,widths):
+    """Unpacks an index built by encode_index back into its components.
+
+    Args:
+        index (int or array): Packed index.
+        widths (list): Number of decimal digits of each component.
+
+    Returns:
+        list: One int or int64 array per component.
+    """
+    scalar = np.ndim(index) == 0
+    remainder = np.asarray(index,dtype=np.int64)
+    components = []
+    for width in widths[:0:-1]:
+        remainder,component = np.divmod(remainder,10**width)
+        components.append(component)
+    components.append(remainder)
+    components = components[::-1]
+    if scalar:
+        return [int(component) for component in components]
+    return components
+
+def index_bounds(prefix,widths):
+    """Returns the inclusive range of indices whose leading components equal
+    prefix, e.g. every File Parquet Index of a single file. Equivalent to
+    int(str(file_idx) + "00000000") and int(str(file_idx) + "99999999").
+
+    Args:
+        prefix (list): Values of the leading components.
+        widths (list): Number of decimal digits of each component.
+
+    Returns:
+        tuple: (lower,upper) ints.
+    """
+    num_prefix = len(prefix)
+    lower = encode_index(list(prefix) + [0]*(len(widths)-num_prefix),widths)
+    upper = lower + 10**int(np.sum(widths[num_prefix:],dtype=int)) - 1
+    return lower,upper
@@ -9,6 +9,7 @@ import dask
 import dask.dataframe as dd
 
 from .daskutils import make_parquet_index, lookup_parquet_index, to_parquet_checkpoint
+from .arraystore import open_array_file, get_array_backend
 
 
 class projection_handler:
@@ -16,6 +17,7 @@ class projection_handler:
         self.headpath = headpath
         self.projection_fn = projection_fn
         self.projection_name = projection_name
+        self.array_backend = get_array_backend(self.headpath + "/metadata.hdf5")
 
         kymo_meta = dd.read_parquet(
             self.headpath + "/kymograph/metadata",
@@ -190,9 +192,9 @@ class projection_handler:
         projection_fn=np.nanpercentile,
         **projection_fn_kwargs
     ):
-        with h5py.File(headpath + "/kymograph/kymograph_" + str(file_idx) + ".hdf5", "r") as infile:
+        with open_array_file(headpath + "/kymograph/kymograph_" + str(file_idx), "r", backend=self.array_backend) as infile:
             intensity_data = infile[intensity_channel][:]
-        with h5py.File(headpath + "/" + seg_key + "/segmentation_" + str(file_idx) + ".hdf5", "r") as infile:
+        with open_array_file(headpath + "/" + seg_key + "/segmentation_" + str(file_idx), "r", backend=self.array_backend) as infile:
             seg_data = infile["data"][:]
 
         orientation_conv_dict = {"top":0,"bottom":1}
@@ -278,9 +280,9 @@ class projection_handler:
         projection_fn=np.nanpercentile,
         **projection_fn_kwargs
     ):
-        with h5py.File(headpath + "/kymograph/kymograph_" + str(file_idx) + ".hdf5", "r") as infile:
+        with open_array_file(headpath + "/kymograph/kymograph_" + str(file_idx), "r", backend=self.array_backend) as infile:
             intensity_data = infile[intensity_channel][:]
-        with h5py.File(headpath + "/" + seg_key + "/segmentation_" + str(file_idx) + ".hdf5", "r") as infile:
+        with open_array_file(headpath + "/" + seg_key + "/segmentation_" + str(file_idx), "r", backend=self.array_backend) as infile:
             seg_data = infile["data"][:]
 
         orientation_conv_dict = {"top":0,"bottom":1}
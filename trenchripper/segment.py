@@ -14,6 +14,8 @@ from dask.distributed import as_completed
 from skimage import measure,feature,segmentation,future,util,morphology,filters,exposure,transform
 from skimage.segmentation import watershed
 from .utils import kymo_handle,pandas_hdf5_handler,writedir
+from .arraystore import open_array_file,get_array_backend,array_file_exists
+from .parquetindex import encode_index
 from .trcluster import hdf5lock
 from time import sleep
 import scipy.ndimage.morphology as morph
@@ -27,7 +29,7 @@ class fluo_segmentation:
     def __init__(self,maskpath=None,bit_max=0,scale_timepoints=False,scaling_percentile=0.9,img_scaling=1.,smooth_sigma=0.75,eig_sigma=2.,\
                  eig_ball_radius=20,eig_local_thr="niblack",eig_otsu_scaling=1.,eig_niblack_k=0.05,eig_window_size=7,\
                  hess_pad=6,local_thr="otsu",background_thr="triangle",global_threshold=25,window_size=15,cell_otsu_scaling=1.,niblack_k=0.2,background_scaling=1.,\
-                 min_obj_size=30,distance_threshold=2,border_buffer=1,horizontal_border_only=False):
+                 min_obj_size=30,distance_threshold=2,border_buffer=1,horizontal_border_only=False,seg_batch_pixels=2**23,eig_background_method="rolling_ball"):
 
         self.maskpath = maskpath
         self.bit_max = bit_max
@@ -43,6 +45,7 @@ class fluo_segmentation:
         self.hess_pad = hess_pad
         self.eig_sigma = eig_sigma
         self.eig_ball_radius = eig_ball_radius
+        self.eig_background_method = eig_background_method
         self.eig_local_thr = eig_local_thr
         self.eig_otsu_scaling = eig_otsu_scaling
         self.eig_niblack_k = eig_niblack_k
@@ -62,13 +65,15 @@ class fluo_segmentation:
         self.border_buffer = border_buffer
         self.horizontal_border_only = horizontal_border_only
 
-    def to_8bit(self,img_arr,bit_max=None):
-        img_max = np.max(img_arr)+0.0001
+        self.seg_batch_pixels = seg_batch_pixels
+
+    def to_8bit(self,img_arr,bit_max=None,axis=None):
+        img_max = np.max(img_arr,axis=axis,keepdims=True)+0.0001
         if bit_max is None:
             max_val = img_max
         else:
-            max_val = max(img_max,bit_max)
-        min_val = np.min(img_arr)
+            max_val = np.maximum(img_max,bit_max)
+        min_val = np.min(img_arr,axis=axis,keepdims=True)
 #         min_val = np.min(img_arr)
         norm_array = (img_arr-min_val)/(max_val-min_val)
         norm_array = np.clip(norm_array,0,1)
@@ -76,25 +81,72 @@ class fluo_segmentation:
         return norm_byte_array
 
     def scale_kymo(self,wrap_arr,percentile):
-        perc_t = np.percentile(wrap_arr[:].reshape(wrap_arr.shape[0],-1),percentile,axis=1)
-        norm_perc_t = perc_t/np.max(perc_t)
-        scaled_arr = wrap_arr.astype(float)/norm_perc_t[:,np.newaxis,np.newaxis]
+        perc_t = np.percentile(wrap_arr[:].reshape(wrap_arr.shape[:-2]+(-1,)),percentile,axis=-1)
+        norm_perc_t = perc_t/np.max(perc_t,axis=-1,keepdims=True)
+        scaled_arr = wrap_arr.astype(float)/norm_perc_t[...,np.newaxis,np.newaxis]
         scaled_arr[scaled_arr>255.] = 255.
         scaled_arr = scaled_arr.astype("uint8")
         return scaled_arr
 
+    def get_hessian_min_eig(self,img_arr,sigma=1.,truncate=4.):
+        """Smaller eigenvalue of the Hessian of a Gaussian smoothed image, in
+        float32. The second derivatives are separable filters, a sampled Gaussian
+        convolved with the central differences np.gradient applies twice, so the
+        result matches sk.feature.hessian_matrix (use_gaussian_derivatives=False)
+        away from the image edges. The closed form 2x2 eigenvalue is evaluated
+        in place in the three derivative buffers. Leading axes are treated as a
+        batch.
+
+        Args:
+            img_arr (numpy.ndarray): Image of shape (...,y,x), scaled to [0,1].
+            sigma (float): Gaussian sigma.
+            truncate (float): Gaussian kernel radius in sigmas.
+
+        Returns:
+            numpy.ndarray: float32 array of the same shape.
+        """
+        radius = int(truncate*sigma+0.5)
+        gauss = np.exp(-0.5*(np.arange(-radius,radius+1)/sigma)**2)
+        gauss = (gauss/gauss.sum()).astype("float32")
+        gauss_d1 = np.convolve(gauss,np.array([0.5,0.,-0.5],dtype="float32"))
+        gauss_d2 = np.convolve(gauss,np.array([0.25,0.,-0.5,0.,0.25],dtype="float32"))
+
+        img_arr = img_arr.astype("float32",copy=False)
+        smooth_r = ndi.correlate1d(img_arr,gauss,axis=-2,mode="constant")
+        deriv_r = ndi.correlate1d(img_arr,gauss_d1,axis=-2,mode="constant")
+        H_rr = ndi.correlate1d(img_arr,gauss_d2,axis=-2,mode="constant")
+        H_rr = ndi.correlate1d(H_rr,gauss,axis=-1,mode="constant",output=H_rr)
+        H_rc = ndi.correlate1d(deriv_r,gauss_d1,axis=-1,mode="constant")
+        del deriv_r
+        H_cc = ndi.correlate1d(smooth_r,gauss_d2,axis=-1,mode="constant")
+        del smooth_r
+
+        ## min eigenvalue (H_rr+H_cc)/2 - sqrt(((H_rr-H_cc)/2)**2 + H_rc**2)
+        np.square(H_rc,out=H_rc)
+        H_rr += H_cc
+        H_cc *= 2.
+        H_cc -= H_rr
+        H_cc *= 0.5
+        np.square(H_cc,out=H_cc)
+        H_cc += H_rc
+        del H_rc
+        np.sqrt(H_cc,out=H_cc)
+        H_rr *= 0.5
+        H_rr -= H_cc
+        return H_rr
+
     def get_eig_img(self,img_arr,edge_padding=6):
+        """Minimum Hessian eigenvalue image, 8-bit normalized per image. Leading
+        axes are treated as a batch.
+        """
+        batch_axes = img_arr.ndim-2
         inverted = sk.util.invert(img_arr)
         del img_arr
-        inverted = np.pad(inverted, edge_padding, 'edge')
-        hessian = sk.feature.hessian_matrix(inverted,order="rc")
+        inverted = np.pad(inverted, ((0,0),)*batch_axes + ((edge_padding,edge_padding),)*2, 'edge')
+        eig_img = self.get_hessian_min_eig(sk.img_as_float32(inverted))
         del inverted
-        eig_img = sk.feature.hessian_matrix_eigvals(hessian)
-        del hessian
-        eig_img = np.min(eig_img,axis=0)
-        eig_img = eig_img[edge_padding:-edge_padding,edge_padding:-edge_padding]
-        max_val,min_val = np.max(eig_img),np.min(eig_img)
-        eig_img = self.to_8bit(eig_img)
+        eig_img = eig_img[...,edge_padding:-edge_padding,edge_padding:-edge_padding]
+        eig_img = self.to_8bit(eig_img,axis=(-2,-1))
         return eig_img
 
     def get_background_dist(self,array,min_tail=30):
@@ -108,13 +160,145 @@ class fluo_segmentation:
             std_n = np.std(array.flatten())
         return mu_n,std_n
 
-    def get_eig_mask(self,eig_img,input_kymo_mask,eig_sigma=2.,eig_ball_radius=20,eig_local_thr="niblack",eig_otsu_scaling=1.,eig_niblack_k=0.05,eig_window_size=7):
-        inv_eig_img = sk.util.invert(sk.filters.gaussian(eig_img,sigma=eig_sigma,preserve_range=True).astype("uint8"))
+    def get_ball_kernel(self,radius,value_range,scale=1):
+        """Rolling ball kernel cropped to the offsets that can affect the
+        background of an image spanning value_range. Offsets where the ball
+        drops by more than the image's range never set the minimum, so
+        rolling_ball with the cropped kernel is exact.
+
+        Args:
+            radius (int): Ball radius, in pixels and intensity units.
+            value_range (float): Max minus min of the image.
+            scale (int): Pixel size relative to the ball's pixels, for shrunk images.
+
+        Returns:
+            numpy.ndarray: 2D kernel, inf outside the ball.
+        """
+        max_dist = radius if value_range >= radius else np.sqrt(2*radius*value_range - value_range**2)
+        half_width = int(max_dist//scale)+1
+        offsets = np.arange(-half_width,half_width+1)*scale
+        sq_dist = offsets[:,np.newaxis]**2 + offsets[np.newaxis,:]**2
+        kernel = np.full(sq_dist.shape,np.inf)
+        in_ball = sq_dist <= radius**2
+        kernel[in_ball] = np.sqrt(radius**2 - sq_dist[in_ball])
+        return kernel
+
+    def get_background(self,img_arr,radius,method="rolling_ball",shrink_factor=None):
+        """Estimates the background of an image, or a batch of images along the
+        leading axes, with one of several engines:
+
+            "rolling_ball": sk.restoration.rolling_ball, exact.
+            "parabolic": grey erosion by the paraboloid osculating the ball, decomposed
+            into two 1D erosions, so the cost is linear rather than quadratic in radius.
+            "shrink": rolling ball on a min-shrunk image, expanded back with linear
+            interpolation.
+
+        Args:
+            img_arr (numpy.ndarray): Float image(s) of shape (...,y,x).
+            radius (int): Ball radius.
+            method (str): Background engine.
+            shrink_factor (int, optional): Shrink factor for "shrink", chosen from the radius if None.
+
+        Returns:
+            numpy.ndarray: Background of the same shape.
+        """
+        batch_axes = img_arr.ndim-2
+        value_range = float(np.max(img_arr)-np.min(img_arr))
+
+        if radius <= 0:
+            return img_arr.astype(float)
+        elif method == "rolling_ball":
+            kernel = self.get_ball_kernel(radius,value_range)
+            return sk.restoration.rolling_ball(img_arr,kernel=kernel.reshape((1,)*batch_axes + kernel.shape))
+
+        elif method == "parabolic":
+            half_width = int(np.sqrt(2*radius*value_range))
+            offsets = np.arange(-half_width,half_width+1)
+            structure = -(offsets**2)/(2*radius)
+            background = img_arr.astype(float)
+            for axis in [-2,-1]:
+                structure_shape = [1]*img_arr.ndim
+                structure_shape[axis] = len(offsets)
+                background = ndi.grey_erosion(background,structure=structure.reshape(structure_shape),mode="constant",cval=np.inf)
+            return background
+
+        elif method == "shrink":
+            if shrink_factor is None:
+                shrink_factor = 1 if radius <= 10 else 2 if radius <= 30 else 4 if radius <= 100 else 8
+            img_shape = img_arr.shape
+            pad_width = [(0,0)]*batch_axes + [(0,-img_shape[axis]%shrink_factor) for axis in [-2,-1]]
+            padded = np.pad(img_arr,pad_width,mode="edge")
+            padded_shape = padded.shape
+            shrunk = padded.reshape(padded_shape[:-2] + (padded_shape[-2]//shrink_factor,shrink_factor,padded_shape[-1]//shrink_factor,shrink_factor))
+            shrunk = shrunk.min(axis=(-3,-1))
+            kernel = self.get_ball_kernel(radius,value_range,scale=shrink_factor)
+            shrunk_background = sk.restoration.rolling_ball(shrunk,kernel=kernel.reshape((1,)*batch_axes + kernel.shape))
+            background = sk.transform.resize(shrunk_background,padded_shape,order=1,mode="edge",anti_aliasing=False,preserve_range=True)
+            background = background[...,:img_shape[-2],:img_shape[-1]]
+            return np.minimum(background,img_arr)
+
+        else:
+            raise ValueError("Unknown background method " + str(method))
+
+    def benchmark_background_methods(self,eig_list,eig_sigma=2.,eig_ball_radius=20,methods=["rolling_ball","parabolic","shrink"],\
+                                     eig_local_thr="niblack",eig_otsu_scaling=1.,eig_niblack_k=0.05,eig_window_size=7):
+        """Times each background engine on sample Hessian images, such as the
+        eig_list of an interactive session, and compares its 8-bit background
+        and Hessian mask to the rolling ball.
+
+        Args:
+            eig_list (list): 8-bit Hessian images from get_eig_img.
+            methods (list): Background engines to compare.
+
+        Returns:
+            pandas.DataFrame: Per method, the total runtime in seconds, the mean and maximum absolute
+            background difference in 8-bit levels and the fraction of mask pixels that agree.
+        """
+        from time import perf_counter
+        results = {}
+        reference = None
+        for method in methods:
+            runtime = 0.
+            backgrounds,masks = ([],[])
+            for eig_img in eig_list:
+                start = perf_counter()
+                eig_mask,inv_eig_img = self.get_eig_mask(eig_img,None,eig_sigma=eig_sigma,eig_ball_radius=eig_ball_radius,eig_local_thr=eig_local_thr,\
+                                                         eig_otsu_scaling=eig_otsu_scaling,eig_niblack_k=eig_niblack_k,eig_window_size=eig_window_size,\
+                                                         eig_background_method=method)
+                runtime += perf_counter()-start
+                backgrounds.append(inv_eig_img.astype(int).ravel())
+                masks.append(eig_mask.ravel())
+            backgrounds,masks = (np.concatenate(backgrounds),np.concatenate(masks))
+            if reference is None:
+                reference = (backgrounds,masks)
+            abs_diff = np.abs(backgrounds-reference[0])
+            results[method] = {"Runtime (s)":runtime,"Mean Abs Difference":np.mean(abs_diff),"Max Abs Difference":np.max(abs_diff),\
+                               "Mask Agreement":np.mean(masks==reference[1])}
+        return pd.DataFrame(results).T
+
+    def get_eig_mask(self,eig_img,input_kymo_mask,eig_sigma=2.,eig_ball_radius=20,eig_local_thr="niblack",eig_otsu_scaling=1.,eig_niblack_k=0.05,eig_window_size=7,\
+                     eig_background_method="rolling_ball"):
+        """Thresholds the background subtracted Hessian image. Leading axes are
+        treated as a batch; smoothing and background estimation run once over the
+        batch and thresholding runs per image.
+        """
+        batch_axes = eig_img.ndim-2
+        inv_eig_img = sk.util.invert(sk.filters.gaussian(eig_img,sigma=(0,)*batch_axes + (eig_sigma,eig_sigma),preserve_range=True).astype("uint8"))
 
         norm_inv_hess = (inv_eig_img)/(2**8 - 1)
-        inv_eig_img = (sk.restoration.rolling_ball(norm_inv_hess,radius=eig_ball_radius)*(2**8 - 1)).astype("uint8")
+        inv_eig_img = (self.get_background(norm_inv_hess,eig_ball_radius,method=eig_background_method)*(2**8 - 1)).astype("uint8")
         del norm_inv_hess
 
+        if batch_axes > 0:
+            eig_mask = np.stack([self.threshold_eig_img(inv_eig_img[i],None if input_kymo_mask is None else input_kymo_mask[i],\
+                                                        eig_local_thr=eig_local_thr,eig_otsu_scaling=eig_otsu_scaling,eig_niblack_k=eig_niblack_k,\
+                                                        eig_window_size=eig_window_size) for i in range(inv_eig_img.shape[0])],axis=0)
+        else:
+            eig_mask = self.threshold_eig_img(inv_eig_img,input_kymo_mask,eig_local_thr=eig_local_thr,eig_otsu_scaling=eig_otsu_scaling,\
+                                              eig_niblack_k=eig_niblack_k,eig_window_size=eig_window_size)
+        return eig_mask,inv_eig_img
+
+    def threshold_eig_img(self,inv_eig_img,input_kymo_mask,eig_local_thr="niblack",eig_otsu_scaling=1.,eig_niblack_k=0.05,eig_window_size=7):
         if eig_local_thr == "otsu":
             otsu_selem = sk.morphology.disk(eig_window_size)
             if input_kymo_mask is None:
@@ -128,7 +312,7 @@ class fluo_segmentation:
         else:
             raise ValueError("Cannot use a segmentation mask and a Niblack threshold. Use Otsu thresholding instead.")
 
-        return eig_mask,inv_eig_img
+        return eig_mask
 
     def get_cell_mask(self,input_kymo, input_kymo_labels, t_tot, local_thr = "otsu" , background_thr = "triangle", global_threshold = 0, window_size = 15, cell_otsu_scaling= 1., niblack_k = 0.2, background_scaling = 1., min_obj_size = 30):
 
@@ -263,38 +447,121 @@ class fluo_segmentation:
 
         return cell_mask
 
-    def reorder_ids(self,array):
-        unique_ids,inv = np.unique(array,return_inverse=True)
-        new_ids = np.array(range(len(unique_ids)))
-        lookup = dict(zip(unique_ids,new_ids))
-        output = np.array([lookup[unique_id] for unique_id in unique_ids])[inv].reshape(array.shape)
-        return output
+    def relabel_frames(self,label_arr):
+        """Relabels each frame of a (t,y,x) label stack to 1..n with a single
+        np.unique over (t,label) pairs, matching relabel_sequential(offset=1)
+        applied frame by frame. Background stays 0.
+        """
+        label_arr = np.asarray(label_arr)
+        num_values = int(label_arr.max())+1 if label_arr.size > 0 else 1
+        frame_keys = np.arange(label_arr.shape[0],dtype=np.int64).reshape((-1,)+(1,)*(label_arr.ndim-1))*num_values + label_arr
+        unique_keys,inv = np.unique(frame_keys,return_inverse=True)
+        unique_frames,unique_labels = np.divmod(unique_keys,num_values)
+
+        ## rank of each label within its frame, shifted so the first nonzero label is 1
+        frame_starts = np.searchsorted(unique_frames,unique_frames)
+        frame_rank = np.arange(len(unique_keys)) - frame_starts
+        frame_rank += unique_labels[frame_starts] != 0
+        new_labels = np.where(unique_labels==0,0,frame_rank).astype("uint32")
+        return new_labels[inv].reshape(label_arr.shape)
+
+    def combine_labels(self,output_kymo,label_arr):
+        """Splits segmented objects by the labels of an extra mask, giving each
+        (object,mask label) pair its own label in every frame. The pair is
+        packed as object*10**4 + mask label, equal to the former
+        int(f'{object:04n}{mask label:04n}'), then relabeled per frame.
+
+        Args:
+            output_kymo (numpy.ndarray): Segmentation labels of shape (t,y,x).
+            label_arr (numpy.ndarray): Extra mask labels of the same shape.
+
+        Returns:
+            numpy.ndarray: Per-frame sequential labels of shape (t,y,x).
+        """
+        combined_kymo = encode_index([output_kymo,label_arr],[4,4])
+        combined_kymo[(output_kymo==0)|(label_arr==0)] = 0
+        return self.relabel_frames(combined_kymo)
+
+    def clear_border_frames(self,label_arr,border_buffer=1,horizontal_border_only=False):
+        """Batched clear_border followed by relabeling of every frame of a
+        (t,y,x) label stack. Labels found in the border slabs of a frame (the
+        outer border_buffer+1 rows, and columns unless horizontal_border_only)
+        are zeroed through a lookup table over (frame,label) pairs. The same
+        np.unique pass then renumbers the remaining labels of each frame in
+        sorted order, with background as 0. A negative border_buffer only
+        renumbers.
+
+        Args:
+            label_arr (numpy.ndarray): Labels of shape (t,y,x).
+            border_buffer (int): Width of the border, as in clear_border's buffer_size.
+            horizontal_border_only (bool): Only clear labels touching the top and bottom.
+
+        Returns:
+            numpy.ndarray: uint32 labels of shape (t,y,x).
+        """
+        num_frames = label_arr.shape[0]
+        num_values = int(label_arr.max())+1 if label_arr.size > 0 else 1
+        frame_offsets = np.arange(num_frames,dtype=np.int64)[:,np.newaxis,np.newaxis]*num_values
+        unique_keys,inv = np.unique(frame_offsets + label_arr,return_inverse=True)
+        unique_frames,unique_labels = np.divmod(unique_keys,num_values)
+
+        background = unique_labels==0
+        if border_buffer >= 0:
+            ext = border_buffer+1
+            border_slabs = [label_arr[:,:ext],label_arr[:,-ext:]]
+            if not horizontal_border_only:
+                border_slabs += [label_arr[:,:,:ext],label_arr[:,:,-ext:]]
+            border_keys = np.concatenate([(frame_offsets + slab).ravel() for slab in border_slabs])
+            background |= np.isin(unique_keys,border_keys)
+
+        ## rank among the kept labels of the frame, after background if the frame has any
+        kept = ~background
+        frame_has_background = np.bincount(unique_frames[background],minlength=num_frames) > 0
+        kept_before = np.cumsum(kept) - kept
+        frame_starts = np.searchsorted(unique_frames,unique_frames)
+        frame_rank = kept_before - kept_before[frame_starts] + frame_has_background[unique_frames]
+        new_labels = np.where(background,0,frame_rank).astype("uint32")
+        return new_labels[inv].reshape(label_arr.shape)
 
     def segment(self,img_arr,label_arr=None): ## img_arr is t,y,x
-        t_tot = img_arr.shape[0]
-        img_arr = self.to_8bit(img_arr,self.bit_max)
+        if label_arr is not None:
+            label_arr = label_arr[np.newaxis]
+        return self.segment_batch(img_arr[np.newaxis],label_arr=label_arr)[0]
+
+    def segment_batch(self,img_arr,label_arr=None): ## img_arr is k,t,y,x
+        """Segments a batch of trench kymographs of equal shape. The smoothing,
+        Hessian, background and distance transform filters run once over the
+        (k,y,t*x) stack of unwrapped kymographs, with no filtering across the
+        batch axis, so each trench is segmented as it would be alone.
+
+        Args:
+            img_arr (numpy.ndarray): Kymographs of shape (k,t,y,x).
+            label_arr (numpy.ndarray, optional): Extra mask labels of the same shape, used with maskpath.
+
+        Returns:
+            numpy.ndarray: Labels of shape (k,t,y,x).
+        """
+        num_trenches,t_tot = img_arr.shape[:2]
+        img_arr = self.to_8bit(img_arr,self.bit_max,axis=(1,2,3))
         if self.scale_timepoints:
             img_arr = self.scale_kymo(img_arr,self.scaling_percentile)
 
-        input_kymo = kymo_handle()
-        input_kymo.import_wrap(img_arr)
+        input_kymo = np.swapaxes(img_arr,1,2).reshape(num_trenches,img_arr.shape[2],-1) # k,y,t*x
         del img_arr
-        input_kymo = input_kymo.return_unwrap()
 
-        original_shape = input_kymo.shape
+        original_shape = input_kymo.shape[1:]
         len_per_tpt = (original_shape[1]*self.img_scaling)//t_tot
         adjusted_scale_factor = (len_per_tpt*t_tot)/(original_shape[1])
+        batch_scale_factor = (1,adjusted_scale_factor,adjusted_scale_factor)
 
-        input_kymo = transform.rescale(input_kymo,adjusted_scale_factor,anti_aliasing=False, preserve_range=True).astype("uint8")
-        input_kymo = sk.filters.gaussian(input_kymo,sigma=self.smooth_sigma,preserve_range=True,mode='reflect').astype("uint8")
+        input_kymo = transform.rescale(input_kymo,batch_scale_factor,anti_aliasing=False, preserve_range=True).astype("uint8")
+        input_kymo = sk.filters.gaussian(input_kymo,sigma=(0,self.smooth_sigma,self.smooth_sigma),preserve_range=True,mode='reflect').astype("uint8")
 
         eig_img = self.get_eig_img(input_kymo,edge_padding=self.hess_pad)
 
         if self.maskpath is not None:
-            input_kymo_labels = kymo_handle()
-            input_kymo_labels.import_wrap(label_arr)
-            input_kymo_labels = input_kymo_labels.return_unwrap()
-            input_kymo_labels = transform.rescale(input_kymo_labels,adjusted_scale_factor,anti_aliasing=False, preserve_range=True)
+            input_kymo_labels = np.swapaxes(label_arr,1,2).reshape(num_trenches,label_arr.shape[2],-1)
+            input_kymo_labels = transform.rescale(input_kymo_labels,batch_scale_factor,anti_aliasing=False, preserve_range=True)
             input_kymo_mask = input_kymo_labels>0
         else:
             input_kymo_labels = None
@@ -302,62 +569,56 @@ class fluo_segmentation:
 
         eig_mask, inv_eig_img = self.get_eig_mask(eig_img,input_kymo_mask,eig_sigma=self.eig_sigma,eig_ball_radius=self.eig_ball_radius,\
                                                 eig_local_thr=self.eig_local_thr,eig_otsu_scaling=self.eig_otsu_scaling,\
-                                                eig_niblack_k=self.eig_niblack_k,eig_window_size=self.eig_window_size)
+                                                eig_niblack_k=self.eig_niblack_k,eig_window_size=self.eig_window_size,\
+                                                eig_background_method=self.eig_background_method)
         del input_kymo_mask
         del eig_img
         del inv_eig_img
 
-        cell_mask = self.get_cell_mask(input_kymo,input_kymo_labels,t_tot,local_thr = self.local_thr,\
+        cell_mask = np.stack([self.get_cell_mask(input_kymo[k],None if input_kymo_labels is None else input_kymo_labels[k],t_tot,\
+                    local_thr = self.local_thr,\
                     background_thr = self.background_thr,\
                     global_threshold=self.global_threshold,\
                     window_size = self.window_size,\
                     cell_otsu_scaling = self.cell_otsu_scaling,\
                     niblack_k = self.niblack_k,\
                     background_scaling=self.background_scaling,\
-                    min_obj_size=self.min_obj_size)
+                    min_obj_size=self.min_obj_size) for k in range(num_trenches)],axis=0)
         del input_kymo
         del input_kymo_labels
 
-        dist_img = ndi.distance_transform_edt(cell_mask).astype("uint8")
+        ## a batch axis spacing longer than any in-image distance keeps the transform per image
+        dist_img = ndi.distance_transform_edt(cell_mask,sampling=(sum(cell_mask.shape[1:]),1,1)).astype("uint8")
         dist_mask = dist_img>self.distance_threshold
         marker_mask = dist_mask*eig_mask
         del dist_mask
-        marker_mask = sk.measure.label(marker_mask)
 
-        output_labels = watershed(-dist_img, markers=marker_mask, mask=cell_mask)
+        output_kymo = []
+        for k in range(num_trenches):
+            trench_markers = sk.measure.label(marker_mask[k])
+            output_labels = watershed(-dist_img[k], markers=trench_markers, mask=cell_mask[k])
+            del trench_markers
+
+            output_labels = sk.morphology.remove_small_objects(output_labels,min_size=self.min_obj_size)
+            output_labels = sk.transform.resize(output_labels,original_shape,order=0,anti_aliasing=False, preserve_range=True).astype("uint32")
 
+            trench_kymo = kymo_handle()
+            trench_kymo.import_unwrap(output_labels,t_tot)
+            del output_labels
+            output_kymo.append(trench_kymo.return_wrap())
         del dist_img
         del marker_mask
         del cell_mask
+        output_kymo = np.stack(output_kymo,axis=0) #mask_arr, k,t,y,x
 
-        output_labels = sk.morphology.remove_small_objects(output_labels,min_size=self.min_obj_size)
-        output_labels = sk.transform.resize(output_labels,original_shape,order=0,anti_aliasing=False, preserve_range=True).astype("uint32")
-
-        output_kymo = kymo_handle()
-        output_kymo.import_unwrap(output_labels,t_tot)
-        del output_labels
-        output_kymo = output_kymo.return_wrap() #mask_arr
+        frame_shape = output_kymo.shape
+        output_kymo = output_kymo.reshape(-1,*frame_shape[2:])
         if self.maskpath is not None:
-            reindexed_kymo = np.stack([output_kymo,label_arr],axis=3)
-            relabel_fn = lambda x: int(f'{x[0]:04n}{x[1]:04n}')
-            reindexed_kymo = np.apply_along_axis(relabel_fn,3,reindexed_kymo) #kyx
-            reindexed_kymo[(output_kymo==0)|(label_arr==0)] = 0
-            output_kymo = reindexed_kymo
-            del reindexed_kymo
+            output_kymo = self.combine_labels(output_kymo,label_arr.reshape(-1,*frame_shape[2:]))
             del label_arr
-            output_kymo = np.stack([sk.segmentation.relabel_sequential(output_kymo[i],offset=1)[0] for i in range(output_kymo.shape[0])],axis=0)
-
-        top_bottom_mask = np.ones(output_kymo.shape[1:],dtype=bool)
-        top_bottom_mask[:(self.border_buffer+1)] = False
-        top_bottom_mask[-(self.border_buffer+1):] = False
 
-        for i in range(output_kymo.shape[0]):
-            if (self.border_buffer >= 0) and not self.horizontal_border_only:
-                output_kymo[i] = sk.segmentation.clear_border(output_kymo[i], buffer_size=self.border_buffer) ##NEW
-            elif (self.border_buffer >= 0) and self.horizontal_border_only:
-                output_kymo[i] = sk.segmentation.clear_border(output_kymo[i], mask=top_bottom_mask) ##NEWER
-            output_kymo[i] = self.reorder_ids(output_kymo[i])
-        return output_kymo
+        output_kymo = self.clear_border_frames(output_kymo,border_buffer=self.border_buffer,horizontal_border_only=self.horizontal_border_only)
+        return output_kymo.reshape(frame_shape)
 
 class fluo_segmentation_cluster(fluo_segmentation):
     def __init__(self,headpath,paramfile=True,seg_channel="",segpath="fluorsegmentation",segparfilename="fluorescent_segmentation.par",\
@@ -365,7 +626,7 @@ class fluo_segmentation_cluster(fluo_segmentation):
                  img_scaling=1.,smooth_sigma=0.75,eig_sigma=2.,eig_ball_radius=20,eig_local_thr="niblack",eig_otsu_scaling=1.,\
                  eig_niblack_k=0.05,eig_window_size=7,hess_pad=6,local_thr="otsu",background_thr="triangle",\
                  global_threshold=25,window_size=15,cell_otsu_scaling=1.,niblack_k=0.2,background_scaling=1.,min_obj_size=30,\
-                 distance_threshold=2,border_buffer=1,horizontal_border_only=False):
+                 distance_threshold=2,border_buffer=1,horizontal_border_only=False,seg_batch_pixels=2**23,eig_background_method="rolling_ball"):
 ###             local_thr="otsu",background_thr="triangle",window_size=15,cell_otsu_scaling=1.,niblack_k=0.2,background_scaling=1.,border_buffer=1)
 
 
@@ -393,6 +654,7 @@ class fluo_segmentation_cluster(fluo_segmentation):
         eig_sigma = param_dict['Hessian Blur Sigma:']
         eig_ball_radius = param_dict['Hessian Rolling Ball Size:']
         eig_local_thr = param_dict['Hessian Local Threshold Method:']
+        eig_background_method = param_dict.get('Hessian Background Method:',eig_background_method)
         eig_otsu_scaling = param_dict['Hessian Otsu Scaling:']
         eig_niblack_k = param_dict['Hessian Niblack K:']
         eig_window_size = param_dict['Hessian Local Window Size:']
@@ -407,41 +669,110 @@ class fluo_segmentation_cluster(fluo_segmentation):
                                                         hess_pad=hess_pad,local_thr=local_thr,background_thr=background_thr,\
                                                         global_threshold=global_threshold,window_size=window_size,cell_otsu_scaling=cell_otsu_scaling,niblack_k=niblack_k,\
                                                         background_scaling=background_scaling,min_obj_size=min_obj_size,distance_threshold=distance_threshold,border_buffer=border_buffer,\
-                                                       horizontal_border_only=horizontal_border_only)
+                                                       horizontal_border_only=horizontal_border_only,seg_batch_pixels=seg_batch_pixels,\
+                                                       eig_background_method=eig_background_method)
 
         self.headpath = headpath
         self.seg_channel = seg_channel
         self.kymographpath = headpath + "/kymograph"
         self.segpath = headpath + "/" + segpath
         self.metapath = headpath + "/kymograph/metadata"
+        self.array_backend = get_array_backend(headpath + "/metadata.hdf5")
         if self.maskpath is not None:
             self.fullmaskpath = headpath + "/" + self.maskpath
 
-    def generate_segmentation(self,file_idx):
-        with h5py.File(self.kymographpath + "/kymograph_" + str(file_idx) + ".hdf5","r") as input_file:
+    def get_seg_batch_size(self,kymo_shape):
+        """Number of trenches segmented together, so that a batch holds about
+        seg_batch_pixels pixels. Trenches in a file share a shape.
+
+        Args:
+            kymo_shape (tuple): (trench,t,y,x) shape of a kymograph dataset.
+
+        Returns:
+            int: Trenches per batch.
+        """
+        return max(self.seg_batch_pixels//int(np.prod(kymo_shape[1:])),1)
+
+    def segment_trench_range(self,file_idx,trench_start=0,trench_end=None):
+        """Segments trenches trench_start:trench_end of one kymograph file, in
+        batches of get_seg_batch_size trenches.
+
+        Args:
+            file_idx (int): Kymograph file index.
+            trench_start (int): First trench to segment.
+            trench_end (int): End of the trench range, defaults to the last trench.
+
+        Returns:
+            numpy.ndarray: (trench,t,y,x) label array.
+        """
+        with open_array_file(self.kymographpath + "/kymograph_" + str(file_idx),"r",backend=self.array_backend) as input_file:
             input_data = input_file[self.seg_channel]
+            if trench_end is None:
+                trench_end = input_data.shape[0]
             trench_output = []
+            batch_size = self.get_seg_batch_size(input_data.shape)
 
             if self.maskpath is None:
-                for trench_idx in range(input_data.shape[0]):
-                    trench_array = input_data[trench_idx]
-                    trench_array = self.segment(trench_array)
-                    trench_output.append(trench_array[np.newaxis])
+                for trench_idx in range(trench_start,trench_end,batch_size):
+                    trench_array = input_data[trench_idx:min(trench_idx+batch_size,trench_end)]
+                    trench_array = self.segment_batch(trench_array)
+                    trench_output.append(trench_array)
                     del trench_array
             else:
-                with h5py.File(self.fullmaskpath + "/segmentation_" + str(file_idx) + ".hdf5","r") as input_label_file:
+                with open_array_file(self.fullmaskpath + "/segmentation_" + str(file_idx),"r",backend=self.array_backend) as input_label_file:
                     input_label_data = input_label_file["data"]
-                    for trench_idx in range(input_data.shape[0]):
-                        trench_array = input_data[trench_idx]
-                        input_label_array = input_label_data[trench_idx]
-                        trench_array = self.segment(trench_array,label_arr=input_label_array)
-                        trench_output.append(trench_array[np.newaxis])
+                    for trench_idx in range(trench_start,trench_end,batch_size):
+                        trench_array = input_data[trench_idx:min(trench_idx+batch_size,trench_end)]
+                        input_label_array = input_label_data[trench_idx:min(trench_idx+batch_size,trench_end)]
+                        trench_array = self.segment_batch(trench_array,label_arr=input_label_array)
+                        trench_output.append(trench_array)
                         del trench_array
 
-            trench_output = np.concatenate(trench_output,axis=0)
-            with h5py.File(self.segpath + "/segmentation_" + str(file_idx) + ".hdf5", "w") as h5pyfile:
-                hdf5_dataset = h5pyfile.create_dataset("data", data=trench_output, dtype="uint16")
-            del trench_output
+        return np.concatenate(trench_output,axis=0)
+
+    def generate_segmentation(self,file_idx):
+        trench_output = self.segment_trench_range(file_idx)
+        with open_array_file(self.segpath + "/segmentation_" + str(file_idx), "w", backend=self.array_backend) as h5pyfile:
+            hdf5_dataset = h5pyfile.create_dataset("data", data=trench_output, dtype="uint16")
+        del trench_output
+
+        return file_idx
+
+    def init_segmentation_file(self,file_idx):
+        """Creates an empty segmentation array, chunked one trench per chunk, so that
+        the trench batches of write_segmentation_batch can be written by separate
+        tasks. Only used with the zarr backend.
+
+        Args:
+            file_idx (int): Kymograph file index.
+
+        Returns:
+            list: (trench_start,trench_end) ranges, one per segmentation task.
+        """
+        with open_array_file(self.kymographpath + "/kymograph_" + str(file_idx),"r",backend=self.array_backend) as input_file:
+            kymo_shape = tuple(input_file[self.seg_channel].shape)
+        with open_array_file(self.segpath + "/segmentation_" + str(file_idx), "w", backend=self.array_backend) as outfile:
+            outfile.create_dataset("data", shape=kymo_shape, chunks=(1,)+kymo_shape[1:], dtype="uint16")
+        batch_size = self.get_seg_batch_size(kymo_shape)
+        return [(trench_idx,min(trench_idx+batch_size,kymo_shape[0])) for trench_idx in range(0,kymo_shape[0],batch_size)]
+
+    def write_segmentation_batch(self,file_idx,trench_start,trench_end):
+        """Segments one trench range and writes it into the array made by
+        init_segmentation_file. Ranges of one file write disjoint chunks, so they
+        can run concurrently.
+
+        Args:
+            file_idx (int): Kymograph file index.
+            trench_start (int): First trench to segment.
+            trench_end (int): End of the trench range.
+
+        Returns:
+            int: file_idx.
+        """
+        trench_output = self.segment_trench_range(file_idx,trench_start=trench_start,trench_end=trench_end)
+        with open_array_file(self.segpath + "/segmentation_" + str(file_idx), "r+", backend=self.array_backend) as outfile:
+            outfile["data"][trench_start:trench_end] = trench_output
+        del trench_output
 
         return file_idx
 
@@ -469,19 +800,33 @@ class fluo_segmentation_cluster(fluo_segmentation):
 
         random_priorities = np.random.uniform(size=(num_file_jobs,))
 
+        ## hdf5 files take a single writer, so each file is one task; zarr files are
+        ## split into trench batches that write their own chunks of the output array
         segmentation_futures_list = []
+        remaining_tasks = {}
         for k,file_idx in enumerate(file_list):
             priority = random_priorities[k]
 
-            future = dask_controller.daskclient.submit(self.generate_segmentation,file_idx,retries=0,priority=priority)
-            dask_controller.futures["Segmentation: " + str(file_idx)] = future
-            segmentation_futures_list.append(future)
+            if self.array_backend == "zarr":
+                trench_ranges = self.init_segmentation_file(file_idx)
+                remaining_tasks[file_idx] = len(trench_ranges)
+                for trench_start,trench_end in trench_ranges:
+                    future = dask_controller.daskclient.submit(self.write_segmentation_batch,file_idx,trench_start,trench_end,retries=0,priority=priority)
+                    dask_controller.futures["Segmentation: " + str(file_idx) + " Trenches: " + str(trench_start)] = future
+                    segmentation_futures_list.append(future)
+            else:
+                remaining_tasks[file_idx] = 1
+                future = dask_controller.daskclient.submit(self.generate_segmentation,file_idx,retries=0,priority=priority)
+                dask_controller.futures["Segmentation: " + str(file_idx)] = future
+                segmentation_futures_list.append(future)
 
         for future in as_completed(segmentation_futures_list):
             result = future.result()
-            finished_files = finished_files + [result]
-            with open(self.segpath + "/progress.pkl", 'wb') as infile:
-                pkl.dump(finished_files,infile)
+            remaining_tasks[result] -= 1
+            if remaining_tasks[result] == 0:
+                finished_files = finished_files + [result]
+                with open(self.segpath + "/progress.pkl", 'wb') as infile:
+                    pkl.dump(finished_files,infile)
             future.cancel()
 
         dask_controller.reset_worker_memory()
@@ -974,6 +1319,7 @@ class phase_segmentation_cluster(phase_segmentation):
         self.phasedatapath = self.phasesegmentationpath + "/cell_data"
         self.metapath = headpath + "/metadata.hdf5"
         self.meta_handle = pandas_hdf5_handler(self.metapath)
+        self.array_backend = get_array_backend(self.metapath)
         self.metadf = None
         self.bit_max = None
 
@@ -1008,7 +1354,7 @@ class phase_segmentation_cluster(phase_segmentation):
         img_entry = self.metadf.loc[trench_idx,timepoint]
         file_idx = int(img_entry["File Index"])
         trench_idx = int(img_entry["File Trench Index"])
-        with h5py.File(self.kymographpath + "/kymograph_" + str(file_idx) + ".hdf5", "r") as infile:
+        with open_array_file(self.kymographpath + "/kymograph_" + str(file_idx), "r", backend=self.array_backend) as infile:
             img_arr = infile[channel][trench_idx,timepoint,:,:]
         plt.imshow(img_arr)
 
@@ -1016,16 +1362,16 @@ class phase_segmentation_cluster(phase_segmentation):
         """Load all the trenches in a file.
 
         Args:
-            path_form (str): filename pattern for hdf5s
+            path_form (str): filename pattern for hdf5s, without the extension
             file_idx (int): file index of hdf5 archive
             key (str): channel name
             to_8bit (bool): whether to turn the data to 8-bit
         Returns:
             trench_array_list (numpy.ndarray, int): all timepoints for all trenches (tr x t x y x x)
         """
-        with h5py.File(path_form + str(file_idx) + ".hdf5","r") as input_file:
+        with open_array_file(path_form + str(file_idx),"r",backend=self.array_backend) as input_file:
             if to_8bit:
-                trench_array_list = np.empty_like(input_file[key], dtype=np.uint8)
+                trench_array_list = np.empty(input_file[key].shape, dtype=np.uint8)
                 for tr in range(trench_array_list.shape[0]):
                     for t in range(trench_array_list.shape[1]):
                         trench_array_list[tr,t,:,:] = self.to_8bit(input_file[key][tr,t,:,:])
@@ -1042,7 +1388,7 @@ class phase_segmentation_cluster(phase_segmentation):
         Returns:
             "Done"
         """
-        with h5py.File(self.phasesegmentationpath + "/segmentation_" + str(file_idx) + ".hdf5", "w") as h5pyfile:
+        with open_array_file(self.phasesegmentationpath + "/segmentation_" + str(file_idx), "w", backend=self.array_backend) as h5pyfile:
             hdf5_dataset = h5pyfile.create_dataset("data", data=final_masks_future, dtype=np.uint8)
         return "Done"
 
@@ -1055,7 +1401,7 @@ class phase_segmentation_cluster(phase_segmentation):
             trench_output (numpy.ndarray): (tr x t) array of trench laoding
         """
         # Load file
-        with h5py.File(self.kymographpath + "/kymograph_" + str(file_idx) + ".hdf5","r") as input_file:
+        with open_array_file(self.kymographpath + "/kymograph_" + str(file_idx),"r",backend=self.array_backend) as input_file:
             input_data = input_file[self.seg_channel]
             trench_output = []
             # Measure loading for each trench
@@ -1192,8 +1538,7 @@ class phase_segmentation_cluster(phase_segmentation):
 
         random_priorities = np.random.uniform(size=(num_file_jobs,2))
         for k,file_idx in enumerate(file_list):
-            segmented_masks_file = "segmentation_" + str(file_idx) + ".hdf5"
-            if segmented_masks_file in os.listdir(self.phasesegmentationpath):
+            if array_file_exists(self.phasesegmentationpath + "/segmentation_" + str(file_idx), backend=self.array_backend):
                 times = kymodf.loc[file_idx, "time (s)"]
                 global_trench_indices = kymodf.loc[file_idx, "trenchid"]
                 trench_loadings = kymodf.loc[file_idx, "Trench Loading"]
@@ -1235,8 +1580,7 @@ class phase_segmentation_cluster(phase_segmentation):
         random_priorities = np.random.uniform(size=(num_file_jobs,num_channels))
         for k,file_idx in enumerate(file_list):
             for k2, channel in enumerate(channels):
-                segmented_masks_file = "segmentation_" + str(file_idx) + ".hdf5"
-                if segmented_masks_file in os.listdir(self.phasesegmentationpath):
+                if array_file_exists(self.phasesegmentationpath + "/segmentation_" + str(file_idx), backend=self.array_backend):
                     times = kymodf.loc[file_idx, "time (s)"]
                     global_trench_indices = kymodf.loc[file_idx, "trenchid"]
                     trench_loadings = kymodf.loc[file_idx, "Trench Loading"]
@@ -19,6 +19,7 @@ from recombinator.tapered_block_bootstrap import tapered_block_bootstrap
 from statsmodels.robust.scale import qn_scale
 
 from .daskutils import to_parquet_checkpoint
+from .parquetindex import encode_index_columns
 #### some helper functions for the various estimators
 
 def coeff_var(x,axis=None):
@@ -1146,7 +1147,7 @@ def trench_aggregate_bootstrap_main(dask_controller,steady_state_df_path,estimat
 
         variant_bootstrap_dd = dd.read_parquet(temp_variant_bootstrap_path, engine="pyarrow",calculate_divisions=True)
 
-        variant_bootstrap_dd["Global Bootstrap Index"] = variant_bootstrap_dd.apply(lambda x: int(f'{int(x[variant_index]):08n}{int(x["Bootstrap Index"]):09n}'), axis=1, meta=("Global Bootstrap Index",int)).persist()
+        variant_bootstrap_dd["Global Bootstrap Index"] = encode_index_columns(variant_bootstrap_dd,[variant_index,"Bootstrap Index"],[8,9],name="Global Bootstrap Index").persist()
         wait(variant_bootstrap_dd);
 
         variant_bootstrap_dd = variant_bootstrap_dd.set_index("Global Bootstrap Index",sorted=False)
@@ -1185,8 +1186,8 @@ def trench_aggregate_bootstrap_main(dask_controller,steady_state_df_path,estimat
             new_index_map = dict(zip(old_indices,additional_indices))
             CV_extrinsic_variant_dd["Bootstrap Index"] = CV_extrinsic_variant_dd["Bootstrap Index"].apply(lambda x: new_index_map[x],meta=(None,int)).persist()
             wait(CV_extrinsic_variant_dd);
-            CV_extrinsic_variant_dd["New Global Bootstrap Index"] = CV_extrinsic_variant_dd.apply(lambda x: int(f'{int(x[variant_index]):08n}{int(x["Bootstrap Index"]):09n}'),\
-                                                                                              axis=1, meta=("New Global Bootstrap Index",int)).persist()
+            CV_extrinsic_variant_dd["New Global Bootstrap Index"] = encode_index_columns(CV_extrinsic_variant_dd,[variant_index,"Bootstrap Index"],[8,9],\
+                                                                                              name="New Global Bootstrap Index").persist()
             wait(CV_extrinsic_variant_dd);
             CV_extrinsic_variant_dd = CV_extrinsic_variant_dd.set_index("New Global Bootstrap Index",divisions=variant_bootstrap_dd.divisions).persist()
             wait(CV_extrinsic_variant_dd);
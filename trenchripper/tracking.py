@@ -24,6 +24,9 @@ from pulp import *
 from ipywidgets import interactive, fixed, FloatSlider, IntSlider, IntRangeSlider, SelectMultiple, Dropdown
 
 from .utils import pandas_hdf5_handler,writedir
+from .arraystore import open_array_file,get_array_backend
+from .parquetindex import encode_index,encode_index_columns,index_bounds,fov_parquet_index_widths,file_parquet_index_widths,\
+trenchid_timepoint_index_widths,global_cellid_widths
 from .trcluster import dask_controller
 from .metrics import get_cell_dimensions_spherocylinder_ellipse,get_cell_dimensions_spherocylinder_perimeter_area,width_length_from_permeter_area
 
@@ -74,6 +77,7 @@ class scorefn:
     def __init__(self,headpath,segfolder,size_attr="axis_major_length",u_pos=0.2,sig_pos=0.4,u_size=0.,sig_size=0.2,w_pos=1.,w_size=1.,w_merge=0.8):
         self.headpath = headpath
         self.segpath = headpath + "/" + segfolder
+        self.array_backend = get_array_backend(headpath + "/metadata.hdf5")
         self.size_attr = size_attr
         self.u_pos,self.sig_pos = (u_pos,sig_pos)
         self.u_size,self.sig_size = (u_size,sig_size)
@@ -487,7 +491,7 @@ class scorefn:
         orientation = orientation_dict[orientation]
         print(orientation)
 
-        with h5py.File(self.segpath + "/segmentation_" + str(file_idx) + ".hdf5", "r") as infile:
+        with open_array_file(self.segpath + "/segmentation_" + str(file_idx), "r", backend=self.array_backend) as infile:
             data = infile["data"][trench_idx]
         t0,tf = t_range
         self.size_attr = size_attr
@@ -576,6 +580,7 @@ class tracking_solver:
         self.meta_handle = pandas_hdf5_handler(self.metapath)
         fovdf = self.meta_handle.read_df("global",read_metadata=True)
         self.metadata = fovdf.metadata
+        self.array_backend = self.metadata.get("array_backend","hdf5")
         self.intensity_channel_list = intensity_channel_list
         self.size_estimation = size_estimation
         self.size_estimation_method = size_estimation_method
@@ -1042,7 +1047,7 @@ class tracking_solver:
             if item == -1:
                 output.append(-1)
             else:
-                global_id = int(f'{file_idx:08n}{file_trench_idx:04n}{item:04n}')
+                global_id = encode_index([file_idx,file_trench_idx,item],global_cellid_widths)
                 output.append(global_id)
 
         return output
@@ -1050,10 +1055,10 @@ class tracking_solver:
     def get_lineage_df(self,file_idx,file_trench_idx,fov,row,trench_idx,trenchid,lineage_score,\
                        labeled_data,orientation,y_local,x_local,mother_dict,daughter_dict,sister_dict,centroids,cell_ids_list):
 
-        kymograph_file = self.kymopath + "/kymograph_" + str(file_idx) + ".hdf5"
+        kymograph_file = self.kymopath + "/kymograph_" + str(file_idx)
         if self.intensity_channel_list is not None:
             kymo_arr_list = []
-            with h5py.File(kymograph_file,"r") as kymofile:
+            with open_array_file(kymograph_file,"r",backend=self.array_backend) as kymofile:
                 for intensity_channel in self.intensity_channel_list:
                     intensity_data = kymofile[intensity_channel][:]
                     if orientation == 1:
@@ -1093,7 +1098,7 @@ class tracking_solver:
             for idx in range(ttl_ids):
                 cell_id = cell_ids[idx]
                 centroid = centroids[t][idx]
-                global_cell_id = int(f'{file_idx:08n}{file_trench_idx:04n}{cell_id:04n}')
+                global_cell_id = encode_index([file_idx,file_trench_idx,cell_id],global_cellid_widths)
                 rp = non_intensity_rps[idx]
 
                 props_entry = [file_idx, file_trench_idx, fov, row, trench_idx, trenchid, t, idx, cell_id, global_cell_id, orientation, lineage_score]
@@ -1189,8 +1194,7 @@ class tracking_solver:
         return df_out
 
     def lineage_trace(self,kymo_meta,file_idx,file_trench_idx):
-        file_trench_idx_i = int(f'{file_idx:08n}{file_trench_idx:04n}{0:04n}')
-        file_trench_idx_f = int(f'{file_idx:08n}{file_trench_idx+1:04n}{0:04n}')-1
+        file_trench_idx_i,file_trench_idx_f = index_bounds([file_idx,file_trench_idx],file_parquet_index_widths)
         trench = kymo_meta.loc[file_trench_idx_i:file_trench_idx_f]
         fov = trench["fov"].iloc[0]
         row = trench["row"].iloc[0]
@@ -1204,7 +1208,7 @@ class tracking_solver:
         y_local = trench["y (local)"].iloc[0]
         x_local = trench["x (local)"].iloc[0]
 
-        with h5py.File(self.segpath + "/segmentation_" + str(file_idx) + ".hdf5", "r") as infile:
+        with open_array_file(self.segpath + "/segmentation_" + str(file_idx), "r", backend=self.array_backend) as infile:
             data = infile["data"][file_trench_idx]
 
         labeled_data,centroids,sizes,_,Aik_arr_list,_,_,lineage_score = self.compute_lineage(data,orientation)
@@ -1221,8 +1225,7 @@ class tracking_solver:
         kymo_df = dd.read_parquet(self.headpath+"/kymograph/metadata",calculate_divisions=True)
         kymo_df = kymo_df.reset_index(drop=False).set_index("File Parquet Index",sorted=True,npartitions=n_partitions,divisions=divisions)
 
-        start_idx = int(str(file_idx) + "00000000")
-        end_idx = int(str(file_idx) + "99999999")
+        start_idx,end_idx = index_bounds([file_idx],file_parquet_index_widths)
 
         kymo_df = kymo_df.loc[start_idx:end_idx].compute(scheduler='threads')
         trench_idx_list = kymo_df["File Trench Index"].unique().tolist()
@@ -1236,12 +1239,9 @@ class tracking_solver:
                 pass
         if len(mergeddf) > 0:
             mergeddf = pd.concat(mergeddf).reset_index()
-            kymo_parq_file_idx = mergeddf.apply(lambda x: int(f'{int(x["File Index"]):08n}{int(x["File Trench Index"]):04n}{int(x["timepoints"]):04n}'), axis=1)
-            kymo_parq_file_idx.index = mergeddf.index
-            kymo_parq_fov_idx = mergeddf.apply(lambda x: int(f'{int(x["fov"]):08n}{int(x["row"]):04n}{int(x["trench"]):04n}{int(x["timepoints"]):04n}'), axis=1)
-            kymo_parq_fov_idx.index = mergeddf.index
-            kymo_parq_trenchid_idx = mergeddf.apply(lambda x: int(f'{int(x["trenchid"]):08n}{int(x["timepoints"]):04n}'), axis=1)
-            kymo_parq_trenchid_idx.index = mergeddf.index
+            kymo_parq_file_idx = encode_index_columns(mergeddf,["File Index","File Trench Index","timepoints"],file_parquet_index_widths)
+            kymo_parq_fov_idx = encode_index_columns(mergeddf,["fov","row","trench","timepoints"],[8,4,4,4])
+            kymo_parq_trenchid_idx = encode_index_columns(mergeddf,["trenchid","timepoints"],trenchid_timepoint_index_widths)
             mergeddf["Kymograph File Parquet Index"] = kymo_parq_file_idx
             mergeddf["Kymograph FOV Parquet Index"] = kymo_parq_fov_idx
             mergeddf["Trenchid Timepoint Index"] = kymo_parq_trenchid_idx
@@ -1263,8 +1263,8 @@ class tracking_solver:
             #remove old indices
     #         del mergeddf["FOV Parquet Index"]
 
-            parq_file_idx = mergeddf.apply(lambda x: int(f'{int(x["File Index"]):08n}{int(x["File Trench Index"]):04n}{int(x["timepoints"]):04n}{int(x["CellID"]):04n}'), axis=1)
-            parq_fov_idx = mergeddf.apply(lambda x: int(f'{int(x["fov"]):04n}{int(x["row"]):04n}{int(x["trench"]):04n}{int(x["timepoints"]):04n}{int(x["CellID"]):04n}'), axis=1)
+            parq_file_idx = encode_index_columns(mergeddf,["File Index","File Trench Index","timepoints","CellID"],file_parquet_index_widths+[4])
+            parq_fov_idx = encode_index_columns(mergeddf,["fov","row","trench","timepoints","CellID"],fov_parquet_index_widths+[4])
 
             mergeddf["File Parquet Index"] = parq_file_idx
             mergeddf["FOV Parquet Index"] = parq_fov_idx
@@ -4,11 +4,15 @@ import h5py
 import shutil
 import os
 import ast
+import threading
 
 import pandas as pd
 import pickle as pkl
 import dask.dataframe as dd
 from copy import deepcopy
+from collections import OrderedDict
+from .arraystore import open_array_file,get_array_backend
+from .parquetindex import encode_index_columns,fov_parquet_index_widths,file_parquet_index_widths,trenchid_timepoint_index_widths
 
 class multifov():
     def __init__(self,selected_fov_list):
@@ -71,9 +75,16 @@ class kymo_handle():
     def return_wrap(self):
         return self.kymo_arr[:]
 
+## in-process LRU cache of read_df results, keyed on (path,key,mtime,size);
+## dask workers run tasks in threads, so every access goes through read_df_cache_lock
+read_df_cache = OrderedDict()
+read_df_cache_size = 8
+read_df_cache_lock = threading.Lock()
+
 class pandas_hdf5_handler:
-    def __init__(self,hdf5_path):
+    def __init__(self,hdf5_path,use_cache=True):
         self.hdf5_path = hdf5_path
+        self.use_cache = use_cache
 
     def keys(self):
         with pd.HDFStore(self.hdf5_path,"r") as store:
@@ -86,12 +97,52 @@ class pandas_hdf5_handler:
             store.put(key, df)
             if metadata is not None:
                 store.get_storer(key).attrs.metadata = metadata
+        self.clear_cache()
+
+    def clear_cache(self):
+        hdf5_path = os.path.abspath(self.hdf5_path)
+        with read_df_cache_lock:
+            for cache_key in [cache_key for cache_key in read_df_cache.keys() if cache_key[0] == hdf5_path]:
+                del read_df_cache[cache_key]
+
     def read_df(self,key,read_metadata=False):
-        with pd.HDFStore(self.hdf5_path,"r") as store:
-            df = store.get(key)
-            if read_metadata:
-                df.metadata = store.get_storer(key).attrs.metadata
-            return df
+        """Reads a dataframe, and optionally its metadata, from the store. Results
+        are cached in-process and reused until the file's modification time
+        or size changes, so repeated reads of the same table (e.g. "global"
+        from many tasks on one worker) only parse the file once. A copy is
+        returned on each call.
+        """
+        if not self.use_cache:
+            with pd.HDFStore(self.hdf5_path,"r") as store:
+                df = store.get(key)
+                if read_metadata:
+                    df.metadata = store.get_storer(key).attrs.metadata
+                return df
+
+        file_stat = os.stat(self.hdf5_path)
+        cache_key = (os.path.abspath(self.hdf5_path),key,file_stat.st_mtime_ns,file_stat.st_size)
+        with read_df_cache_lock:
+            cached = read_df_cache.get(cache_key,None)
+            if cached is not None:
+                read_df_cache.move_to_end(cache_key)
+        if cached is not None:
+            df,metadata = cached
+        else:
+            with pd.HDFStore(self.hdf5_path,"r") as store:
+                df = store.get(key)
+                attrs = store.get_storer(key).attrs
+                metadata = getattr(attrs,"metadata",None)
+            with read_df_cache_lock:
+                read_df_cache[cache_key] = (df,metadata)
+                while len(read_df_cache) > read_df_cache_size:
+                    read_df_cache.popitem(last=False)
+
+        df = df.copy()
+        if read_metadata:
+            if metadata is None:
+                raise AttributeError("No metadata stored for key " + str(key))
+            df.metadata = deepcopy(metadata)
+        return df
 
 def writedir(directory,overwrite=False):
     if overwrite:
@@ -108,6 +159,7 @@ class dataset_time_cropper:
         self.headpath = headpath
         self.subsample_headpath = subsample_headpath
         self.segpath = segpath
+        self.array_backend = get_array_backend(headpath + "/metadata.hdf5") ##the cropped dataset keeps the source backend
 
     def reset_daughters(self,df):
         min_tpts = df.groupby(['Global CellID'])['timepoints'].idxmin().tolist()
@@ -123,8 +175,8 @@ class dataset_time_cropper:
         kymographpath = self.headpath+"/kymograph"
         subsample_kymographpath = self.subsample_headpath+"/kymograph"
 
-        with h5py.File(subsample_kymographpath+"/kymograph_" + str(file_idx) + ".hdf5", "w") as outfile:
-            with h5py.File(kymographpath+"/kymograph_" + str(file_idx) + ".hdf5", "r") as infile:
+        with open_array_file(subsample_kymographpath+"/kymograph_" + str(file_idx), "w", backend=self.array_backend) as outfile:
+            with open_array_file(kymographpath+"/kymograph_" + str(file_idx), "r", backend=self.array_backend) as infile:
                 for channel in infile.keys():
                     cropped_data = infile[channel][:,timepoint_list]
                     hdf5_dataset = outfile.create_dataset(str(channel), data=cropped_data, dtype="uint16")
@@ -135,8 +187,8 @@ class dataset_time_cropper:
         segmentationpath = self.headpath + "/" + self.segpath
         subsample_segmentationpath = self.subsample_headpath + "/" + self.segpath
 
-        with h5py.File(subsample_segmentationpath+"/segmentation_" + str(file_idx) + ".hdf5", "w") as outfile:
-            with h5py.File(segmentationpath+"/segmentation_" + str(file_idx) + ".hdf5", "r") as infile:
+        with open_array_file(subsample_segmentationpath+"/segmentation_" + str(file_idx), "w", backend=self.array_backend) as outfile:
+            with open_array_file(segmentationpath+"/segmentation_" + str(file_idx), "r", backend=self.array_backend) as infile:
                 cropped_data = infile['data'][:,timepoint_list]
                 hdf5_dataset = outfile.create_dataset("data", data=cropped_data, dtype="uint16")
 
@@ -157,11 +209,11 @@ class dataset_time_cropper:
 
         kymo_meta_filtered = kymo_meta_filtered.reset_index()
         ##FOV Parquet Index
-        kymo_meta_filtered["FOV Parquet Index"] = kymo_meta_filtered.apply(lambda x: int(f'{x["fov"]:04n}{x["row"]:04n}{x["trench"]:04n}{x["timepoints"]:04n}'), axis=1, meta=(None, 'int64')).persist()
+        kymo_meta_filtered["FOV Parquet Index"] = encode_index_columns(kymo_meta_filtered,["fov","row","trench","timepoints"],fov_parquet_index_widths).persist()
         ##File Parquet Index
-        kymo_meta_filtered["File Parquet Index"] = kymo_meta_filtered.apply(lambda x: int(f'{int(x["File Index"]):08n}{int(x["File Trench Index"]):04n}{int(x["timepoints"]):04n}'), axis=1, meta=(None, 'int64')).persist()
+        kymo_meta_filtered["File Parquet Index"] = encode_index_columns(kymo_meta_filtered,["File Index","File Trench Index","timepoints"],file_parquet_index_widths).persist()
         ##Trenchid Timepoint Index
-        kymo_meta_filtered["Trenchid Timepoint Index"] = kymo_meta_filtered.apply(lambda x: int(f'{x["trenchid"]:08n}{x["timepoints"]:04n}'), axis=1, meta=(None, 'int64')).persist()
+        kymo_meta_filtered["Trenchid Timepoint Index"] = encode_index_columns(kymo_meta_filtered,["trenchid","timepoints"],trenchid_timepoint_index_widths).persist()
 
         kymo_meta_filtered = kymo_meta_filtered.set_index("FOV Parquet Index",sorted=True)
 
@@ -177,15 +229,15 @@ class dataset_time_cropper:
         lineage_meta_filtered = lineage_meta_filtered.reset_index()
 
         #Kymograph File Parquet Index
-        lineage_meta_filtered["Kymograph File Parquet Index"] = lineage_meta_filtered.apply(lambda x: int(f'{int(x["File Index"]):08n}{int(x["File Trench Index"]):04n}{int(x["timepoints"]):04n}'), axis=1, meta=(None, 'int64')).persist()
+        lineage_meta_filtered["Kymograph File Parquet Index"] = encode_index_columns(lineage_meta_filtered,["File Index","File Trench Index","timepoints"],file_parquet_index_widths).persist()
         #Kymograph FOV Parquet Index
-        lineage_meta_filtered["Kymograph FOV Parquet Index"] = lineage_meta_filtered.apply(lambda x: int(f'{x["fov"]:04n}{x["row"]:04n}{x["trench"]:04n}{x["timepoints"]:04n}'), axis=1, meta=(None, 'int64')).persist()
+        lineage_meta_filtered["Kymograph FOV Parquet Index"] = encode_index_columns(lineage_meta_filtered,["fov","row","trench","timepoints"],fov_parquet_index_widths).persist()
         #Trenchid Timepoint Index
-        lineage_meta_filtered["Trenchid Timepoint Index"] = lineage_meta_filtered.apply(lambda x: int(f'{x["trenchid"]:08n}{x["timepoints"]:04n}'), axis=1, meta=(None, 'int64')).persist()
+        lineage_meta_filtered["Trenchid Timepoint Index"] = encode_index_columns(lineage_meta_filtered,["trenchid","timepoints"],trenchid_timepoint_index_widths).persist()
         #FOV Parquet Index
-        lineage_meta_filtered["FOV Parquet Index"] = lineage_meta_filtered.apply(lambda x: int(f'{int(x["fov"]):04n}{int(x["row"]):04n}{int(x["trench"]):04n}{int(x["timepoints"]):04n}{int(x["CellID"]):04n}'), axis=1, meta=(None, 'int64'))
+        lineage_meta_filtered["FOV Parquet Index"] = encode_index_columns(lineage_meta_filtered,["fov","row","trench","timepoints","CellID"],fov_parquet_index_widths+[4])
         #File Parquet Index
-        lineage_meta_filtered["File Parquet Index"] = lineage_meta_filtered.apply(lambda x: int(f'{int(x["File Index"]):08n}{int(x["File Trench Index"]):04n}{int(x["timepoints"]):04n}{int(x["CellID"]):04n}'), axis=1, meta=(None, 'int64'))
+        lineage_meta_filtered["File Parquet Index"] = encode_index_columns(lineage_meta_filtered,["File Index","File Trench Index","timepoints","CellID"],file_parquet_index_widths+[4])
 
         lineage_meta_filtered = lineage_meta_filtered.set_index("File Parquet Index",sorted=True)
 